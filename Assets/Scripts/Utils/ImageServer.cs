@@ -1,4 +1,5 @@
 using System.Collections;
+using System.Collections.Generic;
 using System.Net.NetworkInformation;
 using UnityEngine;
 using UnityEngine.Networking;
@@ -13,6 +14,22 @@ namespace PicassoAR.Utils
         public string serverUrl = "https://127.0.0.1:8080/"; // replace with the actual server url
         private string listenPath = "comm_usr";
         private string sendPath = "comm_ml2";
+        private string jobsPath = "jobs";
+        private int maxWaitSeconds = 30; // the server holds the request open until the job is done
+
+        // id of the last processing job returned by the server
+        private string lastJobId = null;
+
+        // ETag and texture of the images fetched by name, the server answers 304 if they did not change
+        private Dictionary<string, string> imageETags = new Dictionary<string, string>();
+        private Dictionary<string, Texture2D> imageTextures = new Dictionary<string, Texture2D>();
+
+        [System.Serializable]
+        private class JobResponse
+        {
+            public string job_id;
+            public string status;
+        }
         
         public IEnumerator SendImageToServer(Texture2D texture, string imageName = "image.png")
         {   
@@ -29,6 +46,11 @@ namespace PicassoAR.Utils
             if (request.result == UnityWebRequest.Result.Success)
             {   
                 Debug.Log("Send image success!");
+                JobResponse job = JsonUtility.FromJson<JobResponse>(request.downloadHandler.text);
+                if (job != null && !string.IsNullOrEmpty(job.job_id))
+                {
+                    lastJobId = job.job_id;
+                }
             }
             else
             {
@@ -40,13 +62,36 @@ namespace PicassoAR.Utils
         public IEnumerator FetchProcessedImage(string imgName, System.Action<Texture2D> onComplete)
         {
             // called immediately after sending the image to the server
-            string url = $"{serverUrl}{listenPath}?img={UnityWebRequest.EscapeURL(imgName)}";
+            // if an image was sent, wait for its job to finish, otherwise fetch the image by name
+            string url = string.IsNullOrEmpty(lastJobId)
+                ? $"{serverUrl}{listenPath}?img={UnityWebRequest.EscapeURL(imgName)}"
+                : $"{serverUrl}{jobsPath}/{lastJobId}/result?wait={maxWaitSeconds}";
             Debug.Log("url " + url);
+            bool byName = string.IsNullOrEmpty(lastJobId);
             UnityWebRequest request = UnityWebRequest.Get(url);
+            if (byName && imageETags.TryGetValue(imgName, out string etag))
+            {
+                request.SetRequestHeader("If-None-Match", etag);
+            }
             yield return request.SendWebRequest();
 
+            if (request.responseCode == 304 && imageTextures.TryGetValue(imgName, out Texture2D cached))
+            {
+                // unchanged since the last fetch, only the headers were transferred
+                onComplete?.Invoke(cached);
+                yield break;
+            }
+
             if (request.result == UnityWebRequest.Result.Success)
             {
+                if (request.responseCode == 202)
+                {
+                    // the job is still being processed, keep its id for the next attempt
+                    Debug.Log("Image is still being processed.");
+                    yield break;
+                }
+                lastJobId = null;
+
                 // Parse the gallery JSON (SimpleJSON or System.Text.Json)
                 var galleryData = request.downloadHandler.text; 
                 Debug.Log("Got response: " + galleryData);
@@ -54,11 +99,22 @@ namespace PicassoAR.Utils
                 byte[] processedData = request.downloadHandler.data;
                 Texture2D processedTexture = new Texture2D(2, 2); // will be replaced by the actual image texture afterwardss
                 processedTexture.LoadImage(processedData);
+                string responseETag = request.GetResponseHeader("ETag");
+                if (byName && !string.IsNullOrEmpty(responseETag))
+                {
+                    imageETags[imgName] = responseETag;
+                    imageTextures[imgName] = processedTexture;
+                }
                 onComplete?.Invoke(processedTexture);
             }
             else
             {
                 Debug.LogError($"Error fetching gallery: {request.error}");
+                if (!byName)
+                {
+                    // the job failed or was forgotten by the server, fetch by name next time
+                    lastJobId = null;
+                }
                 yield return null;
             }
         }
@@ -68,6 +124,7 @@ namespace PicassoAR.Utils
         {
             string url = $"https://localhost:8080/images/{pathType}/gallery";
             UnityWebRequest request = UnityWebRequest.Get(url);
+            request.SetRequestHeader("Accept", "application/json");
             yield return request.SendWebRequest();
 
             if (request.result == UnityWebRequest.Result.Success)
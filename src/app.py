@@ -1,12 +1,32 @@
 import datetime
+import json
+import multiprocessing
 import os
+import threading
+import time
+import uuid
 
 import cv2
-from flask import Flask, jsonify, render_template, request, send_from_directory, url_for
+from flask import Flask, Response, g, jsonify, render_template, request, send_from_directory, url_for
 from werkzeug.utils import secure_filename
 
-from src.image_processing import edge_detection, init_net
-from src.utils import format_bytes
+from src.cache import ProbabilityStore, ResultCache
+from src.catalogue import ImageCatalogue
+from src.encoding import FORMATS, EncodingCache, encode_outline, negotiate_format, outline_mask
+from src.image_processing import (BORDER_THICKNESS, EDGE_METHODS, OUTLINE_PNG_PARAMS, STEP_THRESHOLDS,
+                                  THRESHOLD, OutlineBuffers, edge_detection, outline_from_hed,
+                                  stepwise_outlines)
+from src.jobs import JobQueue, decode_image, processed_name
+from src.latency import resolve_budget
+from src.markers import ARUCO_DICTIONARY, MARKER_SIZE, MarkerSessions, camera_matrix
+from src.metrics import SIZE_BUCKETS, Metrics, server_timing, stage
+from src.utils import format_bytes, parse_hex_color
+from src.scheduler import Overloaded, configure_threads
+from src.streaming import FRAME_RESULTS, StreamSessions
+from src.strokes import PAGE_SIZE, DrawingPlans, extract_strokes, plan_drawing_order
+from src.vector import TOLERANCE, decode_polylines
+from src.warping import WarpCache, encode_warped, pose_corners
+from src.writer import AsyncWriter
 
 app = Flask(__name__, static_folder='src/images')
 
@@ -16,6 +36,8 @@ RAW_FOLDER = os.path.join(BASE_DIR, 'images/raw')
 PROCESSED_FOLDER = os.path.join(BASE_DIR, 'images/processed')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 ML2_FOLDER = os.path.join(BASE_DIR, 'images/ml2_exchange')
+CACHE_FOLDER = os.path.join(BASE_DIR, 'cache')
+PROBABILITY_FOLDER = os.path.join(PROCESSED_FOLDER, 'data')  # edge maps for restyling outlines
 
 # Ensure directories exist
 os.makedirs(RAW_FOLDER, exist_ok=True)
@@ -24,31 +46,178 @@ os.makedirs(ML2_FOLDER, exist_ok=True)
 os.makedirs(os.path.join(PROCESSED_FOLDER, 'data'), exist_ok=True) # for exchanging other formats
 os.makedirs(os.path.join(RAW_FOLDER, 'data'), exist_ok=True)
 
+# Server processes on this host, e.g. with gunicorn -w N (whose default is WEB_CONCURRENCY). Every process
+# starts a pool of its own, so the cores (and the default number of workers) are divided among them
+SERVER_PROCESSES = max(1, int(os.environ.get('PICASSO_SERVER_PROCESSES', os.environ.get('WEB_CONCURRENCY', 1))))
+# Images posted by ML2 are processed by a pool of workers, each with its own network
+NUM_WORKERS = int(os.environ.get('PICASSO_WORKERS', max(1, (os.cpu_count() or 1) // SERVER_PROCESSES)))
+# OpenCV threads of each worker (by default the cores divided among the workers) and of the server
+# process, whose request threads run previews and encodings concurrently
+THREADS_PER_WORKER = int(os.environ.get('PICASSO_THREADS_PER_WORKER', 0)) or None
+SERVER_THREADS = int(os.environ.get('PICASSO_SERVER_THREADS', 1))
+DNN_BACKEND = os.environ.get('PICASSO_DNN_BACKEND')  # see DNN_BACKENDS and DNN_TARGETS in image_processing
+DNN_TARGET = os.environ.get('PICASSO_DNN_TARGET')
+# Images waiting for or on the workers, more are rejected with 503 and Retry-After
+MAX_PENDING = int(os.environ.get('PICASSO_MAX_PENDING', 4 * NUM_WORKERS))
+MAX_WAIT_SECONDS = 30  # upper bound for long polling and event streams
+# Large images are processed in tiles to bound the memory used by the network
+TILE_SIZE = int(os.environ.get('PICASSO_TILE_SIZE', 1024))
+TILES_PER_BATCH = int(os.environ.get('PICASSO_TILES_PER_BATCH', 1))
+# Images (of the same size) run through the network together, the first one waits up to the window for
+# the others. Whether it pays off depends on the image size and target, see benchmarks/bench_batch.py
+MAX_BATCH = int(os.environ.get('PICASSO_MAX_BATCH', 1))
+BATCH_WINDOW_MS = float(os.environ.get('PICASSO_BATCH_WINDOW_MS', 10))
+# Uploads and results are kept in memory, saving them to disk happens in the background
+PERSIST_IMAGES = os.environ.get('PICASSO_PERSIST_IMAGES', '1') == '1'
+# Edge maps are kept in a packed store (see src/store.py) instead of one .npy file per image
+PACKED_STORE = os.environ.get('PICASSO_PACKED_STORE', '0') == '1'
+# The workers load the network in the background when the app is imported, instead of on the first request
+PRELOAD_MODEL = os.environ.get('PICASSO_PRELOAD_MODEL', '1') == '1'
+PREVIEW_METHOD = os.environ.get('PICASSO_PREVIEW_METHOD', 'canny')  # fast tier used for live previews
+TRACE_HEADER = 'X-Trace'  # requests with "X-Trace: 1" get their stage timings in a Server-Timing header
+metrics = Metrics()
+cache = ResultCache(CACHE_FOLDER)
+probabilities = ProbabilityStore(PROBABILITY_FOLDER, packed=PACKED_STORE)
+writer = AsyncWriter() if PERSIST_IMAGES else None
+encodings = EncodingCache()
+warps = WarpCache()
+plans = DrawingPlans()  # strokes of outlines in drawing order
+jobs = JobQueue(PROCESSED_FOLDER, num_workers=NUM_WORKERS, cache=cache, probability_store=probabilities,
+                writer=writer, options={"tile_size": TILE_SIZE, "tiles_per_batch": TILES_PER_BATCH},
+                metrics=metrics, threads_per_worker=THREADS_PER_WORKER, backend=DNN_BACKEND,
+                target=DNN_TARGET, max_pending=MAX_PENDING, max_batch=MAX_BATCH,
+                batch_window_ms=BATCH_WINDOW_MS, server_processes=SERVER_PROCESSES)
+configure_threads(SERVER_THREADS)
+streams = StreamSessions(jobs)  # camera frame streams of the headset
+markers = MarkerSessions()  # marker tracking state of the headsets
+if PRELOAD_MODEL and multiprocessing.current_process().name == "MainProcess":  # not in the workers, they import the app too
+    jobs.start()
+_submitted_files = {}  # job of every file in the ML2 folder that was queued, None while it is being queued
+_preview_buffers = threading.local()  # OutlineBuffers of each request thread
+GALLERY_PAGE_SIZE = 100
+# Cache-Control of the images of each type. Raw images do not change once uploaded, processed
+# images are overwritten when an image is processed again and have to be revalidated (with their
+# ETag, so unchanged images cost a 304 without body)
+CACHE_CONTROL = {
+    "raw": "public, max-age=86400",
+    "processed": "no-cache",
+    "ml2_exchange": "no-cache",
+    "job": "private, max-age=86400, immutable",
+}
+
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def get_images_info(folder, path_type):
+# index of the image folders, rescanned only when their content changes
+catalogue = ImageCatalogue({"raw": RAW_FOLDER, "processed": PROCESSED_FOLDER, "ml2_exchange": ML2_FOLDER},
+                           allowed=allowed_file)
+
+
+def get_images_info(path_type, sort="date", reverse=False, offset=0, limit=None):
+    total, entries = catalogue.list(path_type, sort, reverse, offset, limit)
     images = []
-    for filename in os.listdir(folder):
-        filepath = os.path.join(folder, filename)
-        if os.path.isfile(filepath) and allowed_file(filename):
-            size = os.path.getsize(filepath)
-            date = datetime.datetime.fromtimestamp(os.path.getctime(filepath)).strftime('%Y-%m-%d %H:%M:%S')
-            images.append({
-                'filename': filename,
-                'path': url_for('fetch_image', path_type=path_type, filename=filename),#f"/{folder}/{filename}",
-                'size': format_bytes(size),
-                'date': date
-            })
-    return images
-
-
-def process_image_from_file(file_path, net, save_path):
-    image = cv2.imread(file_path)
-    edge_detection_output = edge_detection(file_path, image, net, save_path)
-    return edge_detection_output
+    for entry in entries:
+        date = datetime.datetime.fromtimestamp(entry.ctime).strftime('%Y-%m-%d %H:%M:%S')
+        images.append({
+            'filename': entry.filename,
+            'path': url_for('fetch_image', path_type=path_type, filename=entry.filename),
+            'size': format_bytes(entry.size),
+            'bytes': entry.size,
+            'date': date
+        })
+    return total, images
+
+
+def send_image(path_type, filename):
+    """
+    Sends an image of the catalogue with its content hash as ETag and the Cache-Control policy of
+    its type. Conditional (If-None-Match) and Range requests are answered with 304 and 206.
+    """
+    digest = catalogue.digest(path_type, filename)
+    if digest is None:
+        return f"Image \"{filename}\" not found", 404
+    response = send_from_directory(catalogue.folders[path_type], filename, etag=digest)
+    response.headers["Cache-Control"] = CACHE_CONTROL[path_type]
+    return response
+
+
+def send_bytes(get_data, mimetype, etag, cache_control):
+    """
+    Sends data generated by `get_data` (only called if the client does not have the current
+    version) with the given ETag and Cache-Control policy, with support for conditional and Range
+    requests.
+    """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        with stage(g.stages, "encode"):
+            data = get_data()
+        response = Response(data, mimetype=mimetype)
+        response.make_conditional(request, accept_ranges=True, complete_length=len(data))
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = cache_control
+    return response
+
+
+def send_outline(filename):
+    """
+    Sends a processed image in the format picked by the `format` parameter or the Accept header
+    (see src.encoding), or as stored if no compact format was asked for.
+    """
+    try:
+        fmt = negotiate_format(request.args.get("format"), request.accept_mimetypes)
+    except ValueError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+    if fmt is None:
+        response = send_image("processed", filename)
+    else:
+        digest = catalogue.digest("processed", filename)
+        if digest is None:
+            return f"Image \"{filename}\" not found", 404
+        path = os.path.join(PROCESSED_FOLDER, filename)
+        try:
+            response = send_bytes(lambda: encodings.get(path, os.stat(path), fmt), FORMATS[fmt],
+                                  f"{digest}-{fmt}", CACHE_CONTROL["processed"])
+        except (OSError, ValueError):
+            return f"Image \"{filename}\" not found", 404
+    if isinstance(response, Response):
+        response.vary.add("Accept")
+    return response
+
+
+def processing_options():
+    """
+    Edge detection options of a request: the latency budget, from the `budget_ms` or `quality`
+    parameter, and the edge detector (`method`, hed or one of the fast tier).
+    Raises ValueError for invalid values.
+    """
+    budget_ms = request.values.get("budget_ms", type=float)
+    quality = request.values.get("quality")
+    resolve_budget(budget_ms, quality)
+    options = {}
+    if budget_ms is not None:
+        options["budget_ms"] = budget_ms
+    if quality is not None:
+        options["quality"] = quality
+    method = request.values.get("method")
+    if method is not None:
+        if method not in EDGE_METHODS:
+            raise ValueError(f"unknown edge detection method \"{method}\", expected one of {list(EDGE_METHODS)}")
+        options["method"] = method
+    return options
+
+
+def preview_outline(filename, image):
+    """
+    Outline of the fast tier (PREVIEW_METHOD), computed in the request thread.
+    """
+    buffers = getattr(_preview_buffers, "buffers", None)
+    if buffers is None:
+        buffers = _preview_buffers.buffers = OutlineBuffers()
+    info = {"stages": g.stages}
+    return edge_detection(filename, image, None, method=PREVIEW_METHOD, buffers=buffers, info=info)
 
 
 @app.route("/")
@@ -56,20 +225,37 @@ def home():
     return render_template("index.html")
 
 """
-A gallery to preview the images
+A gallery to preview the images. Returns JSON if asked for with ?format=json or the Accept header,
+otherwise an HTML page.
+Parameters: sort (date, name or size), order (asc or desc, default desc), page (from 1) and per_page.
 """
 @app.route("/images/<path_type>/gallery")
 def gallery(path_type):
-    print("type: ", path_type)
-    if path_type == "processed":
-        folder = PROCESSED_FOLDER
-    elif path_type == "raw":
-        folder = RAW_FOLDER
-    else:
+    if path_type not in ["processed", "raw"]:
         return f"path type \"{path_type}\" not found", 404
-    
-    images = get_images_info(folder, path_type)
-    return render_template("gallery.html", path_type=path_type, images=images)
+    try:
+        sort = request.args.get("sort", "date")
+        page = request.args.get("page", 1, type=int)
+        per_page = request.args.get("per_page", GALLERY_PAGE_SIZE, type=int)
+        if page < 1 or per_page < 1:
+            raise ValueError("page and per_page must be positive")
+        total, images = get_images_info(path_type, sort, request.args.get("order", "desc") == "desc",
+                                        (page - 1) * per_page, per_page)
+    except ValueError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+
+    wants_json = request.args.get("format") == "json" or \
+        request.accept_mimetypes.best_match(["text/html", "application/json"]) == "application/json"
+    if wants_json:
+        return jsonify({"path_type": path_type, "total": total, "page": page, "per_page": per_page,
+                        "images": images})
+    pages = max(1, -(-total // per_page))
+
+    def page_url(number):
+        # the other pages keep the sort, order and page size
+        return url_for("gallery", path_type=path_type, **dict(request.args.to_dict(), page=number))
+    return render_template("gallery.html", path_type=path_type, images=images, page=page, pages=pages,
+                           page_url=page_url)
 
 
 """
@@ -90,6 +276,7 @@ def upload_image(path_type):
             if file and allowed_file(file.filename):
                 filename = secure_filename(file.filename)
                 file.save(os.path.join(folder, filename))
+                catalogue.refresh(path_type, filename)
                 print(f"file saved to {os.path.join(folder, filename)}")
                 return jsonify({"status": "success", "path_type": path_type}), 200
         return render_template("upload.html", path_type=path_type)
@@ -103,28 +290,283 @@ Access image of a specific type
 """
 @app.route("/images/<path_type>/<filename>")
 def fetch_image(path_type, filename):
-    folder = PROCESSED_FOLDER if path_type == "processed" else RAW_FOLDER
-    return send_from_directory(folder, filename)
+    if path_type == "processed":
+        return send_outline(filename)
+    return send_image("raw", filename)
 
 
 """
 The Data folder is used to keep processed / raw data of different types. This will be useful if we 
 Use other representations for the ref image projected on the headset. E.g. image graphs
+Returns the outline of a processed image (img) as polylines (see src.vector), simplified with the
+given tolerance in pixels. format=json returns the points as JSON instead of the binary format.
 """
 @app.route("/images/<path_type>/data")
 def data_folder(path_type):
     if path_type not in ['processed', 'raw']:
         return "Invalid path type", 404
-    # folder = os.path.join(PROCESSED_FOLDER, 'data') if path_type == "processed" else os.path.join(RAW_FOLDER, 'data')
-    # The data folder functionality is currently empty.
-    return "Data folder is currently empty.", 200
+    if path_type == 'raw':
+        return "Only processed images have outline data", 404
+    filename = request.args.get('img')
+    if not filename:
+        return jsonify({"status": "error", "error": "missing image name (img)"}), 400
+    try:
+        tolerance = float(request.args.get('tolerance', TOLERANCE))
+    except ValueError:
+        return jsonify({"status": "error", "error": "tolerance must be a number"}), 400
+
+    digest = catalogue.digest("processed", filename)
+    if digest is None:
+        return f"Image \"{filename}\" not found", 404
+    path = os.path.join(PROCESSED_FOLDER, filename)
+    try:
+        if request.args.get('format') == 'json':
+            polylines, width, height = decode_polylines(
+                encodings.get(path, os.stat(path), "polylines", tolerance=tolerance))
+            return jsonify({"width": width, "height": height,
+                            "polylines": [p.tolist() for p in polylines]})
+        return send_bytes(lambda: encodings.get(path, os.stat(path), "polylines", tolerance=tolerance),
+                          FORMATS["polylines"], f"{digest}-polylines-{tolerance:g}",
+                          CACHE_CONTROL["processed"])
+    except (OSError, ValueError):
+        return f"Image \"{filename}\" not found", 404
+
+
+def outline_style():
+    """
+    Outline parameters of a request: threshold (0-255), border (pixels), thickness (line width in
+    pixels) and color (hex RRGGBB). Raises ValueError for invalid values.
+    """
+    threshold = request.args.get("threshold", THRESHOLD, type=int)
+    border_thickness = request.args.get("border", BORDER_THICKNESS, type=int)
+    line_thickness = request.args.get("thickness", 1, type=int)
+    color = parse_hex_color(request.args.get("color", "000000"))
+    if not 0 <= threshold <= 255 or border_thickness < 0 or not 1 <= line_thickness <= 31:
+        raise ValueError("threshold must be in 0-255, border >= 0 and thickness in 1-31")
+    return threshold, border_thickness, line_thickness, color
+
+
+def step_thresholds():
+    """
+    Thresholds of the stepwise outlines, given as a comma separated list (steps).
+    """
+    if "steps" not in request.args:
+        return STEP_THRESHOLDS
+    thresholds = [int(value) for value in request.args["steps"].split(",") if value.strip()]
+    if not thresholds or not all(0 <= threshold <= 255 for threshold in thresholds):
+        raise ValueError("steps must be a comma separated list of thresholds in 0-255")
+    return thresholds
 
 
+"""
+Regenerates the outline of a processed image from its stored edge map, without running the network
+again. Parameters: threshold (0-255), border (pixels), thickness (line width in pixels) and
+color (hex RRGGBB).
+"""
+@app.route("/images/processed/<filename>/outline")
+def restyle_outline(filename):
+    hed = probabilities.get(secure_filename(filename))
+    if hed is None:
+        return f"No edge map found for \"{filename}\"", 404
+    try:
+        threshold, border_thickness, line_thickness, color = outline_style()
+    except ValueError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+
+    with stage(g.stages, "postprocess"):
+        rgba_image = outline_from_hed(hed, threshold, border_thickness, line_thickness, color)
+    with stage(g.stages, "encode"):
+        ok, png = cv2.imencode('.png', rgba_image, OUTLINE_PNG_PARAMS)
+    if not ok:
+        return "Internal Server Error", 500
+    return Response(png.tobytes(), mimetype='image/png')
+
+
+"""
+Stepwise outlines of a processed image, from coarse to fine, generated from its stored edge map.
+Every step only contains the strokes that are new compared to the previous steps.
+ - /steps streams all steps as a multipart/mixed response, every step is sent as soon as it is
+   computed. The parts carry X-Step and X-Threshold headers.
+ - /steps/<step> returns a single step (0 is the coarsest), X-Steps is the number of steps.
+Parameters: steps (comma separated thresholds, default 192,128,64), border, thickness, color
+(see /outline) and format (see src.encoding, default png).
+"""
+@app.route("/images/processed/<filename>/steps")
+@app.route("/images/processed/<filename>/steps/<int:step>")
+def stepwise_outline(filename, step=None):
+    hed = probabilities.get(secure_filename(filename))
+    if hed is None:
+        return f"No edge map found for \"{filename}\"", 404
+    try:
+        _, border_thickness, line_thickness, color = outline_style()
+        thresholds = step_thresholds()
+        fmt = negotiate_format(request.args.get("format"), request.accept_mimetypes) or "png"
+    except ValueError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+    layers = stepwise_outlines(hed, thresholds, border_thickness, line_thickness, color)
+
+    if step is not None:
+        n_steps = len(set(thresholds))
+        if step >= n_steps:
+            return f"Step {step} not found, there are {n_steps} steps", 404
+        with stage(g.stages, "postprocess"):
+            for _ in range(step + 1):
+                threshold, rgba_image = next(layers)
+        with stage(g.stages, "encode"):
+            data = encode_step(rgba_image, fmt)
+        response = Response(data, mimetype=FORMATS[fmt])
+        response.headers["X-Steps"] = str(n_steps)
+        response.headers["X-Threshold"] = str(threshold)
+        response.vary.add("Accept")
+        return response
+
+    boundary = uuid.uuid4().hex
+
+    def stream():
+        for i, (threshold, rgba_image) in enumerate(layers):
+            yield (f"--{boundary}\r\nContent-Type: {FORMATS[fmt]}\r\nX-Step: {i}\r\n"
+                   f"X-Threshold: {threshold}\r\n\r\n").encode()
+            yield encode_step(rgba_image, fmt)
+            yield b"\r\n"
+        yield f"--{boundary}--\r\n".encode()
+
+    response = Response(stream(), mimetype=f"multipart/mixed; boundary={boundary}")
+    response.vary.add("Accept")
+    return response
+
+
+def encode_step(rgba_image, fmt):
+    if fmt == "png":
+        # fast settings, steps are generated per request
+        ok, png = cv2.imencode('.png', rgba_image, OUTLINE_PNG_PARAMS)
+        if not ok:
+            raise ValueError("could not encode the outline as .png")
+        return png.tobytes()
+    return encode_outline(rgba_image, fmt)
+
+
+def _numbers(name, count):
+    values = [float(value) for value in request.args[name].split(",")]
+    if len(values) != count:
+        raise ValueError(f"{name} must be {count} comma separated numbers")
+    return values
+
+
+"""
+The outline of a processed image warped onto the marker plane, as seen by the headset. The pose is
+given by `corners` (x,y of the top left, top right, bottom right and bottom left outline corner in
+the output image) or by `homography` (the 9 row-major entries of the homography from outline to
+output pixels). `size` (WxH) is the size of the output, by default the size of the outline, and
+`format` the format (see src.encoding, default png).
+Warps are cached per pose, a pose close to a cached one (see src.warping) gets the cached warp:
+X-Warp-Cache tells whether it was a hit, near (reused) or miss, X-Pose-Error is the largest
+distance in pixels between the requested corners and those of the returned warp.
+"""
+@app.route("/images/processed/<filename>/warp")
+def warped_outline(filename):
+    filename = secure_filename(filename)
+    digest = catalogue.digest("processed", filename)
+    if digest is None:
+        return f"Image \"{filename}\" not found", 404
+    rgba_image = None
+
+    def read_outline():
+        nonlocal rgba_image
+        if rgba_image is None:
+            with stage(g.stages, "read"):
+                rgba_image = cv2.imread(os.path.join(PROCESSED_FOLDER, filename), cv2.IMREAD_UNCHANGED)
+            if rgba_image is None:
+                raise OSError(f"could not read image {filename}")
+        return rgba_image
+
+    try:
+        fmt = negotiate_format(request.args.get("format"), request.accept_mimetypes) or "png"
+        width, height = outline_size = warps.source_size(digest, read_outline)
+        if "size" in request.args:
+            width, height = (int(value) for value in request.args["size"].lower().split("x"))
+            if not 0 < width <= 8192 or not 0 < height <= 8192:
+                raise ValueError("size must be at most 8192x8192")
+        if "homography" in request.args:
+            corners = pose_corners(*outline_size, homography=_numbers("homography", 9))
+        elif "corners" in request.args:
+            corners = pose_corners(*outline_size, corners=_numbers("corners", 8))
+        else:
+            raise ValueError("missing pose, expected corners or homography")
+    except OSError:
+        return f"Image \"{filename}\" not found", 404
+    except ValueError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+
+    def warp():
+        with stage(g.stages, "warp"):
+            return encode_warped(read_outline(), corners, (width, height), fmt)
+
+    try:
+        data, status, error = warps.get(digest, corners, (width, height), fmt, warp)
+    except ValueError as e:
+        # the pose was validated above, the warped outline could not be encoded
+        return jsonify({"status": "error", "error": str(e)}), 500
+    response = Response(data, mimetype=FORMATS[fmt])
+    response.headers["X-Warp-Cache"] = status
+    response.headers["X-Pose-Error"] = f"{error:.2f}"
+    response.vary.add("Accept")
+    return response
+
+
+"""
+The strokes of the outline of a processed image in drawing order, for the headset to guide the
+drawing stroke by stroke (see src.strokes): long strokes before details, region by region, each
+one starting near where the previous one ended. The plan is computed once and served in pages:
+page (from 0) and page_size (default 200) select the strokes, tolerance (pixels) is the
+simplification of the strokes. Every stroke has its position in the drawing order (index) and
+its points, in the direction it should be drawn. next is the URL of the next page.
+"""
+@app.route("/images/processed/<filename>/strokes")
+def drawing_strokes(filename):
+    filename = secure_filename(filename)
+    digest = catalogue.digest("processed", filename)
+    if digest is None:
+        return f"Image \"{filename}\" not found", 404
+    try:
+        page = request.args.get("page", 0, type=int)
+        page_size = request.args.get("page_size", PAGE_SIZE, type=int)
+        tolerance = float(request.args.get("tolerance", TOLERANCE))
+        if page < 0 or not 1 <= page_size <= 10000 or tolerance < 0:
+            raise ValueError("page must be >= 0, page_size in 1-10000 and tolerance >= 0")
+    except ValueError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+
+    def plan():
+        with stage(g.stages, "read"):
+            rgba_image = cv2.imread(os.path.join(PROCESSED_FOLDER, filename), cv2.IMREAD_UNCHANGED)
+        if rgba_image is None:
+            raise OSError(f"could not read image {filename}")
+        with stage(g.stages, "strokes"):
+            strokes = extract_strokes(outline_mask(rgba_image), tolerance)
+        with stage(g.stages, "order"):
+            return strokes.ordered(*plan_drawing_order(strokes))
+
+    try:
+        strokes = plans.get((digest, tolerance), plan)
+    except OSError:
+        return f"Image \"{filename}\" not found", 404
+    pages = max(1, -(-len(strokes) // page_size))
+    first = page * page_size
+    last = min(len(strokes), first + page_size)
+    return jsonify({"width": strokes.shape[1], "height": strokes.shape[0], "total": len(strokes),
+                    "page": page, "pages": pages, "pen_up_length": round(strokes.pen_up_length(), 1),
+                    "strokes": [{"index": i, "points": strokes.stroke(i).tolist()} for i in range(first, last)],
+                    "next": url_for("drawing_strokes", filename=filename, page=page + 1, page_size=page_size,
+                                    tolerance=tolerance) if page + 1 < pages else None})
+
 """
 Not sure if this is still used 
 """
 @app.route('/images/<path:path>')
 def serve_image(path):
+    path_type, _, filename = path.partition('/')
+    if path_type in catalogue.folders and '/' not in filename:
+        return send_image(path_type, filename)
     image_path = os.path.join('images', path)
     if not os.path.exists(image_path):
         return "Image not found", 404
@@ -136,6 +578,8 @@ def serve_image(path):
 
     Handles requests from ML2 for sending and receiving images.
     ML2 sends an image to the server, which processes it and returns the result
+    The image can be requested in a compact format with ?format= or the Accept header
+    (png, bilevel, webp, bits, rle, see src.encoding)
     
     ML2 -- GET
 """
@@ -143,17 +587,17 @@ def serve_image(path):
 def comm_usr():
     # Send the most recent processed image to ML2
     if request.method == "GET":
-        files = [f for f in os.listdir(PROCESSED_FOLDER) if allowed_file(f)]
-        if not files:
-            return "No processed images available", 404
-        # latest_file = max(files, key=lambda x: os.path.getctime(os.path.join(PROCESSED_FOLDER, x)))
         key = request.args.get("img")
         print("requested image: ", key)
-        for f in files:
-            if f == key:
-                print("found image at: ", f)
-                return send_from_directory(PROCESSED_FOLDER, f)
-        return f"No processed image found with name \"{key}_transparent.png\"", 500
+        if key:
+            # the name of a processed image, or of the upload it was processed from
+            for name in (key, processed_name(key)):
+                if catalogue.get("processed", name) is not None:
+                    print("found image at: ", name)
+                    return send_outline(name)
+        if catalogue.list("processed", limit=0)[0] == 0:
+            return "No processed images available", 404
+        return f"No processed image found with name \"{processed_name(key or '')}\"", 500
 
     return "Invalid method", 405
 
@@ -161,8 +605,15 @@ def comm_usr():
 """
     Actions initiated by the client (ML2). 
 
-    Laptop continuously polls this endpoint to fetch images for processing.
-    If an image exists in the ML2 folder, it processes and stores the result.
+    ML2 posts an image, which is decoded in memory and queued for processing right away. The
+    response contains the id of the job, which can be used with the /jobs endpoints to wait for the
+    result. With ?wait=<seconds>, the processed image is returned in the same response if it is
+    ready in time. The optional `budget_ms` or `quality` (low, medium, high) parameters trade the inference
+    resolution for latency, `method` selects the edge detector (hed, or sobel / canny of the fast tier).
+    With ?preview=1, the response is an outline of the fast tier (in about 10 ms), and the id of the
+    job that computes the full result is in the X-Job-Id header.
+    If too many images are in progress, the image is rejected with 503 and a Retry-After header.
+    GET enqueues images that were put into the ML2 folder by other means and lists the recent jobs.
     
     ML2 -- POST
     User -- GET
@@ -170,30 +621,32 @@ def comm_usr():
 @app.route("/comm_ml2", methods=["GET", "POST"])
 def comm_ml2():
     if request.method == 'GET':
-        # the server fetches the posted image by ML2, processes it, then saves it in the 'processed' folder
-        files = [f for f in os.listdir(ML2_FOLDER) if allowed_file(f)]
-        if not files:
-            return "No new images from ML2", 404
-        for filename in files:
+        queued = []
+        entries = {entry.filename: entry for entry in catalogue.list("ml2_exchange", sort="date")[1]}
+        # forget the finished jobs of files that were processed or removed from the ML2 folder since
+        for filename, job in list(_submitted_files.items()):
+            entry = entries.get(filename)
+            if job is not None and job.done and (entry is None or _is_processed(entry)):
+                _submitted_files.pop(filename, None)
+        for filename, entry in entries.items():
             filepath = os.path.join(ML2_FOLDER, filename)
-            try:
-                # Process the image
-                processed_path = os.path.join(PROCESSED_FOLDER, filename)
-                process_image_from_file(filepath, net, save_path=processed_path)
-                print(f"Processed image saved to {processed_path}")
-
-                # Delete raw image after processing
-                # os.remove(filepath)
-
-                # Return success message
-                return jsonify({
-                    "status": "success",
-                    "filename": filename,
-                    "processed_path": processed_path
-                })
-            except Exception as e:
-                return jsonify({"status": "error", "Error while fetching images posted by ML2": str(e)}), 500
-        return "No images processed", 200
+            if filename not in _submitted_files and not _is_processed(entry):
+                try:
+                    job = jobs.submit_file(filepath)
+                except ValueError as e:
+                    # e.g. still being copied, tried again by a later request
+                    print(f"Skipping {filepath}: {e}")
+                    continue
+                except Overloaded:
+                    # the remaining files are queued by a later request
+                    break
+                _submitted_files[filename] = job
+                queued.append(job.to_dict())
+        return jsonify({
+            "status": "success",
+            "queued": queued,
+            "jobs": [job.to_dict() for job in jobs.recent()]
+        })
     
     # the ML2 device posts a new images to the server for processing
     elif request.method == 'POST':
@@ -202,18 +655,390 @@ def comm_ml2():
         file = request.files['file']
         if file and allowed_file(file.filename):
             try:
-                filename = secure_filename(file.filename)
-                filepath = os.path.join(ML2_FOLDER, filename)
-                file.save(filepath)
-                print(f"Image received from ML2 and saved to {filepath}")
-            except Exception as e:
-                return jsonify({"status": "error", "Error while saving the image posted by ML2": str(e)}), 500
-                
+                options = processing_options()
+                fmt = negotiate_format(request.args.get("format"), request.accept_mimetypes) or "png"
+            except ValueError as e:
+                return jsonify({"status": "error", "error": str(e)}), 400
+            filename = secure_filename(file.filename)
+            data = file.read()
+            try:
+                image = decode_image(data)
+            except ValueError as e:
+                return jsonify({"status": "error", "Error while decoding the image posted by ML2": str(e)}), 400
+            print(f"Image received from ML2: {filename}")
+            if writer is not None:
+                _submitted_files[filename] = None
+                writer.write(os.path.join(ML2_FOLDER, filename), data)
+
+            try:
+                job = jobs.submit(filename, image, **options)
+            except Overloaded as e:
+                # the saved file is queued by a later GET
+                _submitted_files.pop(filename, None)
+                return (jsonify({"status": "error", "error": str(e)}), 503,
+                        {"Retry-After": str(e.retry_after)})
+            if writer is not None:
+                _submitted_files[filename] = job
+            if request.values.get("preview") == "1":
+                if job.status == "done":  # e.g. from the cache, no preview needed
+                    return _job_result_response(job)
+                # live preview: a fast outline right away, the job result replaces it when it is ready
+                outline = preview_outline(filename, image)
+                with stage(g.stages, "encode"):
+                    data = encode_step(outline, fmt)
+                response = Response(data, mimetype=FORMATS[fmt])
+                response.headers["X-Job-Id"] = job.id
+                response.headers["X-Result-Url"] = url_for('job_result', job_id=job.id)
+                response.headers["X-Preview-Method"] = PREVIEW_METHOD
+                return response
+            wait = _wait_seconds()
+            if wait > 0:
+                job = jobs.wait(job.id, wait)
+                if job.status == "done":
+                    return _job_result_response(job)
+            return jsonify({
+                "status": "queued",
+                "job_id": job.id,
+                "filename": filename,
+                "status_url": url_for('job_status', job_id=job.id),
+                "result_url": url_for('job_result', job_id=job.id)
+            }), 202
+        return "File type not allowed", 400
+
+
+def _is_processed(entry):
+    # the processed image of a file in the ML2 folder is at least as new as the file
+    processed = catalogue.get("processed", processed_name(entry.filename))
+    return processed is not None and processed.mtime >= entry.mtime
+
+
+def _wait_seconds():
+    # invalid and negative values do not wait, like no wait parameter
+    wait = request.args.get("wait", 0.0, type=float)
+    return min(wait, MAX_WAIT_SECONDS) if wait > 0 else 0.0
+
+
+"""
+    Status of a processing job. With ?wait=<seconds> the request is held open until the job is 
+    finished (long polling).
+"""
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = jobs.wait(job_id, _wait_seconds())
+    if job is None:
+        return jsonify({"status": "error", "error": f"job \"{job_id}\" not found"}), 404
+    return jsonify(job.to_dict())
+
+
+"""
+    The processed image of a job. With ?wait=<seconds> the request is held open until the image
+    is ready. Returns 202 if the job is still pending.
+"""
+@app.route("/jobs/<job_id>/result")
+def job_result(job_id):
+    job = jobs.wait(job_id, _wait_seconds())
+    if job is None:
+        return jsonify({"status": "error", "error": f"job \"{job_id}\" not found"}), 404
+    if job.status == "error":
+        return jsonify(job.to_dict()), 500
+    if not job.done:
+        return jsonify(job.to_dict()), 202
+    return _job_result_response(job)
+
+
+def _job_result_response(job):
+    g.stages.update(job.stages)
+    # the result of a job never changes, the job id is its ETag
+    response = send_bytes(lambda: job.result, 'image/png', job.id, CACHE_CONTROL["job"])
+    if job.inference_size is not None:
+        response.headers["X-Inference-Size"] = "{}x{}".format(*job.inference_size)
+    return response
+
+
+"""
+    Server-sent events for a processing job, one event per status change.
+"""
+@app.route("/jobs/<job_id>/events")
+def job_events(job_id):
+    if jobs.get(job_id) is None:
+        return jsonify({"status": "error", "error": f"job \"{job_id}\" not found"}), 404
+
+    def stream():
+        for job in jobs.events(job_id, timeout=MAX_WAIT_SECONDS):
+            yield f"event: {job.status}\ndata: {json.dumps(job.to_dict())}\n\n"
+
+    return Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+"""
+    Opens a stream of camera frames (live guidance). Takes the same `method`, `budget_ms` and
+    `quality` parameters as POST /comm_ml2, which apply to every frame of the stream.
+    Frames are posted to /stream/<id>/frames, the outline is fetched from /stream/<id>/outline or
+    streamed from /stream/<id>/outlines. Frames that barely differ from the previous one reuse its
+    outline, local changes only reprocess the changed region (see src.streaming).
+"""
+@app.route("/stream", methods=["POST"])
+def open_stream():
+    try:
+        options = processing_options()
+    except ValueError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+    session = streams.create(options)
+    return jsonify({
+        **session.to_dict(),
+        "frames_url": url_for('stream_frames', session_id=session.id),
+        "outline_url": url_for('stream_outline', session_id=session.id),
+        "outlines_url": url_for('stream_outlines', session_id=session.id),
+    }), 201
+
+
+def _stream_session(session_id):
+    session = streams.get(session_id)
+    if session is None:
+        return None, (jsonify({"status": "error", "error": f"stream \"{session_id}\" not found"}), 404)
+    return session, None
+
+
+"""
+    Statistics of a stream (GET), or closes it (DELETE)
+"""
+@app.route("/stream/<session_id>", methods=["GET", "DELETE"])
+def stream_status(session_id):
+    if request.method == 'DELETE':
+        session = streams.close(session_id)
+        if session is None:
+            return jsonify({"status": "error", "error": f"stream \"{session_id}\" not found"}), 404
+        return jsonify(session.to_dict())
+    session, error = _stream_session(session_id)
+    if error:
+        return error
+    return jsonify(session.to_dict())
+
+
+"""
+    Posts a camera frame to a stream, as the `file` of a form or as the raw request body.
+    Returns 202 if the frame is processed ("queued", or "waiting" behind the frame in flight) and
+    200 if it is a duplicate of the frame of the current outline or was dropped.
+"""
+@app.route("/stream/<session_id>/frames", methods=["POST"])
+def stream_frames(session_id):
+    session, error = _stream_session(session_id)
+    if error:
+        return error
+    data = request.files['file'].read() if 'file' in request.files else request.get_data()
+    try:
+        with stage(g.stages, "decode"):
+            image = decode_image(data)
+    except ValueError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+    with stage(g.stages, "compare"):
+        result = session.submit(image)
+    result["sequence"] = session.sequence
+    return jsonify(result), 202 if result["status"] in ("queued", "waiting") else 200
+
+
+"""
+    The current outline of a stream, in the format picked by `format` or the Accept header (png by
+    default). With ?after=<sequence>&wait=<seconds> the request is held open until there is a newer
+    outline. The sequence number of the outline is in the X-Sequence header, 202 if there is none
+    yet.
+"""
+@app.route("/stream/<session_id>/outline")
+def stream_outline(session_id):
+    session, error = _stream_session(session_id)
+    if error:
+        return error
+    try:
+        fmt = negotiate_format(request.args.get("format"), request.accept_mimetypes) or "png"
+        after = int(request.args.get("after", 0))
+        timeout = _wait_seconds()
+    except ValueError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+    sequence, outline = session.wait(after, timeout)
+    if outline is None:
+        return jsonify(session.to_dict()), 202
+    response = send_bytes(lambda: encode_step(outline, fmt), FORMATS[fmt], f"{session.id}-{sequence}-{fmt}",
+                          "no-cache")
+    response.headers["X-Sequence"] = str(sequence)
+    response.vary.add("Accept")
+    return response
+
+
+"""
+    Streams every new outline of a stream as a part of a multipart/mixed response (with X-Sequence
+    headers), until the stream is closed or no outline arrived for MAX_WAIT_SECONDS.
+"""
+@app.route("/stream/<session_id>/outlines")
+def stream_outlines(session_id):
+    session, error = _stream_session(session_id)
+    if error:
+        return error
+    try:
+        fmt = negotiate_format(request.args.get("format"), request.accept_mimetypes) or "png"
+    except ValueError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+    boundary = uuid.uuid4().hex
+
+    def stream():
+        after = 0
+        while True:
+            sequence, outline = session.wait(after, MAX_WAIT_SECONDS)
+            if sequence <= after:
+                break
+            after = sequence
+            yield (f"--{boundary}\r\nContent-Type: {FORMATS[fmt]}\r\nX-Sequence: {sequence}\r\n\r\n").encode()
+            yield encode_step(outline, fmt)
+            yield b"\r\n"
+        yield f"--{boundary}--\r\n".encode()
+
+    response = Response(stream(), mimetype=f"multipart/mixed; boundary={boundary}")
+    response.vary.add("Accept")
+    return response
+
+
+"""
+    Detects the ArUco markers in a camera frame and estimates their poses, the frame is the `file`
+    of a form or the raw request body (grayscale is enough, e.g. a downscaled grayscale JPEG).
+    Parameters:
+     - session: id of the headset, markers found in its previous frame are searched for around
+       their last position first (see src.markers)
+     - dictionary, marker_size (m): the markers, by default as in MarkerTracker.cs
+     - fx, fy, cx, cy: camera intrinsics (pixels of the camera image), by default derived from a
+       70 degree field of view
+     - scale: size of the camera image relative to the frame, if the frame was downscaled
+    Returns the markers with their corners (camera pixels) and poses in the OpenCV camera frame
+    (rvec / tvec in meters and the rotation as quaternion x, y, z, w).
+"""
+@app.route("/markers", methods=["POST"])
+def detect_markers():
+    data = request.files['file'].read() if 'file' in request.files else request.get_data()
+    try:
+        with stage(g.stages, "decode"):
+            gray = decode_image(data, cv2.IMREAD_GRAYSCALE)
+        session = markers.get(request.values.get("session", request.remote_addr),
+                              request.values.get("dictionary", ARUCO_DICTIONARY))
+    except ValueError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+    scale = request.values.get("scale", 1.0, type=float)
+    camera = camera_matrix(gray.shape[1] * scale, gray.shape[0] * scale,
+                           *(request.values.get(name, type=float) for name in ("fx", "fy", "cx", "cy")))
+    result = session.process(gray, request.values.get("marker_size", MARKER_SIZE, type=float), camera,
+                             scale=scale, stages=g.stages)
+    metrics.inc("picasso_marker_frames_total", search=result["search"])
+    return jsonify(result)
+
+
+"""
+    Hit / miss counters of the result cache (of the server process, workers keep their own 
+    in-memory level)
+"""
+@app.route("/cache/stats")
+def cache_stats():
+    return jsonify(cache.stats())
+
+
+metrics.describe("picasso_request_seconds", "histogram", "Latency of the HTTP requests until the response headers")
+metrics.describe("picasso_request_bytes", "histogram", "Size of the request bodies", SIZE_BUCKETS)
+metrics.describe("picasso_response_bytes", "histogram", "Size of the response bodies", SIZE_BUCKETS)
+metrics.describe("picasso_job_seconds", "histogram", "Time from the submission of a processing job until it is done")
+metrics.describe("picasso_stage_seconds", "histogram", "Time spent in each stage of the processing jobs")
+metrics.describe("picasso_job_errors_total", "counter", "Processing jobs that failed")
+metrics.describe("picasso_jobs", "gauge", "Jobs kept by the job queue, per status")
+metrics.describe("picasso_cache_lookups_total", "counter", "Lookups in the result cache of the server process")
+metrics.describe("picasso_cache_bytes", "gauge", "Size of the result cache")
+metrics.describe("picasso_encoding_cache_lookups_total", "counter", "Lookups of encoded outlines")
+metrics.describe("picasso_written_files_total", "counter", "Files persisted by the background writer")
+metrics.describe("picasso_workers_ready", "gauge", "Workers that have loaded and warmed up the network")
+metrics.describe("picasso_streams", "gauge", "Open camera frame streams")
+metrics.describe("picasso_stream_frames_total", "counter", "Frames of the streams, by what happened with them")
+metrics.describe("picasso_warp_cache_lookups_total", "counter", "Lookups of warped outlines, by result (hit, near or miss)")
+metrics.describe("picasso_marker_frames_total", "counter", "Frames searched for markers, by search (roi or full)")
+metrics.describe("picasso_marker_sessions", "gauge", "Headsets with marker tracking state")
+metrics.describe("picasso_jobs_pending", "gauge", "Jobs waiting for or running on the workers")
+metrics.describe("picasso_jobs_rejected_total", "counter", "Jobs rejected with 503 because too many were pending")
+
+
+def collect_metrics():
+    for status, count in jobs.counts().items():
+        yield "picasso_jobs", {"status": status}, count
+    stats = cache.stats()
+    yield "picasso_cache_lookups_total", {"result": "hit_memory"}, stats["hits_memory"]
+    yield "picasso_cache_lookups_total", {"result": "hit_disk"}, stats["hits_disk"]
+    yield "picasso_cache_lookups_total", {"result": "miss"}, stats["misses"]
+    yield "picasso_cache_bytes", {"level": "memory"}, stats["memory_bytes"]
+    yield "picasso_cache_bytes", {"level": "disk"}, stats["disk_bytes"]
+    yield "picasso_encoding_cache_lookups_total", {"result": "hit"}, encodings.hits
+    yield "picasso_encoding_cache_lookups_total", {"result": "miss"}, encodings.misses
+    yield "picasso_workers_ready", {}, jobs.workers_ready
+    yield "picasso_jobs_pending", {}, jobs.admission.pending
+    yield "picasso_streams", {}, len(streams)
+    yield "picasso_marker_sessions", {}, len(markers)
+    for result, count in warps.counts.items():
+        yield "picasso_warp_cache_lookups_total", {"result": result}, count
+    for result in FRAME_RESULTS:
+        yield "picasso_stream_frames_total", {"result": result}, streams.totals[result]
+    yield "picasso_jobs_rejected_total", {}, jobs.admission.rejected
+    if writer is not None:
+        yield "picasso_written_files_total", {"result": "ok"}, writer.written
+        yield "picasso_written_files_total", {"result": "failed"}, writer.failed
+
+
+metrics.register(collect_metrics)
+
+
+@app.before_request
+def start_request_timer():
+    g.start = time.perf_counter()
+    g.stages = {}  # stage timings (ms) of the request, see src.metrics
+
+
+@app.after_request
+def record_request_metrics(response):
+    elapsed = time.perf_counter() - g.start
+    labels = {"route": request.url_rule.rule if request.url_rule else "unmatched",
+              "method": request.method}
+    metrics.observe("picasso_request_seconds", elapsed, status=str(response.status_code), **labels)
+    if request.content_length:
+        metrics.observe("picasso_request_bytes", request.content_length, **labels)
+    if response.content_length is not None:
+        metrics.observe("picasso_response_bytes", response.content_length, **labels)
+    if request.headers.get(TRACE_HEADER) == "1":
+        g.stages["total"] = 1000 * elapsed
+        response.headers["Server-Timing"] = server_timing(g.stages)
+    return response
+
+
+"""
+    Metrics of the server in the Prometheus text format: request latency and payload sizes per
+    route, job and stage durations, queue depth and cache hits
+"""
+@app.route("/metrics")
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+"""
+    Liveness probe: the server answers requests
+"""
+@app.route("/healthz")
+def healthz():
+    return jsonify({"status": "ok"})
+
+
+"""
+    Readiness probe: 200 once every worker has loaded and warmed up the network, 503 until then.
+    Starts the workers if they are not running yet (e.g. with PICASSO_PRELOAD_MODEL=0).
+"""
+@app.route("/readyz")
+def readyz():
+    if jobs.started is None:
+        jobs.start()
+    body = {"workers": jobs.num_workers, "workers_ready": jobs.workers_ready}
+    if not jobs.ready():
+        return jsonify({"status": "loading", **body}), 503, {"Retry-After": "1"}
+    return jsonify({"status": "ready", **body})
 
 
 if __name__ == "__main__":
-    # Initialize image processor
-    net = init_net()
-    
-    # run the server
+    # run the server, the image processor is initialized by each worker of the job queue
     app.run(host='0.0.0.0', port=80)
\ No newline at end of file
@@ -0,0 +1,316 @@
+"""
+Offline outline generation for whole image folders, e.g. to pre-generate outline libraries.
+
+The images of the input folder (and its subfolders) are processed by a pool of worker processes,
+each with its own network. Every finished image is appended to a manifest in the output folder
+(manifest.jsonl: input file, its size, mtime and content hash, the options and the outputs), so a
+re-run skips the images whose outputs are up to date and an interrupted run resumes where it
+stopped. Run from the repository root:
+
+    python -m src.batch src/images/raw src/images/processed
+    python -m src.batch photos/ library/ --workers 8 --format rle --quality medium
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import cv2
+
+from src.cache import ResultCache
+from src.catalogue import file_digest
+from src.encoding import FORMATS, encode_outline
+from src.image_processing import (BORDER_THICKNESS, EDGE_METHODS, MODEL_ID, THRESHOLD, edge_detection,
+                                  init_net, warm_up)
+from src.latency import QUALITY_TIERS
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
+MANIFEST_NAME = "manifest.jsonl"
+# file extension of the outlines in each transport format
+FORMAT_EXTENSIONS = {
+    "png": ".png",
+    "bilevel": ".png",
+    "webp": ".webp",
+    "bits": ".bits",
+    "rle": ".rle",
+    "polylines": ".pav",
+}
+
+# every worker process keeps its own instance of the network
+_net = None
+_cache = None
+
+
+def _init_worker(method, cache_folder):
+    global _net, _cache
+    _net = init_net() if method == "hed" else None
+    if _net is not None:
+        warm_up(_net)
+    if cache_folder is not None:
+        _cache = ResultCache(cache_folder)
+
+
+def _write_atomic(path, data):
+    # readers (and a re-run after an interruption) never see partial files
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _process_file(input_path, output_path, options):
+    # runs inside a worker process, reads the image itself so only paths are sent to the pool
+    start = time.perf_counter()
+    image = cv2.imread(input_path)
+    if image is None:
+        raise ValueError(f"could not read image at {input_path}")
+    info = {}
+    edge_options = {key: value for key, value in options.items() if key != "format"}
+    rgba_image = edge_detection(input_path, image, _net, cache=_cache, info=info, **edge_options)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    _write_atomic(output_path, encode_outline(rgba_image, options["format"]))
+    return {"inference_size": list(info["inference_size"]), "seconds": time.perf_counter() - start}
+
+
+def find_images(folder):
+    """
+    Paths of the images in a folder and its subfolders, relative to it and sorted.
+    """
+    images = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for file_name in files:
+            if file_name.lower().endswith(IMAGE_EXTENSIONS):
+                images.append(os.path.relpath(os.path.join(root, file_name), folder))
+    return sorted(images)
+
+
+class Manifest(object):
+    """
+    Append-only record of the processed images, one JSON object per line. Later lines of the same
+    input replace earlier ones, a truncated last line (from an interrupted run) is ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.entries[entry["input"]] = entry
+        except FileNotFoundError:
+            pass
+        self._file = None
+
+    def add(self, entry):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        self._file.write(json.dumps(entry, sort_keys=True) + "\n")
+        self._file.flush()
+        self.entries[entry["input"]] = entry
+
+    def compact(self):
+        """
+        Rewrites the manifest with only the latest entry of every input.
+        """
+        self.close()
+        lines = "".join(json.dumps(self.entries[name], sort_keys=True) + "\n" for name in sorted(self.entries))
+        _write_atomic(self.path, lines.encode())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def options_signature(options):
+    """
+    The options that change the outputs, as stored in the manifest.
+    """
+    signature = dict(options)
+    if options["method"] == "hed":
+        signature["model"] = MODEL_ID
+    return signature
+
+
+def is_up_to_date(entry, stat, input_path, output_folder, signature):
+    """
+    Whether the outputs of a manifest entry are current for the input file. The content hash is
+    only computed if the size or modification time of the file changed.
+    Returns (up to date, digest or None if it was not computed).
+    """
+    if entry is None or entry.get("options") != signature:
+        return False, None
+    if not all(os.path.exists(os.path.join(output_folder, output)) for output in entry["outputs"]):
+        return False, None
+    if (entry["size"], entry["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+        return True, entry["digest"]
+    digest = file_digest(input_path)
+    return digest == entry["digest"], digest
+
+
+class Progress(object):
+    """
+    Prints the progress and throughput at most every `interval` seconds.
+    """
+
+    def __init__(self, total, interval=2.0, stream=sys.stdout):
+        self.total = total
+        self.interval = interval
+        self.stream = stream
+        self.done = 0
+        self.failed = 0
+        self.start = time.perf_counter()
+        self._last = 0.0
+
+    def update(self, name, failed=False):
+        self.done += 1
+        self.failed += int(failed)
+        now = time.perf_counter()
+        if now - self._last < self.interval and self.done < self.total:
+            return
+        self._last = now
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate > 0 else 0.0
+        print(f"[{self.done:>{len(str(self.total))}}/{self.total}] {100 * self.done / max(self.total, 1):5.1f}%  "
+              f"{rate:6.2f} images/s  eta {eta:6.0f}s  {name}", file=self.stream, flush=True)
+
+
+def run_batch(input_folder, output_folder, options, workers=None, cache_folder=None, force=False,
+              progress_interval=2.0):
+    """
+    Processes the images of `input_folder` that are not up to date in `output_folder`.
+
+    Args:
+        options (dict): edge_detection options plus the output "format" (one of FORMATS).
+        workers (int): Number of worker processes, by default one per core.
+        force (bool): Process all images, also the ones that are up to date.
+
+    Returns:
+        dict: Numbers of processed, skipped and failed images and the elapsed time.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    manifest = Manifest(os.path.join(output_folder, MANIFEST_NAME))
+    signature = options_signature(options)
+    extension = FORMAT_EXTENSIONS[options["format"]]
+
+    pending, skipped = [], 0
+    for name in find_images(input_folder):
+        input_path = os.path.join(input_folder, name)
+        stat = os.stat(input_path)
+        entry = manifest.entries.get(name)
+        up_to_date, digest = (False, None) if force else is_up_to_date(entry, stat, input_path,
+                                                                        output_folder, signature)
+        if up_to_date:
+            skipped += 1
+            if (entry["size"], entry["mtime_ns"]) != (stat.st_size, stat.st_mtime_ns):
+                manifest.add({**entry, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns})  # touched only
+            continue
+        pending.append((name, stat, digest))
+    print(f"{len(pending)} images to process, {skipped} up to date", flush=True)
+
+    workers = workers or os.cpu_count() or 1
+    progress = Progress(len(pending), progress_interval)
+    start = time.perf_counter()
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_init_worker, initargs=(options["method"], cache_folder))
+    running = {}
+    queued = iter(pending)
+    try:
+        while True:
+            # a bounded number of submitted images, so an interruption leaves little work behind
+            while len(running) < 2 * workers:
+                item = next(queued, None)
+                if item is None:
+                    break
+                name, stat, digest = item
+                output = os.path.splitext(name)[0] + extension
+                future = executor.submit(_process_file, os.path.join(input_folder, name),
+                                         os.path.join(output_folder, output), options)
+                running[future] = (name, stat, digest, output)
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, stat, digest, output = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Error while processing {name}: {e}", file=sys.stderr, flush=True)
+                    progress.update(name, failed=True)
+                    continue
+                manifest.add({
+                    "input": name,
+                    "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns,
+                    "digest": digest or file_digest(os.path.join(input_folder, name)),
+                    "options": signature,
+                    "outputs": [output],
+                    **result,
+                })
+                progress.update(name)
+    except KeyboardInterrupt:
+        print("Interrupted, the finished images are kept in the manifest, run again to resume",
+              file=sys.stderr, flush=True)
+        # the images in progress are dropped, they are processed again on the next run
+        executor.shutdown(wait=False, cancel_futures=True)
+        for process in multiprocessing.active_children():
+            process.terminate()
+        raise
+    else:
+        executor.shutdown()
+    finally:
+        manifest.compact()
+
+    elapsed = time.perf_counter() - start
+    processed = progress.done - progress.failed
+    print(f"{processed} processed, {skipped} up to date, {progress.failed} failed in {elapsed:.1f}s "
+          f"({processed / elapsed if elapsed > 0 else 0.0:.2f} images/s)", flush=True)
+    return {"processed": processed, "skipped": skipped, "failed": progress.failed, "seconds": elapsed}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", nargs="?", default="src/images/raw", help="folder of the images")
+    parser.add_argument("output", nargs="?", default="src/images/processed", help="folder of the outlines")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--format", choices=list(FORMATS), default="png", help="output format of the outlines")
+    parser.add_argument("--method", choices=EDGE_METHODS, default="hed", help="edge detector")
+    parser.add_argument("--threshold", type=int, default=THRESHOLD)
+    parser.add_argument("--border-thickness", type=int, default=BORDER_THICKNESS)
+    parser.add_argument("--tile-size", type=int, default=1024,
+                        help="tile size of the network on large images, 0 for a single pass")
+    parser.add_argument("--quality", choices=list(QUALITY_TIERS), help="trade resolution for speed")
+    parser.add_argument("--cache", help="folder of a result cache shared by the workers, e.g. src/cache")
+    parser.add_argument("--force", action="store_true", help="also process the images that are up to date")
+    parser.add_argument("--progress-interval", type=float, default=2.0, help="seconds between progress lines")
+    args = parser.parse_args(argv)
+
+    options = {
+        "format": args.format,
+        "method": args.method,
+        "threshold": args.threshold,
+        "border_thickness": args.border_thickness,
+        "tile_size": args.tile_size or None,
+    }
+    if args.quality is not None:
+        options["quality"] = args.quality
+    try:
+        result = run_batch(args.input, args.output, options, args.workers, args.cache, args.force,
+                           args.progress_interval)
+    except KeyboardInterrupt:
+        sys.exit(130)
+    if result["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Throughput of batched HED inference (hed_probabilities) for different batch sizes.
+
+Every batch size runs the same images through the network, --batch-sizes at a time, and reports
+images per second and the latency of a batch. With --mixed, the images get slightly different
+sizes and are padded to size buckets of --bucket pixels, which adds the padding to the cost.
+Needs the model in src/model. Run from the repository root:
+
+    python -m src.benchmarks.bench_batch
+    python -m src.benchmarks.bench_batch --width 480 --height 360 --target opencl
+    python -m src.benchmarks.bench_batch --mixed --bucket 32
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from src.benchmarks.bench_pipeline import synthetic_image
+from src.image_processing import hed_probabilities, init_net, warm_up
+
+
+def parse_sizes(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def make_images(count, width, height, mixed):
+    rng = np.random.default_rng(0)
+    base = synthetic_image(width * height / 1e6, 0)
+    images = []
+    for _ in range(count):
+        w, h = width, height
+        if mixed:
+            w, h = width - int(rng.integers(0, 32)), height - int(rng.integers(0, 32))
+        images.append(cv2.resize(base, (w, h), interpolation=cv2.INTER_AREA))
+    return images
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-sizes", type=parse_sizes, default=[1, 2, 4, 8, 16])
+    parser.add_argument("--width", type=int, default=320)
+    parser.add_argument("--height", type=int, default=240)
+    parser.add_argument("--images", type=int, default=32, help="images per batch size")
+    parser.add_argument("--mixed", action="store_true", help="images of slightly different sizes")
+    parser.add_argument("--bucket", type=int, default=1, help="size bucket of the padding")
+    parser.add_argument("--backend", help="DNN backend, see DNN_BACKENDS in image_processing")
+    parser.add_argument("--target", help="DNN target, see DNN_TARGETS in image_processing")
+    args = parser.parse_args()
+
+    net = init_net(args.backend, args.target)
+    warm_up(net, max(args.width, args.height))
+    images = make_images(args.images, args.width, args.height, args.mixed)
+    print(f"{args.images} images of {args.width}x{args.height}{' (mixed sizes)' if args.mixed else ''}, "
+          f"bucket {args.bucket}")
+    print(f"{'batch size':<12}{'images/s':>10}{'speedup':>10}{'ms/batch':>10}{'batches':>9}")
+    baseline = None
+    for batch_size in args.batch_sizes:
+        hed_probabilities(images[:batch_size], net, batch_size, args.bucket)  # shapes of this batch size
+        passes = []
+        start = time.perf_counter()
+        for i in range(0, len(images), batch_size):
+            stages = [{} for _ in images[i:i + batch_size]]
+            hed_probabilities(images[i:i + batch_size], net, batch_size, args.bucket, stages)
+            passes.append(sum(stages[0].values()) * len(stages))
+        throughput = len(images) / (time.perf_counter() - start)
+        baseline = baseline or throughput
+        print(f"{batch_size:<12}{throughput:>10.2f}{throughput / baseline:>10.2f}{np.median(passes):>10.0f}"
+              f"{len(passes):>9}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
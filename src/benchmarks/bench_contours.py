@@ -0,0 +1,116 @@
+"""
+Benchmark of the contour analysis on images with 10^4 - 10^5 contours: the per-contour loops of
+the contour functions in image_processing against the bulk computations of src/contours.py.
+
+For every image, the moments, arc lengths, bounding boxes and convex hulls are computed with one
+cv2 call per contour and with ContourSet, and the results are checked to agree. Drawing contour by
+contour (as contour_convex_hull did, one drawContours call per contour and hull) costs a time per
+call that grows with the number of contours, so it is timed on --legacy-draws contours and
+extrapolated to all of them. Run from the repository root:
+
+    python -m src.benchmarks.bench_contours
+    python -m src.benchmarks.bench_contours --sizes 1,4 --legacy-draws 50
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from src.contours import ContourSet, find_contours, threshold_image
+
+SIZES = (1, 3, 10)  # megapixels, about 7k, 20k and 70k contours with the default noise
+
+
+def noise_image(megapixels, sigma=1.5, seed=0):
+    """
+    Smoothed noise with 4:3 aspect ratio, the adaptive threshold turns it into many small blobs.
+    """
+    width = int(round(np.sqrt(megapixels * 1e6 * 4 / 3)))
+    height = int(round(width * 3 / 4))
+    noise = np.random.default_rng(seed).integers(0, 256, (height, width), dtype=np.uint8)
+    return cv2.GaussianBlur(noise, (0, 0), sigma)
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, 1000 * (time.perf_counter() - start)
+
+
+def legacy_measures(contours):
+    return ([cv2.moments(c) for c in contours], [cv2.arcLength(c, True) for c in contours],
+            [cv2.boundingRect(c) for c in contours], [cv2.contourArea(c) for c in contours])
+
+
+def legacy_draw_ms(contours, hierarchy, hulls, shape, draws):
+    # ms per contour of drawing contour i and hull i, as contour_convex_hull did
+    drawing = np.zeros(shape + (3,), np.uint8)
+    draws = min(draws, len(contours))
+    start = time.perf_counter()
+    for i in range(draws):
+        cv2.drawContours(drawing, contours, i, (0, 255, 0), 1, 8, hierarchy)
+        cv2.drawContours(drawing, hulls, i, (255, 0, 0), 1, 8)
+    return 1000 * (time.perf_counter() - start) / max(draws, 1)
+
+
+def check(contour_set, moments, lengths, boxes, areas):
+    records = contour_set.records
+    assert np.allclose(records["area"], areas)
+    assert np.allclose(records["length"], lengths)
+    assert (np.stack([records[k] for k in ("x", "y", "w", "h")], axis=1) == np.array(boxes)).all()
+    m00 = np.array([m["m00"] for m in moments])
+    solid = m00 > 1e-6
+    cx = np.array([m["m10"] for m in moments])[solid] / m00[solid]
+    assert np.allclose(records["cx"][solid], cx)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=lambda value: [float(v) for v in value.split(",") if v],
+                        default=list(SIZES), help="megapixels of the noise images")
+    parser.add_argument("--sigma", type=float, default=1.5, help="blur of the noise, smaller gives more contours")
+    parser.add_argument("--legacy-draws", type=int, default=100,
+                        help="contours drawn one by one to estimate the legacy drawing time")
+    parser.add_argument("--min-area", type=float, default=10, help="area filter of the bulk version")
+    args = parser.parse_args()
+
+    print(f"{'image':<12}{'contours':>10}{'points':>10}  {'step':<28}{'per contour':>14}{'bulk':>10}{'speedup':>9}")
+    for megapixels in args.sizes:
+        image = noise_image(megapixels, args.sigma)
+        binary = threshold_image(image)
+        (contours, hierarchy), find_ms = timed(lambda: cv2.findContours(binary, cv2.RETR_TREE,
+                                                                         cv2.CHAIN_APPROX_SIMPLE))
+        name = f"{megapixels:g} MP"
+        print(f"{name:<12}{len(contours):>10}{sum(len(c) for c in contours):>10}  {'findContours':<28}"
+              f"{find_ms:>12.1f}ms")
+
+        measures, legacy_ms = timed(lambda: legacy_measures(contours))
+        contour_set, bulk_ms = timed(lambda: ContourSet.from_contours(contours, hierarchy, binary.shape))
+        check(contour_set, *measures)
+        rows = [("moments/length/box/area", legacy_ms, bulk_ms)]
+
+        legacy_hulls, legacy_ms = timed(lambda: [cv2.convexHull(c) for c in contours])
+        _, bulk_ms = timed(contour_set.hull_areas)
+        rows.append(("convex hulls", legacy_ms, bulk_ms))
+
+        draw_ms = legacy_draw_ms(contours, hierarchy, legacy_hulls, binary.shape, args.legacy_draws)
+        drawing = np.zeros(binary.shape + (3,), np.uint8)
+        _, bulk_ms = timed(lambda: (contour_set.render(drawing, (0, 255, 0)),
+                                    contour_set.render(drawing, (255, 0, 0), hulls=True)))
+        rows.append(("draw contours and hulls (est.)", draw_ms * len(contours), bulk_ms))
+
+        kept, bulk_ms = timed(lambda: contour_set.filter(min_area=args.min_area))
+        rows.append((f"filter area >= {args.min_area:g}", None, bulk_ms))
+        _, total_ms = timed(lambda: find_contours(image).filter(min_area=args.min_area).render())
+        rows.append(("find, filter and render", None, total_ms))
+
+        for step, legacy_ms, bulk_ms in rows:
+            legacy = f"{legacy_ms:>12.1f}ms" if legacy_ms is not None else f"{'':>14}"
+            speedup = f"{legacy_ms / bulk_ms:>8.1f}x" if legacy_ms is not None and bulk_ms > 0 else ""
+            print(f"{'':<32}  {step:<28}{legacy}{bulk_ms:>8.1f}ms{speedup}")
+        print(f"{'':<32}  {len(kept)} of {len(contour_set)} contours kept by the filter")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Size and speed of the outline transport formats (see src.encoding) on the images in
+src/images/processed. All formats are lossless except polylines, whose share of pixels that match
+the stored outline is shown. Run from the repository root:
+
+    python -m src.benchmarks.bench_encoding
+"""
+import argparse
+import os
+import time
+
+import cv2
+import numpy as np
+
+from src.encoding import FORMATS, decode_outline, encode_outline, outline_mask
+
+PROCESSED_FOLDER = "src/images/processed"
+
+
+def median_ms(function, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times)), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    totals = {fmt: [0, 0.0, 0.0] for fmt in ["stored"] + list(FORMATS)}
+    header = f"{'format':<10}{'bytes':>10}{'encode ms':>11}{'decode ms':>11}{'match %':>9}"
+    print(f"{'image':<28}{header}")
+    for file_name in sorted(os.listdir(PROCESSED_FOLDER)):
+        path = os.path.join(PROCESSED_FOLDER, file_name)
+        if not file_name.lower().endswith('.png'):
+            continue
+        rgba_image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if rgba_image is None or rgba_image.ndim != 3 or rgba_image.shape[2] != 4:
+            continue  # not an outline
+        mask = outline_mask(rgba_image)
+
+        with open(path, 'rb') as f:
+            stored = f.read()
+        decode_ms, _ = median_ms(lambda: cv2.imdecode(np.frombuffer(stored, np.uint8), cv2.IMREAD_UNCHANGED),
+                                 args.repeats)
+        rows = [("stored", len(stored), float("nan"), decode_ms, 100.0)]
+        for fmt in FORMATS:
+            encode_ms, data = median_ms(lambda: encode_outline(rgba_image, fmt), args.repeats)
+            decode_ms, decoded = median_ms(lambda: decode_outline(data, fmt), args.repeats)
+            assert fmt == "polylines" or np.array_equal(decoded, mask), (file_name, fmt)
+            rows.append((fmt, len(data), encode_ms, decode_ms, 100 * float(np.mean(decoded == mask))))
+
+        for fmt, size, encode_ms, decode_ms, match in rows:
+            print(f"{file_name:<28}{fmt:<10}{size:>10}{encode_ms:>11.2f}{decode_ms:>11.2f}{match:>9.2f}")
+            totals[fmt][0] += size
+            totals[fmt][1] += encode_ms
+            totals[fmt][2] += decode_ms
+
+    print(f"\n{'total':<28}{header[:-9]}")
+    for fmt, (size, encode_ms, decode_ms) in totals.items():
+        print(f"{'':<28}{fmt:<10}{size:>10}{encode_ms:>11.2f}{decode_ms:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
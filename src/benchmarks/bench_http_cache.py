@@ -0,0 +1,68 @@
+"""
+Bytes and time of repeated fetches of the processed images with and without the ETag of the
+previous response (If-None-Match). Fails if a revalidation of an unchanged image transfers a body.
+Run from the repository root:
+
+    python -m src.benchmarks.bench_http_cache
+"""
+import argparse
+import os
+import time
+
+os.environ.setdefault("PICASSO_PRELOAD_MODEL", "0")  # no processing here, the workers are not needed
+from src.app import app, catalogue
+
+# the ways the headset fetches a processed image
+URLS = [
+    "/comm_usr?img={}",
+    "/images/processed/{}",
+    "/images/processed/{}?format=rle",
+    "/images/processed/data?img={}",
+]
+
+
+def response_bytes(response):
+    # status line and headers as sent on the wire, plus the body
+    headers = sum(len(f"{k}: {v}\r\n") for k, v in response.headers.items())
+    return len(f"HTTP/1.1 {response.status}\r\n") + headers + 2 + len(response.get_data())
+
+
+def timed_get(client, url, headers, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        response = client.get(url, headers=headers)
+    return response, 1000 * (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    client = app.test_client()
+    _, entries = catalogue.list("processed", sort="name")
+    totals = {"full": [0, 0.0], "revalidated": [0, 0.0]}
+    print(f"{'url':<48}{'full bytes':>12}{'full ms':>9}{'304 bytes':>11}{'304 ms':>8}")
+    for entry in entries:
+        for url in URLS:
+            url = url.format(entry.filename)
+            client.get(url)  # fills the in-memory caches
+            full, full_ms = timed_get(client, url, {}, args.repeats)
+            revalidated, revalidated_ms = timed_get(client, url, {"If-None-Match": full.headers.get("ETag", "")},
+                                                    args.repeats)
+            if full.status_code != 200:
+                continue
+            assert revalidated.status_code == 304 and not revalidated.get_data(), url
+            print(f"{url:<48}{response_bytes(full):>12}{full_ms:>9.2f}"
+                  f"{response_bytes(revalidated):>11}{revalidated_ms:>8.2f}")
+            totals["full"][0] += response_bytes(full)
+            totals["full"][1] += full_ms
+            totals["revalidated"][0] += response_bytes(revalidated)
+            totals["revalidated"][1] += revalidated_ms
+
+    print(f"\ntotal: {totals['full'][0]} bytes in {totals['full'][1]:.1f} ms, revalidated "
+          f"{totals['revalidated'][0]} bytes in {totals['revalidated'][1]:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Load test of the job queue for different splits of the cores into worker processes x OpenCV
+threads per worker.
+
+For every split, a JobQueue with that many workers and threads is started and warmed up, then
+--clients concurrent clients submit images and wait for the results for --duration seconds, like
+the headset does with POST /comm_ml2?wait=... . Rejected submissions (503 in the app, with
+--max-pending) wait for the retry hint and try again. Reports throughput, p50 / p99 latency from
+submission to result and the rejections. Needs the model in src/model. Run from the repository
+root on the machine to size:
+
+    python -m src.benchmarks.bench_load
+    python -m src.benchmarks.bench_load --splits 1x16,4x4,16x1 --clients 32 --duration 60
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from src.benchmarks.bench_pipeline import synthetic_image
+from src.jobs import JobQueue
+from src.scheduler import Overloaded
+
+
+def default_splits(cpu_count):
+    """
+    All cores in one worker, one worker per core and the splits in between with powers of two.
+    """
+    splits = []
+    threads = cpu_count
+    while threads >= 1:
+        splits.append((max(1, cpu_count // threads), threads))
+        threads //= 2
+    if (cpu_count, 1) not in splits:
+        splits.append((cpu_count, 1))
+    return splits
+
+
+def parse_splits(value):
+    return [tuple(int(v) for v in split.split("x")) for split in value.split(",") if split]
+
+
+def run_clients(jobs, images, clients, duration, max_retry_wait):
+    latencies = []
+    rejected = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(index):
+        n = 0
+        while time.perf_counter() < deadline:
+            image = images[(index + n) % len(images)]
+            start = time.perf_counter()
+            try:
+                job = jobs.submit(f"load_{index}_{n}.png", image)
+            except Overloaded as e:
+                with lock:
+                    rejected[0] += 1
+                time.sleep(min(e.retry_after, max_retry_wait))
+                continue
+            n += 1
+            job = jobs.wait(job.id, duration + 60)
+            if job.status == "done":
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, rejected[0], time.perf_counter() - start
+
+
+def main():
+    cpu_count = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--splits", type=parse_splits, default=default_splits(cpu_count),
+                        help="workers x threads per worker, e.g. 1x8,2x4,8x1")
+    parser.add_argument("--clients", type=int, default=2 * cpu_count, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load per split")
+    parser.add_argument("--megapixels", type=float, default=0.3, help="size of the images")
+    parser.add_argument("--max-pending", type=int, help="admission bound, by default 4 jobs per worker")
+    parser.add_argument("--max-retry-wait", type=float, default=1.0, help="upper bound of a client's retry wait")
+    parser.add_argument("--tile-size", type=int, default=1024)
+    parser.add_argument("--backend", help="DNN backend, see DNN_BACKENDS in image_processing")
+    parser.add_argument("--target", help="DNN target, see DNN_TARGETS in image_processing")
+    args = parser.parse_args()
+
+    images = [synthetic_image(args.megapixels, seed) for seed in range(4)]
+    print(f"{cpu_count} cores, {args.clients} clients, {images[0].shape[1]}x{images[0].shape[0]} images")
+    print(f"{'workers x threads':<20}{'images/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'done':>7}{'rejected':>10}")
+    with tempfile.TemporaryDirectory() as folder:
+        for workers, threads in args.splits:
+            jobs = JobQueue(folder, num_workers=workers, threads_per_worker=threads, backend=args.backend,
+                            target=args.target, options={"tile_size": args.tile_size},
+                            max_pending=args.max_pending or 4 * workers)
+            jobs.start()
+            while not jobs.ready():
+                time.sleep(0.1)
+            latencies, rejected, elapsed = run_clients(jobs, images, args.clients, args.duration,
+                                                       args.max_retry_wait)
+            jobs.shutdown(wait=True)
+            if latencies:
+                p50, p99 = (1000 * np.percentile(latencies, q) for q in (50, 99))
+            else:
+                p50 = p99 = float("nan")
+            print(f"{f'{workers} x {threads}':<20}{len(latencies) / elapsed:>10.2f}{p50:>10.0f}{p99:>10.0f}"
+                  f"{len(latencies):>7}{rejected:>10}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
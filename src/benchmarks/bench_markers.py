@@ -0,0 +1,73 @@
+"""
+Latency of the marker detection (src.markers) per frame: full-frame search on every frame versus
+a session that searches around the markers of the previous frame.
+
+The frames are synthetic: --markers ArUco markers on a shaded background, moving a few pixels
+from frame to frame, at every resolution of --resolutions. Run from the repository root:
+
+    python -m src.benchmarks.bench_markers
+    python -m src.benchmarks.bench_markers --resolutions 640x480,1920x1080 --markers 4
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from src.markers import FULL_SEARCH_INTERVAL, MarkerDetector, MarkerSession, aruco_dictionary, refine_corners
+
+
+def parse_resolutions(value):
+    return [tuple(int(v) for v in resolution.split("x")) for resolution in value.split(",") if resolution]
+
+
+def make_frames(width, height, markers, count, seed=0):
+    rng = np.random.default_rng(seed)
+    dictionary = aruco_dictionary()
+    side = max(32, min(width, height) // 6)
+    tiles = [cv2.copyMakeBorder(cv2.aruco.generateImageMarker(dictionary, i, side), side // 8, side // 8,
+                                side // 8, side // 8, cv2.BORDER_CONSTANT, value=255) for i in range(markers)]
+    size = tiles[0].shape[0]
+    origins = [(int(rng.integers(0, width - 2 * size)), int(rng.integers(0, height - 2 * size)))
+               for _ in range(markers)]
+    background = np.tile(np.linspace(90, 200, width, dtype=np.uint8), (height, 1))
+    frames = []
+    for n in range(count):
+        frame = background.copy()
+        for tile, (x, y) in zip(tiles, origins):
+            dx, dy = int(size * 0.5 * (1 + np.sin(n / 10))), int(size * 0.5 * (1 + np.cos(n / 13)))
+            frame[y + dy:y + dy + size, x + dx:x + dx + size] = tile
+        frames.append(cv2.GaussianBlur(frame, (3, 3), 0))
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--resolutions", type=parse_resolutions, default=[(640, 480), (1280, 960)])
+    parser.add_argument("--markers", type=int, default=2)
+    parser.add_argument("--frames", type=int, default=4 * FULL_SEARCH_INTERVAL)
+    args = parser.parse_args()
+
+    print(f"{args.markers} markers, {args.frames} frames per resolution")
+    print(f"{'resolution':<14}{'mode':<10}{'p50 ms':>9}{'p99 ms':>9}{'found':>8}")
+    for width, height in args.resolutions:
+        frames = make_frames(width, height, args.markers, args.frames)
+        detector = MarkerDetector()
+        session = MarkerSession("bench")
+        for mode in ("full", "session"):
+            times, found = [], 0
+            for frame in frames:
+                start = time.perf_counter()
+                if mode == "full":
+                    ids, corners = detector.detect(frame)
+                    refine_corners(frame, corners)
+                    found += len(ids)
+                else:
+                    found += len(session.process(frame)["markers"])
+                times.append(1000 * (time.perf_counter() - start))
+            print(f"{f'{width}x{height}':<14}{mode:<10}{np.percentile(times, 50):>9.2f}"
+                  f"{np.percentile(times, 99):>9.2f}{found / (len(frames) * args.markers):>8.0%}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""
+Benchmark suite of the image processing pipeline: edge_detection (HED and the Sobel / Canny fast
+tier), preprocess_image, the contour functions and the Sobel filter, on the images in src/images/raw
+and on synthetic images of the given sizes (megapixels).
+
+Reports p50/p95 latency per function and image, the throughput of edge_detection with N worker
+processes and the peak RSS. The results can be written as JSON (--output) and compared against a
+stored baseline (--baseline): a p50 latency that is more than --threshold slower, or a throughput
+that is more than --threshold lower, is a regression and makes the run exit with status 1.
+
+The deterministic stand-in network (src/benchmarks/standin.py) is used by default, so the suite
+runs without the pretrained weights. Use --net model to benchmark the real model. Run from the
+repository root:
+
+    python -m src.benchmarks.bench_pipeline --output results.json
+    python -m src.benchmarks.bench_pipeline --baseline results.json --threshold 0.1
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from src import image_processing
+from src.benchmarks import standin
+from src.image_processing import (bounding_contour, contour_convex_hull, contour_length_based,
+                                  contour_moments, edge_detection, preprocess_image, sobel_filter)
+
+RAW_FOLDER = "src/images/raw"
+SYNTHETIC_SIZES = (0.3, 1, 4, 12)  # megapixels
+TILE_SIZE = 1024  # as in the app, bounds the memory of the network on large images
+
+# functions that take the decoded image, and functions that read the image from a path
+IMAGE_CASES = {
+    "edge_detection": lambda image, net, args: edge_detection("bench.png", image, net, tile_size=args.tile_size),
+    # fast tier, as used for live previews
+    "edge_detection_sobel": lambda image, net, args: edge_detection("bench.png", image, net, method="sobel"),
+    "edge_detection_canny": lambda image, net, args: edge_detection("bench.png", image, net, method="canny"),
+    "preprocess_image": lambda image, net, args: preprocess_image(image),
+}
+PATH_CASES = {
+    "contour_moments": contour_moments,
+    "contour_length_based": contour_length_based,
+    "contour_convex_hull": contour_convex_hull,
+    "bounding_contour": bounding_contour,
+    "sobel_filter": sobel_filter,
+}
+
+_worker_net = None
+
+
+def init_net(name):
+    return standin.init_net() if name == "standin" else image_processing.init_net()
+
+
+def synthetic_image(megapixels, seed=0):
+    """
+    A deterministic test image with 4:3 aspect ratio: shapes on a shaded background.
+    """
+    width = int(round(np.sqrt(megapixels * 1e6 * 4 / 3)))
+    height = int(round(width * 3 / 4))
+    rng = np.random.default_rng(seed)
+    ramp = np.linspace(60, 190, width, dtype=np.float32)
+    image = np.repeat(np.broadcast_to(ramp, (height, width))[:, :, None], 3, axis=2).copy()
+    scale = max(width, height) / 100
+    for _ in range(40):
+        color = tuple(float(c) for c in rng.integers(0, 256, 3))
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        if rng.random() < 0.5:
+            cv2.circle(image, center, int(rng.integers(2, 15) * scale), color, -1)
+        else:
+            end = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+            cv2.line(image, center, end, color, max(1, int(scale / 2)))
+    image = cv2.GaussianBlur(image, (0, 0), scale / 4)  # soft edges like in photos
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def load_images(sizes, raw=True):
+    images = []
+    for file_name in sorted(os.listdir(RAW_FOLDER) if raw else []):
+        image = cv2.imread(os.path.join(RAW_FOLDER, file_name))
+        if image is not None:
+            images.append((file_name, image))
+    for megapixels in sizes:
+        images.append((f"synthetic_{megapixels:g}mp", synthetic_image(megapixels)))
+    return images
+
+
+def close_figures():
+    # the contour functions and the Sobel filter plot their results
+    import matplotlib.pyplot as plt
+    plt.close("all")
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def measure(function, repeats, warmup=1):
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(1000 * (time.perf_counter() - start))
+    return {
+        "p50_ms": float(np.percentile(times, 50)),
+        "p95_ms": float(np.percentile(times, 95)),
+        "mean_ms": float(np.mean(times)),
+        "runs": repeats,
+    }
+
+
+def _init_worker(net_name):
+    global _worker_net
+    _worker_net = init_net(net_name)
+
+
+def _worker_edge_detection(image, tile_size):
+    edge_detection("bench.png", image, _worker_net, tile_size=tile_size)
+
+
+def measure_throughput(images, num_workers, args):
+    """
+    Images per second of edge_detection with `num_workers` processes, each with its own network.
+    """
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker, initargs=(args.net,)) as executor:
+        # wait until every worker has loaded its network
+        list(executor.map(_worker_edge_detection, [images[0]] * num_workers, [args.tile_size] * num_workers))
+        start = time.perf_counter()
+        futures = [executor.submit(_worker_edge_detection, image, args.tile_size)
+                   for _ in range(args.repeats) for image in images]
+        for future in futures:
+            future.result()
+        elapsed = time.perf_counter() - start
+    return {"images_per_s": len(futures) / elapsed, "peak_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN)}
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the change against the baseline and returns the regressions.
+    """
+    regressions = []
+    print(f"\n{'comparison with baseline':<52}{'baseline':>10}{'current':>10}{'change':>9}")
+    for name, case in results["cases"].items():
+        if name in baseline.get("cases", {}) and "p50_ms" in case:
+            before, after = baseline["cases"][name]["p50_ms"], case["p50_ms"]
+            change = after / before - 1 if before > 0 else 0.0
+            flag = " REGRESSION" if change > threshold else ""
+            print(f"{name + ' p50 ms':<52}{before:>10.2f}{after:>10.2f}{100 * change:>8.1f}%{flag}")
+            if flag:
+                regressions.append(name)
+    for workers, run in results["throughput"].items():
+        if workers in baseline.get("throughput", {}):
+            before, after = baseline["throughput"][workers]["images_per_s"], run["images_per_s"]
+            change = after / before - 1 if before > 0 else 0.0
+            flag = " REGRESSION" if change < -threshold else ""
+            print(f"{'throughput ' + workers + ' workers images/s':<52}{before:>10.2f}{after:>10.2f}"
+                  f"{100 * change:>8.1f}%{flag}")
+            if flag:
+                regressions.append(f"throughput/{workers}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--sizes", type=lambda value: [float(v) for v in value.split(",") if v],
+                        default=list(SYNTHETIC_SIZES), help="megapixels of the synthetic images")
+    parser.add_argument("--no-raw", action="store_true", help="only use the synthetic images")
+    parser.add_argument("--cases", type=lambda value: value.split(","),
+                        default=list(IMAGE_CASES) + list(PATH_CASES), help="functions to benchmark")
+    parser.add_argument("--workers", type=lambda value: [int(v) for v in value.split(",") if v],
+                        default=[1, os.cpu_count() or 1], help="worker counts for the throughput")
+    parser.add_argument("--net", choices=["standin", "model"], default="standin")
+    parser.add_argument("--tile-size", type=int, default=TILE_SIZE)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown, 0.1 is 10%%")
+    args = parser.parse_args()
+    for case in args.cases:
+        if case not in IMAGE_CASES and case not in PATH_CASES:
+            parser.error(f"unknown case \"{case}\", expected one of {list(IMAGE_CASES) + list(PATH_CASES)}")
+
+    net = init_net(args.net)
+    images = load_images(args.sizes, raw=not args.no_raw)
+    results = {
+        "meta": {
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "net": args.net,
+            "repeats": args.repeats,
+            "tile_size": args.tile_size,
+            "python": platform.python_version(),
+            "opencv": cv2.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "cases": {},
+        "throughput": {},
+    }
+
+    print(f"{'case':<52}{'pixels':>10}{'p50 ms':>10}{'p95 ms':>10}{'peak MB':>9}")
+    with tempfile.TemporaryDirectory() as folder:
+        for image_name, image in images:
+            path = os.path.join(folder, os.path.splitext(image_name)[0] + ".png")
+            cv2.imwrite(path, image)
+            for case in args.cases:
+                if case in IMAGE_CASES:
+                    function = lambda: IMAGE_CASES[case](image, net, args)
+                else:
+                    function = lambda: (PATH_CASES[case](path), close_figures())
+                name = f"{case}/{image_name}"
+                try:
+                    result = measure(function, args.repeats)
+                except Exception as e:  # e.g. contour_length_based needs at least 7 contours
+                    result = {"error": f"{type(e).__name__}: {e}"}
+                    print(f"{name:<52}{image.shape[0] * image.shape[1]:>10} {result['error']}")
+                else:
+                    result["peak_rss_mb"] = peak_rss_mb()
+                    print(f"{name:<52}{image.shape[0] * image.shape[1]:>10}{result['p50_ms']:>10.2f}"
+                          f"{result['p95_ms']:>10.2f}{result['peak_rss_mb']:>9.0f}")
+                results["cases"][name] = result
+
+    if "edge_detection" in args.cases:
+        print(f"\n{'edge_detection throughput':<52}{'images/s':>10}{'peak MB':>9}")
+        for num_workers in args.workers:
+            run = measure_throughput([image for _, image in images], num_workers, args)
+            results["throughput"][str(num_workers)] = run
+            print(f"{f'{num_workers} workers':<52}{run['images_per_s']:>10.2f}{run['peak_rss_mb']:>9.0f}")
+    results["meta"]["peak_rss_mb"] = peak_rss_mb()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) above {100 * args.threshold:g}%")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Micro-benchmark of the outline post-processing that runs after the HED forward pass.
+
+Compares the original implementation (one temporary array per step) with the fused version that
+writes into reusable OutlineBuffers. The edge maps in src/output are used as network output, so
+no model is needed. Run from the repository root:
+
+    python -m src.benchmarks.bench_postprocess
+"""
+import argparse
+import os
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from src.image_processing import BORDER_THICKNESS, THRESHOLD, OutlineBuffers, outline_from_probability
+
+RAW_FOLDER = "src/images/raw"
+HED_FOLDER = "src/output"
+
+
+def legacy_outline(probability, threshold=THRESHOLD, border_thickness=BORDER_THICKNESS):
+    # the post-processing as it was originally written in edge_detection
+    (H, W) = probability.shape
+    hed = cv2.resize(probability, (W, H))
+    hed = (255 * hed).astype("uint8")
+    mask = np.ones_like(hed, dtype=np.uint8)
+    mask[:border_thickness, :] = 0
+    mask[-border_thickness:, :] = 0
+    mask[:, :border_thickness] = 0
+    mask[:, -border_thickness:] = 0
+    cleaned_hed_output = cv2.bitwise_and(hed, hed, mask=mask)
+    binary_image = np.where(cleaned_hed_output > threshold, 255, 0).astype("uint8")
+    inverted_image = 255 - binary_image
+    rgba_image = cv2.cvtColor(inverted_image, cv2.COLOR_GRAY2BGRA)
+    rgba_image[:, :, 3] = np.where(inverted_image == 255, 0, 255)
+    return rgba_image, hed
+
+
+def load_probabilities():
+    # the stored HED output of every raw image, scaled back to probabilities
+    for file_name in sorted(os.listdir(RAW_FOLDER)):
+        if not file_name.lower().endswith(('.png', '.jpg')):
+            continue
+        stem = os.path.splitext(file_name)[0]
+        hed = cv2.imread(os.path.join(HED_FOLDER, stem + "_hed.png"), cv2.IMREAD_GRAYSCALE)
+        if hed is not None:
+            yield stem, hed.astype(np.float32) / 255
+
+
+def measure(function, probability, repeats):
+    function(probability)  # warm-up, allocates the buffers of the fused version
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(probability)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function(probability)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return 1000 * float(np.median(times)), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    buffers = OutlineBuffers()
+    fused = lambda probability: outline_from_probability(probability, buffers=buffers)
+
+    print(f"{'image':<28}{'pixels':>10}{'legacy ms':>11}{'fused ms':>10}{'legacy peak':>13}{'fused peak':>12}")
+    for stem, probability in load_probabilities():
+        legacy_rgba, legacy_hed = legacy_outline(probability)
+        fused_rgba, fused_hed = fused(probability)
+        assert np.array_equal(legacy_rgba, fused_rgba) and np.array_equal(legacy_hed, fused_hed), stem
+
+        legacy_ms, legacy_peak = measure(legacy_outline, probability, args.repeats)
+        fused_ms, fused_peak = measure(fused, probability, args.repeats)
+        print(f"{stem:<28}{probability.size:>10}{legacy_ms:>11.2f}{fused_ms:>10.2f}"
+              f"{legacy_peak / 1024 ** 2:>11.2f}MB{fused_peak / 1024 ** 2:>10.2f}MB")
+
+
+if __name__ == "__main__":
+    main()
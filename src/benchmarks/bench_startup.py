@@ -0,0 +1,97 @@
+"""
+Cold-start benchmark of the server, every measurement in a fresh interpreter:
+ - import: time to import src.app (without starting the workers) and whether matplotlib was
+   imported with it
+ - ready: time from the start of the interpreter until /readyz reports every worker ready
+   (import, spawning the workers, loading and warming up the network)
+ - first image: latency of the first HED forward pass on a real image after loading the network,
+   with and without the warm-up pass
+
+Needs the model in src/model. Run from the repository root:
+
+    python -m src.benchmarks.bench_startup
+    python -m src.benchmarks.bench_startup --repeats 5 --workers 2
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import src.app
+print(json.dumps({"seconds": time.perf_counter() - start, "matplotlib": "matplotlib" in sys.modules,
+                  "modules": len(sys.modules)}))
+"""
+
+READY_SCRIPT = """
+import json, time
+start = time.perf_counter()
+from src.app import app
+client = app.test_client()
+first_response = None
+while client.get("/readyz").status_code != 200:
+    if first_response is None:
+        first_response = time.perf_counter() - start
+    time.sleep(0.01)
+print(json.dumps({"seconds": time.perf_counter() - start, "first_response": first_response}))
+"""
+
+FIRST_IMAGE_SCRIPT = """
+import json, time
+import cv2
+from src.image_processing import hed_probability, init_net, warm_up
+net = init_net()
+warm_up_ms = warm_up(net) if {warm_up} else 0.0
+image = cv2.imread({image!r})
+start = time.perf_counter()
+hed_probability(image, net)
+first = time.perf_counter() - start
+start = time.perf_counter()
+hed_probability(image, net)
+print(json.dumps({{"first": first, "second": time.perf_counter() - start, "warm_up": warm_up_ms / 1000}}))
+"""
+
+
+def run(script, env=None):
+    output = subprocess.run([sys.executable, "-c", script], check=True, capture_output=True, text=True,
+                            env={**os.environ, **(env or {})})
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def summary(values):
+    return f"{1000 * np.median(values):>10.0f}{1000 * np.min(values):>10.0f}{1000 * np.max(values):>10.0f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1, help="worker processes of the server")
+    parser.add_argument("--image", default="src/images/raw/flower.jpg", help="image of the first forward pass")
+    args = parser.parse_args()
+    env = {"PICASSO_WORKERS": str(args.workers), "PICASSO_PERSIST_IMAGES": "0"}
+
+    print(f"{'measurement':<40}{'p50 ms':>10}{'min ms':>10}{'max ms':>10}")
+    imports = [run(IMPORT_SCRIPT, {**env, "PICASSO_PRELOAD_MODEL": "0"}) for _ in range(args.repeats)]
+    print(f"{'import src.app':<40}{summary([r['seconds'] for r in imports])}"
+          f"  ({imports[0]['modules']} modules, matplotlib {'imported' if imports[0]['matplotlib'] else 'not imported'})")
+
+    readies = [run(READY_SCRIPT, env) for _ in range(args.repeats)]
+    print(f"{'first response (not ready)':<40}{summary([r['first_response'] or r['seconds'] for r in readies])}")
+    print(f"{f'ready, {args.workers} worker(s)':<40}{summary([r['seconds'] for r in readies])}")
+
+    for warm in (False, True):
+        runs = [run(FIRST_IMAGE_SCRIPT.format(warm_up=warm, image=args.image)) for _ in range(args.repeats)]
+        label = "with warm-up" if warm else "without warm-up"
+        if warm:
+            print(f"{'warm-up pass':<40}{summary([r['warm_up'] for r in runs])}")
+        print(f"{'first image ' + label:<40}{summary([r['first'] for r in runs])}")
+        print(f"{'second image ' + label:<40}{summary([r['second'] for r in runs])}")
+
+
+if __name__ == "__main__":
+    main()
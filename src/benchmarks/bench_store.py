@@ -0,0 +1,64 @@
+"""
+Reading edge maps from a packed store (src.store) versus one .npy file per map (ProbabilityStore
+without the packed store), at --entries maps.
+
+Both are filled with the same --size x --size uint8 maps in a temporary folder, then --reads
+random maps are read from each. Reports the time to open the store (reading its index), the
+latency of a read (p50/p99) and the files on disk. Run from the repository root:
+
+    python -m src.benchmarks.bench_store
+    python -m src.benchmarks.bench_store --entries 100000 --size 32
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from src.cache import ProbabilityStore
+from src.store import PackedStore
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=10000)
+    parser.add_argument("--size", type=int, default=64, help="side of the maps (pixels)")
+    parser.add_argument("--reads", type=int, default=10000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    hed = rng.integers(0, 256, (args.size, args.size), dtype=np.uint8)
+    names = [f"image_{i}.png" for i in range(args.entries)]
+    reads = [names[i] for i in rng.integers(0, args.entries, args.reads)]
+
+    print(f"{args.entries} maps of {args.size}x{args.size}, {args.reads} random reads")
+    print(f"{'store':<8}{'fill s':>9}{'open ms':>9}{'p50 us':>9}{'p99 us':>9}{'files':>8}")
+    with tempfile.TemporaryDirectory() as folder:
+        for kind in ("files", "packed"):
+            path = os.path.join(folder, kind)
+            start = time.perf_counter()
+            if kind == "packed":
+                packed = PackedStore(path)
+                for i in range(0, len(names), 1000):
+                    packed.put_many([(name[:-4] + "_hed", hed) for name in names[i:i + 1000]])
+            else:
+                writer = ProbabilityStore(path, max_memory_items=0)
+                for name in names:
+                    writer.put(name, hed)
+            fill = time.perf_counter() - start
+
+            start = time.perf_counter()
+            store = ProbabilityStore(path, max_memory_items=0)  # no in-memory copies, every read hits the store
+            opened = 1000 * (time.perf_counter() - start)
+            times = []
+            for name in reads:
+                start = time.perf_counter()
+                store.get(name)
+                times.append(1e6 * (time.perf_counter() - start))
+            print(f"{kind:<8}{fill:>9.2f}{opened:>9.1f}{np.percentile(times, 50):>9.1f}"
+                  f"{np.percentile(times, 99):>9.1f}{len(os.listdir(path)):>8}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
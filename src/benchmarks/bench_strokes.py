@@ -0,0 +1,61 @@
+"""
+Time of the drawing-order planner (src.strokes) and the pen-up travel of its order.
+
+The outline is synthetic: --strokes short random lines on a --size x --size mask, or the outline
+of a processed image with --image. Reports the time of the stroke extraction, of the greedy
+order alone and with 2-opt, and the pen-up travel of the strokes as extracted, in greedy order
+and after 2-opt. Run from the repository root:
+
+    python -m src.benchmarks.bench_strokes
+    python -m src.benchmarks.bench_strokes --strokes 50000 --size 4000
+    python -m src.benchmarks.bench_strokes --image src/images/processed/rose.png
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from src.encoding import outline_mask
+from src.strokes import TWO_OPT_ROUNDS, extract_strokes, plan_drawing_order
+
+
+def synthetic_mask(size, strokes, seed=0):
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((size, size), dtype=np.uint8)
+    for _ in range(strokes):
+        x, y = rng.integers(10, size - 10, 2)
+        angle, length = rng.uniform(0, np.pi), rng.uniform(5, 25)
+        cv2.line(mask, (int(x), int(y)), (int(x + length * np.cos(angle)), int(y + length * np.sin(angle))), 255, 1)
+    return mask
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--strokes", type=int, default=10000)
+    parser.add_argument("--size", type=int, default=2500, help="side of the synthetic mask (pixels)")
+    parser.add_argument("--image", help="processed image (RGBA outline) instead of the synthetic mask")
+    args = parser.parse_args()
+
+    if args.image:
+        mask = outline_mask(cv2.imread(args.image, cv2.IMREAD_UNCHANGED))
+    else:
+        mask = synthetic_mask(args.size, args.strokes)
+
+    start = time.perf_counter()
+    strokes = extract_strokes(mask)
+    extract_ms = 1000 * (time.perf_counter() - start)
+    print(f"{len(strokes)} strokes on {mask.shape[1]}x{mask.shape[0]}, extracted in {extract_ms:.0f} ms")
+    print(f"{'order':<12}{'ms':>8}{'pen-up px':>14}{'vs extracted':>14}")
+    baseline = strokes.pen_up_length()
+    print(f"{'extracted':<12}{0:>8.0f}{baseline:>14.0f}{1:>14.2f}")
+    for name, rounds in (("greedy", 0), ("2-opt", TWO_OPT_ROUNDS)):
+        start = time.perf_counter()
+        order, reverse = plan_drawing_order(strokes, two_opt_rounds=rounds)
+        elapsed = 1000 * (time.perf_counter() - start)
+        travel = strokes.ordered(order, reverse).pen_up_length()
+        print(f"{name:<12}{elapsed:>8.0f}{travel:>14.0f}{travel / max(baseline, 1e-9):>14.2f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
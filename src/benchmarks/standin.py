@@ -0,0 +1,109 @@
+"""
+Deterministic stand-in for the HED network, for benchmarks on machines without the pretrained
+weights. `init_net` builds a network from src/model/deploy.prototxt with the same layers and blob
+shapes as the real model, but with seeded random weights (bilinear kernels for the upsampling
+layers), so it costs the same to run and gives the same output for the same input on every run.
+The edge maps it produces are not meaningful.
+"""
+import re
+
+import cv2
+import numpy as np
+
+from src.image_processing import register_crop_layer
+
+PROTOTXT = "src/model/deploy.prototxt"
+SEED = 0
+# the input is mean-subtracted BGR (about +-128), the score layers scale the features back and the
+# fused score is shifted, so most pixels get a low edge probability like with the real weights
+SCORE_SCALE = 1.0 / 32
+FUSE_BIAS = -2.5
+
+
+def init_net(seed=SEED):
+    """
+    Same interface as src.image_processing.init_net.
+    """
+    with open(PROTOTXT, 'rb') as f:
+        proto = f.read()
+    model = build_caffemodel(proto.decode(), seed)
+    register_crop_layer()
+    return cv2.dnn.readNetFromCaffe(np.frombuffer(proto, np.uint8), np.frombuffer(model, np.uint8))
+
+
+def build_caffemodel(prototxt, seed=SEED):
+    """
+    Serializes a caffemodel (NetParameter protobuf) with weights for every layer of `prototxt`.
+    """
+    rng = np.random.default_rng(seed)
+    channels = {"data": 3}
+    layers = b""
+    for block in _layer_blocks(prototxt):
+        name, layer_type = _attr(block, "name")[0], _attr(block, r"\btype")[0]
+        bottoms, top = _attr(block, "bottom"), _attr(block, "top")[0]
+        if layer_type == "Concat":
+            in_channels = sum(channels[bottom] for bottom in bottoms)
+        else:
+            in_channels = channels[bottoms[0]]
+        channels[top] = in_channels
+        if layer_type not in ("Convolution", "Deconvolution"):
+            continue
+
+        out_channels = int(_attr(block, "num_output")[0])
+        kernel = int(_attr(block, "kernel_size")[0])
+        if layer_type == "Deconvolution":
+            weights = np.broadcast_to(_bilinear_kernel(kernel), (in_channels, out_channels, kernel, kernel))
+        else:
+            fan_in = in_channels * kernel * kernel
+            weights = rng.standard_normal((out_channels, in_channels, kernel, kernel)) * np.sqrt(2.0 / fan_in)
+            if "score" in name:
+                weights = weights * SCORE_SCALE if name.startswith("score") else np.full_like(weights, 0.2)
+        bias = np.full(out_channels, FUSE_BIAS if name == "new-score-weighting" else 0.0)
+        channels[top] = out_channels
+        layers += _bytes_field(100, _bytes_field(1, name.encode()) + _bytes_field(2, layer_type.encode())
+                               + _bytes_field(7, _blob(weights)) + _bytes_field(7, _blob(bias)))
+    return _bytes_field(1, b"FCN") + layers
+
+
+def _bilinear_kernel(size):
+    factor = (size + 1) // 2
+    center = factor - 1 if size % 2 == 1 else factor - 0.5
+    ramp = 1 - np.abs(np.arange(size) - center) / factor
+    return np.outer(ramp, ramp)
+
+
+def _layer_blocks(prototxt):
+    text = re.sub(r"#.*", "", prototxt)
+    for match in re.finditer(r"layer\s*\{", text):
+        depth, i = 1, match.end()
+        while depth:
+            depth += {"{": 1, "}": -1}.get(text[i], 0)
+            i += 1
+        yield text[match.end():i - 1]
+
+
+def _attr(block, key):
+    return re.findall(key + r"\s*:\s*['\"]?([\w\-.]+)['\"]?", block)
+
+
+# minimal protobuf encoding, enough for the fields of a caffemodel
+def _varint(n):
+    out = bytearray()
+    while True:
+        low = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(low | 0x80)
+        else:
+            out.append(low)
+            return bytes(out)
+
+
+def _bytes_field(number, data):
+    return _varint((number << 3) | 2) + _varint(len(data)) + data
+
+
+def _blob(array):
+    # BlobProto: shape (field 7, BlobShape with packed dims) and data (field 5, packed floats)
+    shape = b"".join(_varint(d) for d in array.shape)
+    return _bytes_field(7, _bytes_field(1, shape)) + _bytes_field(5, np.ascontiguousarray(array, dtype="<f4").tobytes())
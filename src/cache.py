@@ -0,0 +1,223 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+
+from src.store import PackedStore, probability_key
+
+
+def cache_key(image, **params):
+    """
+    Content address of a processing result: a hash of the decoded pixels and the parameters
+    used to process them.
+
+    Args:
+        image (np.ndarray): Decoded input image.
+        **params: Processing parameters (threshold, border thickness, output format, model id...).
+
+    Returns:
+        str: Hex digest identifying the result.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"{image.shape}|{image.dtype}|".encode())
+    h.update(np.ascontiguousarray(image).data)
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class ResultCache(object):
+    """
+    Two-level cache for processing results.
+
+    Entries are dicts of numpy arrays. The first level is an in-memory LRU bounded by the total
+    size of the arrays it holds, the second level is a folder of .npz files bounded by their total
+    size on disk; the least recently used files are evicted first. The folder can be shared by
+    several processes.
+    """
+
+    def __init__(self, folder, max_memory_bytes=256 * 1024 ** 2, max_disk_bytes=1024 ** 3):
+        self.folder = folder
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(folder, exist_ok=True)
+        self._disk_bytes = self._folder_bytes()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + '.npz')
+
+    def _folder_bytes(self):
+        # size of the .npz files of all processes sharing the folder
+        total = 0
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith('.npz'):
+                try:
+                    total += entry.stat().st_size
+                except FileNotFoundError:
+                    pass  # evicted by another process while scanning
+        return total
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits_memory += 1
+                return self._memory[key]
+
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                value = {name: data[name] for name in data.files}
+            # mark as recently used for the disk eviction
+            os.utime(path)
+        except (OSError, ValueError, zipfile.BadZipFile):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits_disk += 1
+            self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        value = {name: np.array(array) for name, array in value.items()}
+        with self._lock:
+            self._remember(key, value)
+
+        # write to a temporary file first, so readers in other processes never see partial files
+        path = self._path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **value)
+        try:
+            replaced_size = os.path.getsize(path)  # the key is written again, e.g. by another process
+        except OSError:
+            replaced_size = 0
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._disk_bytes += os.path.getsize(path) - replaced_size
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _remember(self, key, value):
+        if key in self._memory:
+            return
+        size = sum(array.nbytes for array in value.values())
+        if size > self.max_memory_bytes:
+            return
+        self._memory[key] = value
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= sum(array.nbytes for array in evicted.values())
+
+    def _evict_disk(self):
+        # other processes may have written to the folder too, so the sizes are read again
+        entries = [entry for entry in os.scandir(self.folder) if entry.name.endswith('.npz')]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        self._disk_bytes = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self._disk_bytes -= size
+            except OSError:
+                pass
+
+    def stats(self):
+        # the worker processes write most of the files, so the size on disk is read from the folder
+        disk_bytes = self._folder_bytes()
+        with self._lock:
+            self._disk_bytes = disk_bytes
+            lookups = self.hits_memory + self.hits_disk + self.misses
+            return {
+                "hits_memory": self.hits_memory,
+                "hits_disk": self.hits_disk,
+                "misses": self.misses,
+                "hit_rate": (self.hits_memory + self.hits_disk) / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_bytes": self._disk_bytes,
+            }
+
+
+class ProbabilityStore(object):
+    """
+    Edge probability maps of processed images, kept so outlines can be restyled without running
+    the network again.
+
+    The maps are stored as uint8 .npy files (the network output scaled to 0-255, which is what the
+    thresholding works on), and the most recently used ones are kept in memory.
+    With `packed` or if the folder holds a packed store (see src.store), the maps are written to
+    the store instead and read from its memory map without copying. Maps not found in the store
+    are still read from their .npy files.
+    """
+
+    def __init__(self, folder, max_memory_items=32, packed=False):
+        self.folder = folder
+        self.max_memory_items = max_memory_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self._packed = PackedStore(folder) if packed or PackedStore.exists(folder) else None
+
+    def _path(self, name):
+        return os.path.join(self.folder, os.path.splitext(name)[0] + '_hed.npy')
+
+    def put(self, name, hed):
+        hed = np.ascontiguousarray(hed, dtype=np.uint8)
+        if self._packed is not None:
+            self._packed.put(probability_key(name), hed)
+            return
+        path = self._path(name)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, hed)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._remember(name, os.stat(path).st_mtime_ns, hed.copy())
+
+    def get(self, name):
+        if self._packed is not None:
+            hed = self._packed.get(probability_key(name))
+            if hed is not None:
+                return hed
+        # maps can be replaced by other processes, the modification time tells if a copy is current
+        path = self._path(name)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        with self._lock:
+            if name in self._memory and self._memory[name][0] == mtime:
+                self._memory.move_to_end(name)
+                return self._memory[name][1]
+        try:
+            hed = np.load(path)
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            self._remember(name, mtime, hed)
+        return hed
+
+    def _remember(self, name, mtime, hed):
+        self._memory[name] = (mtime, hed)
+        self._memory.move_to_end(name)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
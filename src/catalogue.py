@@ -0,0 +1,162 @@
+import hashlib
+import os
+import threading
+
+
+class CatalogueEntry(object):
+    __slots__ = ("filename", "size", "mtime", "mtime_ns", "ctime", "digest")
+
+    def __init__(self, filename, stat):
+        self.filename = filename
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.mtime_ns = stat.st_mtime_ns
+        self.ctime = stat.st_ctime
+        self.digest = None  # hash of the content, computed on first use
+
+    def same_file(self, other):
+        return other is not None and (self.size, self.mtime_ns) == (other.size, other.mtime_ns)
+
+
+def file_digest(path, chunk_size=1024 ** 2):
+    """
+    Hash of the content of a file (hex), used as its ETag.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# keys of the sorted listings
+SORT_KEYS = {
+    "name": lambda entry: entry.filename,
+    "date": lambda entry: entry.ctime,
+    "size": lambda entry: entry.size,
+}
+
+
+class ImageCatalogue(object):
+    """
+    In-memory index of the images in a set of folders, so galleries and lookups by name do not
+    scan the folders on every request.
+
+    A folder is scanned again only when the modification time of the directory changes, which
+    happens whenever a file is created, removed or renamed in it (also by other processes, e.g. the
+    background writer). Files changed in place are picked up with `refresh`.
+    The content hash of a file is computed once and kept until the file changes.
+    """
+
+    def __init__(self, folders, allowed=None):
+        """
+        Args:
+            folders (dict): Folder of every image type, e.g. {"raw": ..., "processed": ...}.
+            allowed (callable): Filter on file names, by default every file is an image.
+        """
+        self.folders = dict(folders)
+        self.allowed = allowed or (lambda filename: True)
+        self.scans = 0
+        self._entries = {path_type: {} for path_type in self.folders}
+        self._sorted = {path_type: {} for path_type in self.folders}
+        self._dir_mtimes = {path_type: None for path_type in self.folders}
+        self._lock = threading.Lock()
+
+    def _folder(self, path_type):
+        if path_type not in self.folders:
+            raise KeyError(f"unknown path type \"{path_type}\", expected one of {list(self.folders)}")
+        return self.folders[path_type]
+
+    def _current(self, path_type):
+        # rescans the folder if its listing changed, returns the entries by name
+        folder = self._folder(path_type)
+        try:
+            dir_mtime = os.stat(folder).st_mtime_ns
+        except FileNotFoundError:
+            dir_mtime = None
+        with self._lock:
+            if dir_mtime != self._dir_mtimes[path_type] or dir_mtime is None:
+                self._scan(path_type, folder)
+                self._dir_mtimes[path_type] = dir_mtime
+            return self._entries[path_type]
+
+    def _scan(self, path_type, folder):
+        previous = self._entries[path_type]
+        entries = {}
+        try:
+            with os.scandir(folder) as it:
+                for dir_entry in it:
+                    if not self.allowed(dir_entry.name):
+                        continue
+                    try:
+                        if dir_entry.is_file():
+                            entry = CatalogueEntry(dir_entry.name, dir_entry.stat())
+                            if entry.same_file(previous.get(entry.filename)):
+                                entry.digest = previous[entry.filename].digest
+                            entries[entry.filename] = entry
+                    except FileNotFoundError:
+                        pass  # removed while scanning
+        except FileNotFoundError:
+            pass
+        self._entries[path_type] = entries
+        self._sorted[path_type] = {}
+        self.scans += 1
+
+    def refresh(self, path_type, filename):
+        """
+        Updates the entry of a single file, e.g. after it was overwritten in place.
+        """
+        path = os.path.join(self._folder(path_type), filename)
+        with self._lock:
+            entries = dict(self._entries[path_type])
+            try:
+                entry = CatalogueEntry(filename, os.stat(path))
+                if entry.same_file(entries.get(filename)):
+                    entry.digest = entries[filename].digest
+                entries[filename] = entry
+            except FileNotFoundError:
+                entries.pop(filename, None)
+            self._entries[path_type] = entries
+            self._sorted[path_type] = {}
+
+    def get(self, path_type, filename):
+        """
+        Returns the entry of an image, or None if there is no image with this name.
+        """
+        return self._current(path_type).get(filename)
+
+    def digest(self, path_type, filename):
+        """
+        Returns the content hash of an image, or None if there is no image with this name.
+        """
+        entry = self.get(path_type, filename)
+        if entry is None:
+            return None
+        if entry.digest is None:
+            try:
+                entry.digest = file_digest(os.path.join(self.folders[path_type], filename))
+            except FileNotFoundError:
+                return None
+        return entry.digest
+
+    def list(self, path_type, sort="date", reverse=False, offset=0, limit=None):
+        """
+        A page of the images of a type, sorted by name, date (creation time) or size.
+
+        Returns:
+            tuple: (total number of images, list of entries of the page)
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError(f"unknown sort key \"{sort}\", expected one of {list(SORT_KEYS)}")
+        self._current(path_type)
+        with self._lock:
+            entries = self._entries[path_type]
+            ordered = self._sorted[path_type].get(sort)
+            if ordered is None:
+                ordered = sorted(entries.values(), key=SORT_KEYS[sort])
+                self._sorted[path_type][sort] = ordered
+        total = len(ordered)
+        end = total if limit is None else min(offset + limit, total)
+        if reverse:
+            return total, ordered[max(total - end, 0):max(total - offset, 0)][::-1]
+        return total, ordered[offset:end]
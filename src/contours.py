@@ -0,0 +1,257 @@
+"""
+Headless contour analysis: the contours of an image with their moments, arc lengths, bounding
+boxes and (on demand) convex hulls, computed for all contours at once.
+
+The points of all contours are kept in one (N, 2) int32 array with the start offset of every
+contour, the same layout as the polyline format in src/vector.py. The measures are reductions over
+the segments of this array (np.add.reduceat etc.), so their cost grows with the number of points and
+not with the number of Python-level calls per contour.
+"""
+import cv2
+import numpy as np
+
+# one record per contour
+CONTOUR_RECORD = np.dtype([
+    ("parent", np.int32),  # index of the enclosing contour (RETR_TREE / RETR_CCOMP), -1 if none
+    ("points", np.int32),  # number of contour points
+    ("area", np.float64),  # enclosed area, as cv2.contourArea
+    ("length", np.float64),  # perimeter of the closed contour, as cv2.arcLength(contour, True)
+    ("cx", np.float64),  # centroid (m10 / m00, m01 / m00), the mean point of degenerate contours
+    ("cy", np.float64),
+    ("mu20", np.float64),  # central second order moments, as cv2.moments
+    ("mu11", np.float64),
+    ("mu02", np.float64),
+    ("x", np.int32),  # bounding box, as cv2.boundingRect
+    ("y", np.int32),
+    ("w", np.int32),
+    ("h", np.int32),
+])
+
+ADAPTIVE_BLOCK_SIZE = 11  # adaptive threshold of the contour functions in image_processing
+ADAPTIVE_C = 2
+
+
+def threshold_image(gray, threshold=None):
+    """
+    Binary image for contour tracing: the adaptive Gaussian threshold used by the contour functions
+    in image_processing, or a fixed threshold (0-255).
+    """
+    if threshold is None:
+        return cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
+                                     ADAPTIVE_BLOCK_SIZE, ADAPTIVE_C)
+    _, binary = cv2.threshold(gray, threshold, 255, cv2.THRESH_BINARY)
+    return binary
+
+
+class ContourSet(object):
+    """
+    The contours of an image with one CONTOUR_RECORD per contour.
+
+    Attributes:
+        points (np.ndarray): (N, 2) int32 points of all contours.
+        offsets (np.ndarray): Start of every contour in `points`, plus the total number of points.
+        records (np.ndarray): Structured array of CONTOUR_RECORD.
+        shape (tuple): (height, width) of the image.
+    """
+
+    def __init__(self, points, offsets, records, shape):
+        self.points = points
+        self.offsets = offsets
+        self.records = records
+        self.shape = shape
+        self._hulls = None
+
+    @classmethod
+    def from_contours(cls, contours, hierarchy, shape):
+        """
+        Args:
+            contours (sequence): Contours as returned by cv2.findContours.
+            hierarchy (np.ndarray): Hierarchy of cv2.findContours, or None.
+            shape (tuple): (height, width) of the image.
+        """
+        counts = np.fromiter((len(c) for c in contours), dtype=np.int64, count=len(contours))
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        if len(contours):
+            points = np.concatenate(contours).reshape(-1, 2).astype(np.int32, copy=False)
+        else:
+            points = np.zeros((0, 2), np.int32)
+        records = contour_records(points, offsets)
+        if hierarchy is not None and len(contours):
+            records["parent"] = hierarchy.reshape(-1, 4)[:, 3]
+        else:
+            records["parent"] = -1
+        return cls(points, offsets, records, tuple(shape[:2]))
+
+    def __len__(self):
+        return len(self.records)
+
+    def contour(self, i):
+        # (n, 1, 2) view, the layout cv2 functions expect
+        return self.points[self.offsets[i]:self.offsets[i + 1]].reshape(-1, 1, 2)
+
+    def contours(self):
+        """
+        All contours as a list of (n, 1, 2) views of `points`.
+        """
+        points = self.points.reshape(-1, 1, 2)
+        return [points[start:end] for start, end in zip(self.offsets[:-1].tolist(), self.offsets[1:].tolist())]
+
+    def select(self, keep):
+        """
+        A ContourSet of the contours selected by a boolean mask or index array. Parent indices are
+        mapped to the selection, parents that are not selected become -1.
+        """
+        indices = np.flatnonzero(keep) if np.asarray(keep).dtype == bool else np.asarray(keep, dtype=np.int64)
+        counts = np.diff(self.offsets)[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        # index of every point of the selection in `points`
+        point_index = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - self.offsets[indices], counts)
+        records = self.records[indices]
+        new_index = np.full(len(self) + 1, -1, dtype=np.int32)  # the extra last entry maps parent -1
+        new_index[indices] = np.arange(len(indices))
+        records["parent"] = new_index[records["parent"]]
+        selection = ContourSet(self.points[point_index], offsets, records, self.shape)
+        if self._hulls is not None:
+            selection._hulls = [self._hulls[i] for i in indices]
+        return selection
+
+    def filter(self, min_area=0, max_area=None, min_length=0, max_length=None, min_points=1):
+        """
+        The contours with area and arc length in the given ranges.
+        """
+        records = self.records
+        keep = (records["area"] >= min_area) & (records["length"] >= min_length) & (records["points"] >= min_points)
+        if max_area is not None:
+            keep &= records["area"] <= max_area
+        if max_length is not None:
+            keep &= records["length"] <= max_length
+        return self.select(keep)
+
+    def hulls(self):
+        """
+        Convex hull of every contour, as a list of (n, 1, 2) int32 arrays. Computed once.
+        """
+        if self._hulls is None:
+            self._hulls = [cv2.convexHull(contour) for contour in self.contours()]
+        return self._hulls
+
+    def hull_areas(self):
+        return np.array([cv2.contourArea(hull) for hull in self.hulls()], dtype=np.float64)
+
+    def solidity(self):
+        """
+        Contour area / hull area, 0 for contours without area.
+        """
+        hull_areas = self.hull_areas()
+        return np.divide(self.records["area"], hull_areas, out=np.zeros(len(self)), where=hull_areas > 0)
+
+    def approximate(self, epsilon=1.0, relative=False):
+        """
+        The contours simplified with approxPolyDP, `epsilon` in pixels or, with `relative`, as a
+        fraction of the arc length of each contour.
+        """
+        epsilons = self.records["length"] * epsilon if relative else np.full(len(self), float(epsilon))
+        contours = [cv2.approxPolyDP(contour, e, True) for contour, e in zip(self.contours(), epsilons)]
+        approximated = ContourSet.from_contours(contours, None, self.shape)
+        approximated.records["parent"] = self.records["parent"]
+        return approximated
+
+    def render(self, image=None, color=255, thickness=1, hulls=False):
+        """
+        Draws all contours (or their hulls) with a single cv2 call.
+
+        Args:
+            image (np.ndarray): Image to draw on, by default a new single channel uint8 image.
+            color: Line color, a scalar or BGR(A) tuple.
+            thickness (int): Line thickness, -1 fills the contours (even-odd, holes stay empty).
+
+        Returns:
+            np.ndarray: The image.
+        """
+        if image is None:
+            image = np.zeros(self.shape, dtype=np.uint8)
+        contours = self.hulls() if hulls else self.contours()
+        if not contours:
+            return image
+        if thickness < 0:
+            cv2.fillPoly(image, contours, color)
+        else:
+            cv2.polylines(image, contours, True, color, thickness)
+        return image
+
+
+def contour_records(points, offsets):
+    """
+    CONTOUR_RECORD of every contour of the (N, 2) `points`, contour i being
+    points[offsets[i]:offsets[i + 1]]. The "parent" field is left at 0.
+    """
+    count = len(offsets) - 1
+    records = np.zeros(count, dtype=CONTOUR_RECORD)
+    if count == 0:
+        return records
+    starts = offsets[:-1]
+    counts = np.diff(offsets)
+    x = points[:, 0].astype(np.float64)
+    y = points[:, 1].astype(np.float64)
+
+    # the next point of the closed contour: the following one, or the first at the end
+    next_index = np.arange(1, len(points) + 1)
+    next_index[offsets[1:] - 1] = starts
+    xn, yn = x[next_index], y[next_index]
+
+    # moments of the polygon by Green's theorem, the same formulas as cv2.moments
+    cross = x * yn - xn * y
+    m00 = np.add.reduceat(cross, starts) / 2
+    m10 = np.add.reduceat(cross * (x + xn), starts) / 6
+    m01 = np.add.reduceat(cross * (y + yn), starts) / 6
+    m20 = np.add.reduceat(cross * (x * (x + xn) + xn * xn), starts) / 12
+    m11 = np.add.reduceat(cross * (x * (2 * y + yn) + xn * (y + 2 * yn)), starts) / 24
+    m02 = np.add.reduceat(cross * (y * (y + yn) + yn * yn), starts) / 12
+    # the sign depends on the orientation of the contour
+    sign = np.where(m00 < 0, -1.0, 1.0)
+    m00, m10, m01, m20, m11, m02 = (sign * m for m in (m00, m10, m01, m20, m11, m02))
+
+    degenerate = np.abs(m00) <= np.finfo(np.float32).eps
+    safe_m00 = np.where(degenerate, 1.0, m00)
+    cx = np.where(degenerate, np.add.reduceat(x, starts) / counts, m10 / safe_m00)
+    cy = np.where(degenerate, np.add.reduceat(y, starts) / counts, m01 / safe_m00)
+
+    records["points"] = counts
+    records["area"] = m00
+    records["length"] = np.add.reduceat(np.hypot(xn - x, yn - y), starts)
+    records["cx"] = cx
+    records["cy"] = cy
+    records["mu20"] = np.where(degenerate, 0.0, m20 - cx * m10)
+    records["mu11"] = np.where(degenerate, 0.0, m11 - cx * m01)
+    records["mu02"] = np.where(degenerate, 0.0, m02 - cy * m01)
+    x0 = np.minimum.reduceat(points[:, 0], starts)
+    y0 = np.minimum.reduceat(points[:, 1], starts)
+    records["x"] = x0
+    records["y"] = y0
+    records["w"] = np.maximum.reduceat(points[:, 0], starts) - x0 + 1
+    records["h"] = np.maximum.reduceat(points[:, 1], starts) - y0 + 1
+    return records
+
+
+def find_contours(image, threshold=None, mode=cv2.RETR_TREE, method=cv2.CHAIN_APPROX_SIMPLE):
+    """
+    Traces the contours of an image.
+
+    Args:
+        image (np.ndarray): BGR or grayscale image, or a binary mask.
+        threshold (int): Fixed threshold (0-255), by default the adaptive threshold of
+            threshold_image. Use 0 for a binary mask.
+        mode (int): Contour retrieval mode of cv2.findContours.
+        method (int): Contour approximation method of cv2.findContours.
+
+    Returns:
+        ContourSet: The contours.
+    """
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if gray.dtype != np.uint8:
+        gray = (gray > 0).astype(np.uint8) * 255
+    binary = threshold_image(gray, threshold)
+    contours, hierarchy = cv2.findContours(binary, mode, method)
+    return ContourSet.from_contours(contours, hierarchy, binary.shape)
@@ -0,0 +1,230 @@
+"""
+Compact encodings of outlines for the transport to the headset.
+
+Outlines are strictly two-valued (opaque line pixels on a transparent background), so they can be
+sent as a line mask instead of a 4-channel image:
+ - png:     RGBA PNG with maximum compression
+ - bilevel: 1-bit grayscale PNG, black lines on white
+ - webp:    lossless RGBA WebP
+ - bits:    header + the mask packed to 1 bit per pixel (np.packbits, rows are not padded)
+ - rle:     header + lengths of alternating background / line runs over the flattened mask,
+            starting with background, as LEB128 varints
+ - polylines: boundaries of the lines as delta-coded int16 polylines (see src.vector)
+
+The headers of bits and rle are a 4-byte magic followed by width and height as little-endian uint32.
+"""
+import struct
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from src.vector import TOLERANCE, decode_polylines, encode_polylines, extract_polylines, render_polylines
+
+BITS_MAGIC = b"PAB1"
+RLE_MAGIC = b"PAR1"
+_HEADER = struct.Struct("<4sII")
+
+# mime type of each format, used for content negotiation
+FORMATS = {
+    "png": "image/png",
+    "bilevel": "image/png",
+    "webp": "image/webp",
+    "bits": "application/x-outline-bits",
+    "rle": "application/x-outline-rle",
+    "polylines": "application/x-outline-polylines",
+}
+
+
+def outline_mask(rgba_image):
+    """
+    Line pixels of an outline (the opaque ones) as a boolean mask.
+    """
+    if rgba_image.ndim == 3 and rgba_image.shape[2] == 4:
+        return rgba_image[:, :, 3] > 127
+    # images without alpha: dark pixels are lines
+    gray = rgba_image if rgba_image.ndim == 2 else cv2.cvtColor(rgba_image, cv2.COLOR_BGR2GRAY)
+    return gray < 128
+
+
+def mask_to_rgba(mask):
+    """
+    Black lines on a transparent background, like the outlines written by edge_detection.
+    """
+    binary_image = mask.astype(np.uint8) * 255
+    inverted_image = 255 - binary_image
+    return cv2.merge([inverted_image, inverted_image, inverted_image, binary_image])
+
+
+def encode_outline(rgba_image, fmt, tolerance=TOLERANCE):
+    """
+    Encodes an outline in one of FORMATS. `tolerance` is the simplification tolerance (pixels) of
+    the polylines format.
+
+    Returns:
+        bytes: The encoded outline.
+    """
+    if fmt == "png":
+        return _imencode(".png", rgba_image, [cv2.IMWRITE_PNG_COMPRESSION, 9])
+    mask = outline_mask(rgba_image)
+    if fmt == "bilevel":
+        return _imencode(".png", np.where(mask, 0, 255).astype(np.uint8),
+                         [cv2.IMWRITE_PNG_BILEVEL, 1, cv2.IMWRITE_PNG_COMPRESSION, 9])
+    if fmt == "webp":
+        return _imencode(".webp", mask_to_rgba(mask), [cv2.IMWRITE_WEBP_QUALITY, 101])
+    if fmt == "bits":
+        return encode_bits(mask)
+    if fmt == "rle":
+        return encode_rle(mask)
+    if fmt == "polylines":
+        (H, W) = mask.shape
+        return encode_polylines(extract_polylines(mask, tolerance), W, H)
+    raise ValueError(f"unknown format \"{fmt}\", expected one of {list(FORMATS)}")
+
+
+def decode_outline(data, fmt):
+    """
+    Decodes an outline encoded with encode_outline into its line mask.
+    """
+    if fmt in ("png", "bilevel", "webp"):
+        return outline_mask(cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED))
+    if fmt == "bits":
+        return decode_bits(data)
+    if fmt == "rle":
+        return decode_rle(data)
+    if fmt == "polylines":
+        return render_polylines(*decode_polylines(data)) > 0
+    raise ValueError(f"unknown format \"{fmt}\", expected one of {list(FORMATS)}")
+
+
+def _imencode(ext, image, params):
+    ok, encoded = cv2.imencode(ext, image, params)
+    if not ok:
+        raise ValueError(f"could not encode the outline as {ext}")
+    return encoded.tobytes()
+
+
+def encode_bits(mask):
+    (H, W) = mask.shape
+    return _HEADER.pack(BITS_MAGIC, W, H) + np.packbits(mask, axis=None).tobytes()
+
+
+def decode_bits(data):
+    magic, W, H = _HEADER.unpack_from(data)
+    if magic != BITS_MAGIC:
+        raise ValueError("not a packed outline")
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8, offset=_HEADER.size), count=W * H)
+    return bits.reshape(H, W).astype(bool)
+
+
+def encode_rle(mask):
+    (H, W) = mask.shape
+    flat = mask.ravel()
+    # positions where the value changes, the first run is background and may be empty
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate(([0], changes, [flat.size]))
+    runs = np.diff(bounds)
+    if flat.size and flat[0]:
+        runs = np.concatenate(([0], runs))
+    return _HEADER.pack(RLE_MAGIC, W, H) + _encode_varints(runs.astype(np.uint64)).tobytes()
+
+
+def decode_rle(data):
+    magic, W, H = _HEADER.unpack_from(data)
+    if magic != RLE_MAGIC:
+        raise ValueError("not a run-length encoded outline")
+    runs = _decode_varints(np.frombuffer(data, dtype=np.uint8, offset=_HEADER.size))
+    values = np.arange(runs.size) % 2 == 1  # runs alternate, starting with background
+    return np.repeat(values, runs).reshape(H, W)
+
+
+def _encode_varints(values):
+    # LEB128: 7 bits per byte, the high bit marks that more bytes follow
+    n_bytes = np.ones(values.size, dtype=np.int64)
+    for k in range(1, 10):
+        n_bytes += values >= (1 << (7 * k))
+    offsets = np.concatenate(([0], np.cumsum(n_bytes)[:-1]))
+    out = np.empty(int(n_bytes.sum()), dtype=np.uint8)
+    for k in range(int(n_bytes.max(initial=1))):
+        has_byte = n_bytes > k
+        chunk = (values[has_byte] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        more = (n_bytes[has_byte] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[offsets[has_byte] + k] = (chunk | more).astype(np.uint8)
+    return out
+
+
+def _decode_varints(data):
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    lengths = ends - starts + 1
+    values = np.zeros(ends.size, dtype=np.int64)
+    for k in range(int(lengths.max(initial=0))):
+        has_byte = lengths > k
+        values[has_byte] |= (data[starts[has_byte] + k].astype(np.int64) & 0x7F) << (7 * k)
+    return values
+
+
+def negotiate_format(requested, accept_mimetypes):
+    """
+    Picks the format of a response from the `format` query parameter or the Accept header.
+
+    Returns:
+        str: One of FORMATS, or None to send the image as stored.
+
+    Raises:
+        ValueError: If an unknown format is requested.
+    """
+    if requested is not None:
+        if requested not in FORMATS:
+            raise ValueError(f"unknown format \"{requested}\", expected one of {list(FORMATS)}")
+        return requested
+    # the stored PNG is preferred, unless the client ranks one of the compact types higher
+    compact = ("webp", "bits", "rle", "polylines")
+    best = accept_mimetypes.best_match(["image/png"] + [FORMATS[fmt] for fmt in compact])
+    for fmt in compact:
+        if best == FORMATS[fmt]:
+            return fmt
+    return None
+
+
+class EncodingCache(object):
+    """
+    LRU of encoded outlines, keyed on the source file (path, modification time and size), the
+    format and its options, bounded by the total size of the encodings.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, path, stat, fmt, **options):
+        """
+        Returns the outline at `path` encoded as `fmt`, encoding it on a miss. `options` are passed
+        on to encode_outline.
+        """
+        key = (path, stat.st_mtime_ns, stat.st_size, fmt, tuple(sorted(options.items())))
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        rgba_image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if rgba_image is None:
+            raise ValueError(f"could not read image at {path}")
+        data = encode_outline(rgba_image, fmt, **options)
+
+        with self._lock:
+            if key not in self._entries and len(data) <= self.max_bytes:
+                self._entries[key] = data
+                self._bytes += len(data)
+                while self._bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._bytes -= len(evicted)
+        return data
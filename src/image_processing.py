@@ -1,12 +1,47 @@
 import cv2
 import numpy as np
-import matplotlib
-matplotlib.use('agg')
-import matplotlib.pyplot as plt
-from matplotlib.widgets import Slider
-from tqdm import tqdm
 
 import os
+import time
+
+from src.cache import cache_key
+from src.contours import find_contours
+from src.latency import LatencyModel, inference_size, resolve_budget
+from src.metrics import info_stages, stage
+from src.store import PackedStore, outline_key, probability_key
+
+MODEL_ID = "hed_pretrained_bsds"
+THRESHOLD = 64  # minimum HED response (0-255) for a pixel to be part of the outline
+BORDER_THICKNESS = 10  # pixels at the image border that are never part of the outline
+TILE_OVERLAP = 128  # pixels shared by neighbouring tiles in tiled inference
+STEP_THRESHOLDS = (192, 128, THRESHOLD)  # thresholds of the stepwise outlines, coarse to fine
+# edge detectors: the HED network, and the classical "fast" tier that needs no network
+EDGE_METHODS = ("hed", "sobel", "canny")
+WARMUP_SIZE = 128  # side of the blank image of the warm-up pass
+# batched images are padded to multiples of this size, equal sizes share a forward pass. 1 only
+# batches images of the same size, which gives exactly the results of single passes
+BATCH_BUCKET = 1
+MAX_BATCH = 8  # images per batched forward pass
+# DNN backends and targets that can be selected by name, which ones work depends on the OpenCV build
+DNN_BACKENDS = {
+    "default": cv2.dnn.DNN_BACKEND_DEFAULT,
+    "opencv": cv2.dnn.DNN_BACKEND_OPENCV,
+    "inference_engine": cv2.dnn.DNN_BACKEND_INFERENCE_ENGINE,
+    "cuda": cv2.dnn.DNN_BACKEND_CUDA,
+}
+DNN_TARGETS = {
+    "cpu": cv2.dnn.DNN_TARGET_CPU,
+    "opencl": cv2.dnn.DNN_TARGET_OPENCL,
+    "opencl_fp16": cv2.dnn.DNN_TARGET_OPENCL_FP16,
+    "cuda": cv2.dnn.DNN_TARGET_CUDA,
+    "cuda_fp16": cv2.dnn.DNN_TARGET_CUDA_FP16,
+}
+CANNY_SIGMA = 0.33  # the Canny thresholds are (1 -+ sigma) * median intensity
+# outlines are mostly long runs of transparent pixels, fast RLE compression suits them best
+OUTLINE_PNG_PARAMS = [cv2.IMWRITE_PNG_COMPRESSION, 1, cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_RLE]
+
+# forward pass latency measured in this process
+_latency_model = LatencyModel()
 
 class CropLayer(object):
     def __init__(self, params, blobs):
@@ -38,14 +73,51 @@ class CropLayer(object):
         return [inputs[0][:, :, self.startY:self.endY,
                 self.startX:self.endX]]
 
-def init_net():
+_crop_layer_registered = False
+
+
+def register_crop_layer():
+    # registering a layer type twice aborts the process, e.g. when a second network is loaded
+    global _crop_layer_registered
+    if not _crop_layer_registered:
+        cv2.dnn_registerLayer("Crop", CropLayer)
+        _crop_layer_registered = True
+
+
+def init_net(backend=None, target=None):
     # load our serialized edge detector from disk
     protoPath = "src/model/deploy.prototxt"
-    modelPath = "src/model/hed_pretrained_bsds.caffemodel"
-    cv2.dnn_registerLayer("Crop", CropLayer)
+    modelPath = f"src/model/{MODEL_ID}.caffemodel"
+    register_crop_layer()
     net = cv2.dnn.readNetFromCaffe(protoPath, modelPath)
+    set_dnn_target(net, backend, target)
     return net
 
+
+def set_dnn_target(net, backend=None, target=None):
+    """
+    Selects the DNN backend and target device (names of DNN_BACKENDS / DNN_TARGETS), None keeps
+    the OpenCV default (the OpenCV backend on the CPU).
+    """
+    if backend is not None:
+        if backend not in DNN_BACKENDS:
+            raise ValueError(f"unknown DNN backend \"{backend}\", expected one of {list(DNN_BACKENDS)}")
+        net.setPreferableBackend(DNN_BACKENDS[backend])
+    if target is not None:
+        if target not in DNN_TARGETS:
+            raise ValueError(f"unknown DNN target \"{target}\", expected one of {list(DNN_TARGETS)}")
+        net.setPreferableTarget(DNN_TARGETS[target])
+
+
+def warm_up(net, size=WARMUP_SIZE):
+    """
+    Runs the network once on a small blank image, so the one-time initialisation of the layers
+    is not paid by the first real image. Returns the time it took (ms).
+    """
+    start = time.perf_counter()
+    hed_probability(np.zeros((size, size, 3), dtype=np.uint8), net)
+    return 1000 * (time.perf_counter() - start)
+
 def preprocess_image(image):
     # Enhance contrast with CLAHE
     clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
@@ -65,47 +137,465 @@ def preprocess_image(image):
     return sharpened_image
 
 
-def edge_detection(image_path, image, net, save_path=None):
+def edge_detection(image_path, image, net, save_path=None, threshold=THRESHOLD,
+                   border_thickness=BORDER_THICKNESS, tile_size=None, tile_overlap=TILE_OVERLAP,
+                   tiles_per_batch=1, budget_ms=None, quality=None, latency_model=None, cache=None,
+                   probability_store=None, buffers=None, info=None, method="hed"):
+    """
+    Computes the transparent outline of an image with HED, or with one of the classical edge
+    detectors of the fast tier (`method` "sobel" or "canny", see classical_edges), which need no
+    network and take a few milliseconds. Results of the fast tier are not cached.
+
+    With a latency budget (`budget_ms`, or a `quality` tier) the network runs on a downscaled copy
+    of the image, sized by the latency model, and the edge map is scaled back to the image size.
+    If a `probability_store` is given, the edge map is kept in it under the file name of the image,
+    so the outline can be restyled later without running the network again.
+    If `info` is a dict, it is filled with details about the run, e.g. the inference size used and
+    the time spent in each stage (ms, in info["stages"]).
+    With `buffers`, the outline is written into reusable arrays (see OutlineBuffers).
+    The outline and the edge map are saved as PNG files into the folder `save_path`, or appended
+    to it if it is a PackedStore (see src.store).
+    """
+    if method not in EDGE_METHODS:
+        raise ValueError(f"unknown edge detection method \"{method}\", expected one of {list(EDGE_METHODS)}")
+    budget_ms = resolve_budget(budget_ms, quality)
+    stages = info_stages(info)
+    if method != "hed":
+        # computing the outline is cheaper than a cache lookup
+        cache = None
+    if cache is not None:
+        with stage(stages, "cache_lookup"):
+            key = outline_cache_key(image, threshold, border_thickness, tile_size, tile_overlap, budget_ms)
+            cached = cache.get(key)
+    else:
+        cached = None
+
+    if cached is not None:
+        rgba_image, hed = cached["rgba"], cached["hed"]
+        inference_wh = tuple(int(v) for v in cached["inference_size"])
+    elif method != "hed":
+        with stage(stages, method):
+            hed = classical_edges(image, method, buffers=buffers)
+        with stage(stages, "postprocess"):
+            rgba_image = outline_from_hed(hed, threshold, border_thickness, buffers=buffers)
+        inference_wh = tuple(image.shape[1::-1])
+    else:
+        probability, inference_wh = _adaptive_probability(image, net, budget_ms,
+                                                          latency_model or _latency_model,
+                                                          tile_size, tile_overlap, tiles_per_batch,
+                                                          stages)
+        with stage(stages, "postprocess"):
+            rgba_image, hed = outline_from_probability(probability, threshold, border_thickness,
+                                                       buffers=buffers)
+        if cache is not None:
+            with stage(stages, "cache_store"):
+                cache.put(key, {"rgba": rgba_image, "hed": hed, "inference_size": np.array(inference_wh)})
+
+    if probability_store is not None:
+        with stage(stages, "probability_store"):
+            probability_store.put(os.path.basename(image_path), hed)
+    if info is not None:
+        info["inference_size"] = inference_wh
+        info["cached"] = cached is not None
+
+    # Save the resulting RGBA image
+    # TODO: separate save folder
+    if save_path is not None:
+        file_name = image_path.split('/')[-1]
+        with stage(stages, "save"):
+            if isinstance(save_path, PackedStore):
+                save_path.put(outline_key(file_name), rgba_image, encoding="png")
+                save_path.put(probability_key(file_name), hed)
+            else:
+                cv2.imwrite(os.path.join(save_path, file_name[:-4] + '_transparent.png'), rgba_image)
+                cv2.imwrite(os.path.join(save_path, file_name[:-4] + '_hed.png'), hed)
+    return rgba_image
+
+
+def edge_detection_batch(image_paths, images, net, threshold=THRESHOLD, border_thickness=BORDER_THICKNESS,
+                         tile_size=None, tile_overlap=TILE_OVERLAP, tiles_per_batch=1, budget_ms=None,
+                         quality=None, latency_model=None, cache=None, probability_store=None, infos=None,
+                         method="hed", max_batch=MAX_BATCH, bucket=BATCH_BUCKET):
+    """
+    edge_detection of several images, returns their outlines (in the same order).
+
+    The images that are not cached and fit into one tile (after scaling to the latency budget)
+    run through the network together, see hed_probabilities. Larger images are processed one by
+    one with tiled inference. Outlines of padded images are not added to the cache.
+    `infos` is a list with an info dict (or None) per image.
+    """
+    infos = infos if infos is not None else [None] * len(images)
+    options = dict(threshold=threshold, border_thickness=border_thickness, tile_size=tile_size,
+                   tile_overlap=tile_overlap, tiles_per_batch=tiles_per_batch, budget_ms=budget_ms,
+                   quality=quality, latency_model=latency_model, cache=cache,
+                   probability_store=probability_store, method=method)
+    if method != "hed":
+        return [edge_detection(path, image, net, info=info, **options)
+                for path, image, info in zip(image_paths, images, infos)]
+    budget_ms = resolve_budget(budget_ms, quality)
+    latency_model = latency_model or _latency_model
+
+    outlines = [None] * len(images)
+    hed_maps = [None] * len(images)
+    inference_sizes = [None] * len(images)
+    keys = [None] * len(images)
+    batch = []  # indices of the images that run through the network together
+    for i, (path, image, info) in enumerate(zip(image_paths, images, infos)):
+        (H, W) = image.shape[:2]
+        inference_sizes[i] = inference_size(W, H, budget_ms, latency_model)
+        if tile_size is not None and max(inference_sizes[i]) > tile_size:
+            outlines[i] = edge_detection(path, image, net, info=info, **options)
+            continue
+        stages = info_stages(info)
+        cached = None
+        if cache is not None:
+            with stage(stages, "cache_lookup"):
+                keys[i] = outline_cache_key(image, threshold, border_thickness, tile_size, tile_overlap,
+                                            budget_ms)
+                cached = cache.get(keys[i])
+        if cached is not None:
+            outlines[i], hed_maps[i] = cached["rgba"], cached["hed"]
+            inference_sizes[i] = tuple(int(v) for v in cached["inference_size"])
+        else:
+            batch.append(i)
+        if info is not None:
+            info["cached"] = cached is not None
+
+    small_images = []
+    for i in batch:
+        (H, W) = images[i].shape[:2]
+        if inference_sizes[i] == (W, H):
+            small_images.append(images[i])
+        else:
+            with stage(info_stages(infos[i]), "downscale"):
+                small_images.append(cv2.resize(images[i], inference_sizes[i], interpolation=cv2.INTER_AREA))
+    batch_stages = [{} if infos[i] is None else info_stages(infos[i]) for i in batch]
+    start = time.perf_counter()
+    probabilities = hed_probabilities(small_images, net, max_batch, bucket, batch_stages)
+    if batch:
+        latency_model.record(sum(w * h for w, h in (inference_sizes[i] for i in batch)),
+                             1000 * (time.perf_counter() - start))
+
+    for i, probability in zip(batch, probabilities):
+        stages = info_stages(infos[i])
+        (H, W) = images[i].shape[:2]
+        if inference_sizes[i] != (W, H):
+            with stage(stages, "upscale"):
+                probability = cv2.resize(probability, (W, H), interpolation=cv2.INTER_LINEAR)
+        with stage(stages, "postprocess"):
+            outlines[i], hed_maps[i] = outline_from_probability(probability, threshold, border_thickness)
+        if cache is not None and batch_bucket(*inference_sizes[i], bucket) == inference_sizes[i]:
+            with stage(stages, "cache_store"):
+                cache.put(keys[i], {"rgba": outlines[i], "hed": hed_maps[i],
+                                    "inference_size": np.array(inference_sizes[i])})
+
+    for i, (path, info) in enumerate(zip(image_paths, infos)):
+        if hed_maps[i] is None:
+            continue  # processed by edge_detection
+        if probability_store is not None:
+            with stage(info_stages(info), "probability_store"):
+                probability_store.put(os.path.basename(path), hed_maps[i])
+        if info is not None:
+            info["inference_size"] = inference_sizes[i]
+    return outlines
+
+
+def outline_cache_key(image, threshold=THRESHOLD, border_thickness=BORDER_THICKNESS, tile_size=None,
+                      tile_overlap=TILE_OVERLAP, budget_ms=None, quality=None, method="hed", **_):
+    # other edge_detection options (e.g. tiles_per_batch) do not change the result
+    model = MODEL_ID if method == "hed" else method
+    params = dict(threshold=threshold, border_thickness=border_thickness, output="rgba", model=model)
+    # tiling changes the result slightly, the whole image is processed if it fits into one tile
+    if tile_size is not None and max(image.shape[:2]) > tile_size:
+        params.update(tile_size=tile_size, tile_overlap=tile_overlap)
+    budget_ms = resolve_budget(budget_ms, quality)
+    if budget_ms is not None:
+        params.update(budget_ms=budget_ms)
+    return cache_key(image, **params)
+
+
+def _adaptive_probability(image, net, budget_ms, latency_model, tile_size, tile_overlap,
+                          tiles_per_batch, stages=None):
     (H, W) = image.shape[:2]
-    blob = cv2.dnn.blobFromImage(image, scalefactor=1.0, size=(W, H),
+    (w, h) = inference_size(W, H, budget_ms, latency_model)
+    if (w, h) == (W, H):
+        small = image
+    else:
+        with stage(stages, "downscale"):
+            small = cv2.resize(image, (w, h), interpolation=cv2.INTER_AREA)
+
+    start = time.perf_counter()
+    probability = hed_probability(small, net, tile_size, tile_overlap, tiles_per_batch, stages)
+    latency_model.record(w * h, 1000 * (time.perf_counter() - start))
+
+    if (w, h) != (W, H):
+        with stage(stages, "upscale"):
+            probability = cv2.resize(probability, (W, H), interpolation=cv2.INTER_LINEAR)
+    return probability, (w, h)
+
+
+def _hed_blob(images):
+    return cv2.dnn.blobFromImages(images, scalefactor=1.0, size=images[0].shape[1::-1],
         mean=(104.00698793, 116.66876762, 122.67891434),
         swapRB=False, crop=False)
 
-    net.setInput(blob)
-    hed = net.forward()
-    hed = cv2.resize(hed[0, 0], (W, H))
-    hed = (255 * hed).astype("uint8")
-
-    # Create a mask for the inner region and set 10-pixels of border to 0
-    mask = np.ones_like(hed, dtype=np.uint8)
-    border_thickness = 10
-    mask[:border_thickness, :] = 0  # Top border
-    mask[-border_thickness:, :] = 0  # Bottom border
-    mask[:, :border_thickness] = 0  # Left border
-    mask[:, -border_thickness:] = 0  # Right border
-    cleaned_hed_output = cv2.bitwise_and(hed, hed, mask=mask)
-
-    # Turn every non-black pixel into pure white (strictly black and white image)
-    binary_image = np.where(cleaned_hed_output > 64, 255, 0).astype("uint8")
-    
-    # Invert the colors (black becomes white, white becomes black)
-    inverted_image = 255 - binary_image
 
-    # Convert to RGBA and make the white part transparent
-    rgba_image = cv2.cvtColor(inverted_image, cv2.COLOR_GRAY2BGRA)
-    rgba_image[:, :, 3] = np.where(inverted_image == 255, 0, 255)
+def hed_probability(image, net, tile_size=None, tile_overlap=TILE_OVERLAP, tiles_per_batch=1,
+                    stages=None):
+    """
+    Runs HED on an image and returns the edge probability map (float32, same size as the image).
 
-    # Save the resulting RGBA image
-    # TODO: separate save folder
-    if save_path is not None:
-        file_name = image_path.split('/')[-1]
-        cv2.imwrite(os.path.join(save_path, file_name[:-4] + '_transparent.png'), rgba_image)
-        cv2.imwrite(os.path.join(save_path, file_name[:-4] + '_hed.png'), hed)
+    The memory used by the network grows with the number of input pixels. If `tile_size` is
+    given, the image is split into overlapping tiles of at most tile_size x tile_size pixels,
+    which are processed `tiles_per_batch` at a time. The tile results are blended with weights
+    that fall off towards the tile borders, so the seams between tiles are not visible.
+    If `stages` is a dict, the time spent in each step is added to it (see src.metrics).
+    """
+    (H, W) = image.shape[:2]
+    if tile_size is None or max(H, W) <= tile_size:
+        with stage(stages, "blob"):
+            net.setInput(_hed_blob([image]))
+        with stage(stages, "forward"):
+            hed = net.forward()
+        with stage(stages, "resize"):
+            return cv2.resize(hed[0, 0], (W, H))
+
+    tile_h, tile_w = min(tile_size, H), min(tile_size, W)
+    tile_overlap = min(tile_overlap, tile_size // 2)
+    weights = np.outer(_blend_ramp(tile_h, tile_overlap), _blend_ramp(tile_w, tile_overlap))
+
+    origins = [(y, x) for y in _tile_starts(H, tile_h, tile_overlap)
+               for x in _tile_starts(W, tile_w, tile_overlap)]
+    probability = np.zeros((H, W), dtype=np.float32)
+    weight_sum = np.zeros((H, W), dtype=np.float32)
+    for i in range(0, len(origins), tiles_per_batch):
+        batch = origins[i:i + tiles_per_batch]
+        with stage(stages, "blob"):
+            net.setInput(_hed_blob([image[y:y + tile_h, x:x + tile_w] for (y, x) in batch]))
+        with stage(stages, "forward"):
+            hed = net.forward()
+        with stage(stages, "blend"):
+            for (y, x), tile in zip(batch, hed[:, 0]):
+                probability[y:y + tile_h, x:x + tile_w] += tile * weights
+                weight_sum[y:y + tile_h, x:x + tile_w] += weights
+    with stage(stages, "blend"):
+        probability /= weight_sum
+    return probability
+
+
+def batch_bucket(width, height, bucket=BATCH_BUCKET):
+    """
+    Size (width, height) an image is padded to in a batch, the images of a bucket run together.
+    """
+    return -(-width // bucket) * bucket, -(-height // bucket) * bucket
+
+
+def hed_probabilities(images, net, max_batch=MAX_BATCH, bucket=BATCH_BUCKET, stages=None):
+    """
+    Runs HED on several images and returns their edge probability maps (in the same order).
+
+    The images are grouped by size bucket (see batch_bucket) and padded to the size of their
+    bucket by repeating the last row and column, so up to `max_batch` of them run in one forward
+    pass. The padding is cut off the outputs again. Padding changes the edge map: the crop layers
+    align the side outputs of the network by centring them, which depends on the input size. It
+    is exact for images of the same size (bucket 1), and close if the sizes are multiples of 32.
+    If `stages` is a list with a dict per image, the time of every step is added to it, a step
+    shared by a batch is split evenly among its images.
+    """
+    probabilities = [None] * len(images)
+    groups = {}
+    for i, image in enumerate(images):
+        groups.setdefault(batch_bucket(image.shape[1], image.shape[0], bucket), []).append(i)
+    for (width, height), indices in groups.items():
+        for start in range(0, len(indices), max_batch):
+            batch = indices[start:start + max_batch]
+            batch_stages = {} if stages is not None else None
+            with stage(batch_stages, "pad"):
+                padded = [cv2.copyMakeBorder(images[i], 0, height - images[i].shape[0], 0,
+                                             width - images[i].shape[1], cv2.BORDER_REPLICATE)
+                          for i in batch]
+            with stage(batch_stages, "blob"):
+                net.setInput(_hed_blob(padded))
+            with stage(batch_stages, "forward"):
+                hed = net.forward()
+            with stage(batch_stages, "unpad"):
+                for i, output in zip(batch, hed[:, 0]):
+                    (H, W) = images[i].shape[:2]
+                    probabilities[i] = np.ascontiguousarray(output[:H, :W])
+            if stages is not None:
+                for i in batch:
+                    for name, ms in batch_stages.items():
+                        stages[i][name] = stages[i].get(name, 0.0) + ms / len(batch)
+    return probabilities
+
+
+def _tile_starts(length, tile, overlap):
+    # evenly spaced tiles covering [0, length), neighbouring tiles overlap by at least `overlap`
+    if length <= tile:
+        return [0]
+    count = int(np.ceil((length - overlap) / (tile - overlap)))
+    return np.linspace(0, length - tile, count).round().astype(int).tolist()
+
+
+def _blend_ramp(length, overlap):
+    # 1 in the middle of the tile, falling off linearly over `overlap` pixels towards the borders
+    ramp = np.ones(length, dtype=np.float32)
+    if overlap > 0:
+        fade = (np.arange(overlap, dtype=np.float32) + 0.5) / overlap
+        ramp[:overlap] = fade
+        ramp[-overlap:] = np.minimum(ramp[-overlap:], fade[::-1])
+    return ramp
+
+
+class OutlineBuffers(object):
+    """
+    Reusable output arrays for the outline post-processing, one set per worker.
+
+    Arrays returned by functions that write into the buffers are overwritten by the next call,
+    copy them to keep them.
+    """
+
+    def __init__(self):
+        self._arrays = {}
+
+    def get(self, name, shape, dtype):
+        array = self._arrays.get(name)
+        if array is None or array.shape != shape or array.dtype != dtype:
+            array = np.empty(shape, dtype=dtype)
+            self._arrays[name] = array
+        return array
+
+
+def classical_edges(image, method="canny", blur_sigma=1.0, canny_sigma=CANNY_SIGMA, buffers=None):
+    """
+    Edge map (uint8, like the scaled HED output) of a BGR image with a classical edge detector:
+     - sobel: gradient magnitude of the blurred image (float32), scaled so the strongest edge is 255
+     - canny: Canny with thresholds derived from the median intensity, edges are 255
+
+    All intermediate results are written into `buffers` (see OutlineBuffers).
+    """
+    buffers = buffers or OutlineBuffers()
+    (H, W) = image.shape[:2]
+    gray = buffers.get("gray", (H, W), np.uint8)
+    edges = buffers.get("edges", (H, W), np.uint8)
+    if image.ndim == 3:
+        cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=gray)
+    else:
+        np.copyto(gray, image)
+    if blur_sigma > 0:
+        cv2.GaussianBlur(gray, (0, 0), blur_sigma, dst=gray)
+
+    if method == "sobel":
+        gx = buffers.get("gx", (H, W), np.float32)
+        gy = buffers.get("gy", (H, W), np.float32)
+        magnitude = buffers.get("magnitude", (H, W), np.float32)
+        cv2.Sobel(gray, cv2.CV_32F, 1, 0, dst=gx, ksize=3)
+        cv2.Sobel(gray, cv2.CV_32F, 0, 1, dst=gy, ksize=3)
+        cv2.magnitude(gx, gy, magnitude=magnitude)
+        peak = cv2.minMaxLoc(magnitude)[1]
+        cv2.convertScaleAbs(magnitude, dst=edges, alpha=255.0 / peak if peak > 0 else 0.0)
+    elif method == "canny":
+        # the median from the histogram is O(pixels), without sorting
+        cumulative = np.cumsum(cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel())
+        median = int(np.searchsorted(cumulative, cumulative[-1] / 2))
+        lower = max(0, int((1.0 - canny_sigma) * median))
+        upper = min(255, max(lower + 1, int((1.0 + canny_sigma) * median)))
+        cv2.Canny(gray, lower, upper, edges=edges)
+    else:
+        raise ValueError(f"unknown classical edge detector \"{method}\", expected sobel or canny")
+    return edges
+
+
+def outline_from_probability(probability, threshold=THRESHOLD, border_thickness=BORDER_THICKNESS,
+                             line_thickness=1, color=(0, 0, 0), buffers=None):
+    buffers = buffers or OutlineBuffers()
+    scaled = buffers.get("scaled", probability.shape, np.float32)
+    hed = buffers.get("hed", probability.shape, np.uint8)
+    np.multiply(probability, 255, out=scaled)
+    np.copyto(hed, scaled, casting="unsafe")  # truncates like astype
+    return outline_from_hed(hed, threshold, border_thickness, line_thickness, color, buffers), hed
+
+
+def outline_from_hed(hed, threshold=THRESHOLD, border_thickness=BORDER_THICKNESS, line_thickness=1,
+                     color=(0, 0, 0), buffers=None):
+    """
+    Turns a HED edge map (uint8) into an outline: pixels above `threshold` become lines of the
+    given BGR `color` and `line_thickness`, everything else is transparent.
+
+    All intermediate results are written into `buffers`, so repeated calls on images of the same
+    size do not allocate.
+    """
+    buffers = buffers or OutlineBuffers()
+    (H, W) = hed.shape
+    binary_image = buffers.get("binary", (H, W), np.uint8)
+    inverted_image = buffers.get("inverted", (H, W), np.uint8)
+    rgba_image = buffers.get("rgba", (H, W, 4), np.uint8)
+
+    # Turn every pixel above the threshold into pure white (strictly black and white image)
+    cv2.threshold(hed, threshold, 255, cv2.THRESH_BINARY, dst=binary_image)
+
+    # Set the border pixels to 0
+    if border_thickness > 0:
+        binary_image[:border_thickness, :] = 0  # Top border
+        binary_image[-border_thickness:, :] = 0  # Bottom border
+        binary_image[:, :border_thickness] = 0  # Left border
+        binary_image[:, -border_thickness:] = 0  # Right border
+
+    if line_thickness > 1:
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (line_thickness, line_thickness))
+        cv2.dilate(binary_image, kernel, dst=binary_image)
+
+    # Lines are opaque, everything else is transparent. Black lines on white are the inverted
+    # binary image, the color of the transparent pixels does not matter for other colors
+    if tuple(color) == (0, 0, 0):
+        cv2.bitwise_not(binary_image, dst=inverted_image)
+        cv2.merge([inverted_image, inverted_image, inverted_image, binary_image], dst=rgba_image)
+    else:
+        rgba_image[:, :, :3] = color
+        rgba_image[:, :, 3] = binary_image
     return rgba_image
+
+
+
+def stepwise_outlines(hed, thresholds=STEP_THRESHOLDS, border_thickness=BORDER_THICKNESS,
+                      line_thickness=1, color=(0, 0, 0), buffers=None):
+    """
+    Generates a series of outlines from coarse to fine out of one HED edge map (uint8): the
+    strongest edges first, then the weaker ones down to the lowest threshold.
+
+    Every layer only contains the strokes that are new compared to all previous layers, the lines
+    of earlier layers are transparent. Layers are computed lazily, one per iteration.
+
+    Yields:
+        tuple: (threshold, RGBA layer). The layer is overwritten by the next one, copy it to keep it.
+    """
+    buffers = buffers or OutlineBuffers()
+    drawn = buffers.get("drawn", hed.shape, np.uint8)
+    new_lines = buffers.get("new_lines", hed.shape, np.uint8)
+    drawn.fill(0)
+    for threshold in sorted(set(thresholds), reverse=True):
+        rgba_image = outline_from_hed(hed, threshold, border_thickness, line_thickness, color,
+                                      buffers=buffers)
+        # the alpha channel is the line mask, keep only the lines not drawn yet
+        cv2.bitwise_not(drawn, dst=new_lines)
+        cv2.bitwise_and(rgba_image[:, :, 3], new_lines, dst=new_lines)
+        cv2.bitwise_or(drawn, rgba_image[:, :, 3], dst=drawn)
+        rgba_image[:, :, 3] = new_lines
+        yield threshold, rgba_image
             
 
+def _pyplot():
+    # matplotlib is only needed by the plotting functions below, importing it takes longer than
+    # everything else the server needs
+    import matplotlib
+    matplotlib.use('agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
 # based on https://medium.com/swlh/contours-in-images-a58b4c12c0ff
 def contour_moments(image, save_path=None):
+    plt = _pyplot()
     img = cv2.imread(image, 1)
     imgray = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
     thresh = cv2.adaptiveThreshold(imgray,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,11,2)
@@ -138,7 +628,8 @@ def contour_moments(image, save_path=None):
 
     plt.show()
 
-def contour_length_based(image, save_path=None):
+def contour_length_based(image, save_path=None, index=6):
+    plt = _pyplot()
     img = cv2.imread(image, 0)
     thresh=cv2.adaptiveThreshold(img,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,11,2)
     contours, hierarchy= cv2.findContours(thresh,cv2.RETR_TREE,cv2.CHAIN_APPROX_SIMPLE);
@@ -152,7 +643,7 @@ def contour_length_based(image, save_path=None):
     # plt.imshow(img_with_contours[:,:,::-1])
 
     # contour
-    cnt = contours[6]
+    cnt = contours[index]
     epsilon = 0.1*cv2.arcLength(cnt,True)
     approx = cv2.approxPolyDP(cnt,epsilon,True)
 
@@ -171,25 +662,16 @@ def contour_length_based(image, save_path=None):
     plt.show()
 
 def contour_convex_hull(image, save_path=None):
-    img = cv2.imread(image, 0)  
-    thresh = cv2.adaptiveThreshold(img,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,11,2) 
-    contours, hierarchy = cv2.findContours(thresh,cv2.RETR_TREE,cv2.CHAIN_APPROX_SIMPLE)
-    hull = []
-    
-    # calculate points for each contour
-    for i in range(len(contours)):
-        # creating convex hull object for each contour
-        hull.append(cv2.convexHull(contours[i], False))
-    drawing = np.zeros((thresh.shape[0], thresh.shape[1], 3), np.uint8)
-    
-    # draw contours and hull points
-    for i in tqdm(range(len(contours)), desc='computing convex hulls'):
-        color_contours = (0, 255, 0) # green - color for contours
-        color = (255, 0, 0) # blue - color for convex hull
-        # draw ith contour
-        cv2.drawContours(drawing, contours, i, color_contours, 1, 8, hierarchy)
-        # draw ith convex hull object
-        cv2.drawContours(drawing, hull, i, color, 1, 8)
+    plt = _pyplot()
+    img = cv2.imread(image, 0)
+    # adaptive threshold and RETR_TREE as in the other contour functions
+    contour_set = find_contours(img)
+    drawing = np.zeros((img.shape[0], img.shape[1], 3), np.uint8)
+
+    # all contours and all hulls with one draw call each, drawing them one by one with
+    # drawContours(contours, i) converts the whole contour list on every call
+    contour_set.render(drawing, (0, 255, 0), 1)  # green - color for contours
+    contour_set.render(drawing, (255, 0, 0), 1, hulls=True)  # blue - color for convex hull
     plt.figure(figsize=(8, 8))
     plt.imshow(drawing[:,:,::-1])
 
@@ -198,7 +680,8 @@ def contour_convex_hull(image, save_path=None):
     plt.show()
 
 
-def bounding_contour(image, save_path=None):
+def bounding_contour(image, save_path=None, index=1):
+    plt = _pyplot()
     img = cv2.imread(image, 0)
 
     # Change thresholding and check 
@@ -211,7 +694,7 @@ def bounding_contour(image, save_path=None):
     # drawing contours over original image 
     img_with_contours = img.copy() 
     img_with_contours = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-    cv2.drawContours(img_with_contours, contours, 1, (0,255,0), 3) 
+    cv2.drawContours(img_with_contours, contours, index, (0,255,0), 3) 
 
     # Talk about (0, 255, 0) colors   
     plt.figure(figsize=(8, 8)) 
@@ -223,6 +706,7 @@ def bounding_contour(image, save_path=None):
 
 
 def sobel_filter(image, save_path=None):
+    plt = _pyplot()
     # Read the image
     img = cv2.imread(image)
 
@@ -280,6 +764,8 @@ def sobel_filter(image, save_path=None):
 
 
 def sobel_interactive(image, save_path=None):
+    plt = _pyplot()
+    from matplotlib.widgets import Slider
 
     # Read the image
     img = cv2.imread(image)
@@ -387,11 +873,11 @@ def sobel_interactive(image, save_path=None):
         slider_dy.set_val(dy)
 
         # Update Sobel X
-        sobelx = apply_sobel(dx, 0, ksize_x)
+        sobelx = apply_sobel(dx, 0, ksize_x, 'x')
         im_sobelx.set_data(sobelx)
 
         # Update Sobel Y
-        sobely = apply_sobel(0, dy, ksize_y)
+        sobely = apply_sobel(0, dy, ksize_y, 'y')
         im_sobely.set_data(sobely)
 
         # Update Combined Gradient
@@ -410,23 +896,6 @@ def sobel_interactive(image, save_path=None):
     
 
 if __name__ == '__main__':
-    # Folder containing the images
-    image_folder = "./images/raw"
-    net = init_net()
-
-    # Loop through each file in the folder
-    for file_name in os.listdir(image_folder):
-        file_path = os.path.join(image_folder, file_name)
-        
-        if file_name.lower().endswith(('.png', '.jpg')):
-            print(f"\nProcessing file: {file_path}")
-            image = cv2.imread(file_path)
-
-            # optional preprocessing: i tried it, but the results were not good
-            # image = preprocess_image(image)
-            edge_detection_output = edge_detection(file_path, image, net, save_path='output')
-
-            # Display the processed image
-            cv2.imshow("Processed Image", edge_detection_output)
-            key = cv2.waitKey(0)
-            cv2.destroyAllWindows()
\ No newline at end of file
+    # outlines of all raw images, processed in parallel without any windows (see src/batch.py)
+    from src.batch import main
+    main()
@@ -0,0 +1,442 @@
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from src.cache import ProbabilityStore, ResultCache
+from src.image_processing import (BATCH_BUCKET, OUTLINE_PNG_PARAMS, OutlineBuffers, edge_detection,
+                                  edge_detection_batch, init_net, outline_cache_key, warm_up)
+from src.metrics import stage
+from src.scheduler import AdmissionControl, configure_threads, thread_budget
+from src.store import outline_key
+
+BATCH_WINDOW_MS = 10  # how long the first image of a batch waits for more images
+
+# every worker process keeps its own instance of the network and its own in-memory caches,
+# the files on disk are shared
+_net = None
+_cache = None
+_probability_store = None
+_buffers = OutlineBuffers()
+
+
+def _init_worker(cache_folder, probability_folder, ready=None, num_threads=None, backend=None, target=None):
+    global _net, _cache, _probability_store
+    configure_threads(num_threads)
+    _net = init_net(backend, target)
+    warm_up(_net)
+    if cache_folder is not None:
+        _cache = ResultCache(cache_folder)
+    if probability_folder is not None:
+        _probability_store = ProbabilityStore(probability_folder, max_memory_items=0)
+    if ready is not None:
+        with ready.get_lock():
+            ready.value += 1
+
+
+def _noop():
+    pass
+
+
+def _encode_png(rgba_image):
+    ok, png = cv2.imencode('.png', rgba_image, OUTLINE_PNG_PARAMS)
+    if not ok:
+        raise ValueError("could not encode the processed image")
+    return png.tobytes()
+
+
+def _process_job(name, image, options, persist=True):
+    # runs inside a worker process, the decoded image is passed in and the encoded result is
+    # returned, nothing goes through the disk
+    info = {"stages": {}}
+    rgba_image = edge_detection(name, image, _net, cache=_cache if persist else None,
+                                probability_store=_probability_store if persist else None,
+                                buffers=_buffers, info=info, **options)
+    with stage(info["stages"], "encode"):
+        png = _encode_png(rgba_image)
+    return png, info
+
+
+def _process_batch(names, images, options, persist=True):
+    # runs inside a worker process, like _process_job for images that share their options
+    infos = [{"stages": {}} for _ in images]
+    outlines = edge_detection_batch(names, images, _net, cache=_cache if persist else None,
+                                    probability_store=_probability_store if persist else None,
+                                    infos=infos, **options)
+    results = []
+    for rgba_image, info in zip(outlines, infos):
+        with stage(info["stages"], "encode"):
+            results.append((_encode_png(rgba_image), info))
+    return results
+
+
+def processed_name(filename):
+    """
+    File name of the processed image of an upload: the outline is always a transparent PNG, whatever
+    the format of the upload (e.g. photo.jpg -> photo_transparent.png).
+    """
+    return outline_key(filename) + ".png"
+
+
+def decode_image(data, flags=cv2.IMREAD_COLOR):
+    """
+    Decodes an uploaded image (bytes) into a BGR array (or grayscale with cv2.IMREAD_GRAYSCALE).
+    Raises ValueError if it is not an image.
+    """
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+    if image is None:
+        raise ValueError("could not decode the image")
+    return image
+
+
+class _Batch(object):
+    # images collected for one batched forward pass
+    def __init__(self, options, persist):
+        self.options = options
+        self.persist = persist
+        self.jobs = []
+        self.images = []
+        self.timer = None
+
+
+class Job(object):
+    def __init__(self, filename, persist=True, on_done=None):
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.persist = persist  # results of transient images (e.g. stream frames) are not kept
+        self.on_done = on_done
+        self.status = "queued"
+        self.created = time.time()
+        self.finished = None
+        self.processed_path = None
+        self.error = None
+        self.inference_size = None
+        self.stages = {}  # time spent in each processing stage (ms)
+        self.result = None  # encoded processed image
+        self.future = None
+
+    @property
+    def done(self):
+        return self.status in ("done", "error")
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "filename": self.filename,
+            "status": self.status,
+            "created": self.created,
+            "finished": self.finished,
+            "processed_path": self.processed_path,
+            "inference_size": self.inference_size,
+            "stages": self.stages,
+            "error": self.error,
+        }
+
+
+class JobQueue(object):
+    """
+    Runs edge detection on a pool of worker processes.
+
+    Jobs are submitted with a decoded image and complete asynchronously, the encoded result is kept
+    in memory (`Job.result`). Callers can block on a job with `wait` (used for long polling) or
+    subscribe to status changes with `events`. With a writer, results are also saved to
+    `save_folder` in the background, under their processed_name. The edge maps are kept under the
+    same name, so a saved outline can be restyled by its file name.
+    If a cache is given, images with a cached result complete immediately without using the pool.
+    If a probability store is given, the edge maps of processed images are kept in it.
+    `options` are passed on to edge_detection and can be overridden per job.
+    With `metrics` (see src.metrics), the duration of every job and of its stages is recorded.
+
+    Every worker gets its share of the cores for the OpenCV thread pool (`threads_per_worker`, see
+    src.scheduler), shared with the pools of the other `server_processes` on the host, and runs the
+    network on the given DNN `backend` / `target`. With `max_pending`, `submit` raises Overloaded
+    when that many jobs are already waiting for or running on the workers.
+
+    With `max_batch` > 1, HED jobs with the same options are collected for up to `batch_window_ms`
+    or until `max_batch` of them are waiting, and run through the network in one batched forward
+    pass (see edge_detection_batch, images are grouped by `batch_bucket`).
+    """
+
+    def __init__(self, save_folder, num_workers=None, max_jobs=256, cache=None,
+                 probability_store=None, writer=None, options=None, metrics=None,
+                 threads_per_worker=None, backend=None, target=None, max_pending=None, max_batch=1,
+                 batch_window_ms=BATCH_WINDOW_MS, batch_bucket=BATCH_BUCKET, server_processes=1):
+        self.save_folder = save_folder
+        self.writer = writer
+        self.metrics = metrics
+        self.cache = cache
+        self.probability_store = probability_store
+        self.options = options or {}
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.threads_per_worker = thread_budget(self.num_workers, threads_per_worker,
+                                                server_processes=server_processes)
+        self.backend = backend
+        self.target = target
+        self.admission = AdmissionControl(max_pending, self.num_workers)
+        self.max_batch = max_batch
+        self.batch_window_ms = batch_window_ms
+        self.batch_bucket = batch_bucket
+        self._batches = {}  # batches being collected, by persist and options
+        self._batch_lock = threading.Lock()
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()
+        self._changed = threading.Condition()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._workers_ready = None  # shared counter of the workers that have loaded the network
+        self.started = None
+
+    def _get_executor(self):
+        # the pool is created on first use (or by start), so importing the app does not spawn any
+        # processes
+        with self._executor_lock:
+            if self._executor is None:
+                context = multiprocessing.get_context("spawn")
+                self._workers_ready = context.Value('i', 0)
+                self._executor = ProcessPoolExecutor(max_workers=self.num_workers, mp_context=context,
+                                                     initializer=_init_worker,
+                                                     initargs=(self.cache.folder if self.cache else None,
+                                                               self.probability_store.folder
+                                                               if self.probability_store else None,
+                                                               self._workers_ready, self.threads_per_worker,
+                                                               self.backend, self.target))
+                self.started = time.time()
+            return self._executor
+
+    def start(self):
+        """
+        Starts the worker processes, which load and warm up the network in the background.
+        Returns immediately, `ready` tells when they are done.
+        """
+        # the processes of a spawn pool are started on demand, one per submission that finds no
+        # idle worker
+        executor = self._get_executor()
+        for _ in range(self.num_workers):
+            executor.submit(_noop)
+        return self
+
+    @property
+    def workers_ready(self):
+        return 0 if self._workers_ready is None else self._workers_ready.value
+
+    def ready(self):
+        """
+        Whether every worker has loaded and warmed up its network.
+        """
+        return self._executor is not None and self.workers_ready >= self.num_workers
+
+    def submit(self, name, image, persist=True, on_done=None, **options):
+        """
+        Queues the decoded `image`. `name` is the file name the result is saved under.
+        With `persist` False, the image is not looked up in or added to the caches and the result is
+        not saved, e.g. for camera frames. `on_done` is called with the job once it is finished.
+        Raises Overloaded (see src.scheduler) if `max_pending` jobs are already in progress.
+        """
+        options = {**self.options, **options}
+        job = Job(name, persist, on_done)
+        if persist and self.cache is not None and self._complete_from_cache(job, image, options):
+            if on_done is not None:
+                on_done(job)
+            return job
+
+        self.admission.admit()
+        if self.max_batch > 1 and options.get("method", "hed") == "hed":
+            with self._changed:
+                self._jobs[job.id] = job
+                self._forget_old_jobs()
+            self._add_to_batch(job, image, options)
+            return job
+        # the executor gives no callback when a job starts, it is marked as running on a status check
+        try:
+            job.future = self._get_executor().submit(_process_job, processed_name(name), image, options,
+                                                     persist)
+        except Exception:
+            self.admission.release()
+            raise
+        with self._changed:
+            self._jobs[job.id] = job
+            self._forget_old_jobs()
+        job.future.add_done_callback(lambda f: self._on_done(job, f))
+        return job
+
+    def _add_to_batch(self, job, image, options):
+        key = (job.persist, tuple(sorted(options.items())))
+        with self._batch_lock:
+            batch = self._batches.get(key)
+            if batch is None:
+                batch = self._batches[key] = _Batch(options, job.persist)
+                batch.timer = threading.Timer(self.batch_window_ms / 1000, self._flush_batch, (key, batch))
+                batch.timer.daemon = True
+                batch.timer.start()
+            batch.jobs.append(job)
+            batch.images.append(image)
+            full = len(batch.jobs) >= self.max_batch
+            if full:
+                del self._batches[key]
+                batch.timer.cancel()
+        if full:
+            self._submit_batch(batch)
+
+    def _flush_batch(self, key, batch):
+        # the batch window has passed, submit the batch unless it was submitted full
+        with self._batch_lock:
+            if self._batches.get(key) is not batch:
+                return
+            del self._batches[key]
+        self._submit_batch(batch)
+
+    def _submit_batch(self, batch):
+        options = {**batch.options, "max_batch": self.max_batch, "bucket": self.batch_bucket}
+        try:
+            names = [processed_name(job.filename) for job in batch.jobs]
+            future = self._get_executor().submit(_process_batch, names, batch.images, options, batch.persist)
+        except Exception as e:
+            # the submitters have returned already, the jobs fail like jobs that failed on a worker
+            future = Future()
+            future.set_exception(e)
+        for index, job in enumerate(batch.jobs):
+            job.future = future
+            future.add_done_callback(lambda f, job=job, index=index: self._on_done(job, f, index))
+
+    def submit_file(self, file_path, **options):
+        image = cv2.imread(file_path)
+        if image is None:
+            raise ValueError(f"could not read image at {file_path}")
+        return self.submit(os.path.basename(file_path), image, **options)
+
+    def _complete_from_cache(self, job, image, options):
+        stages = {}
+        with stage(stages, "cache_lookup"):
+            cached = self.cache.get(outline_cache_key(image, **options))
+        if cached is None:
+            return False
+        if self.probability_store is not None:
+            with stage(stages, "probability_store"):
+                self.probability_store.put(processed_name(job.filename), cached["hed"])
+        with stage(stages, "encode"):
+            png = _encode_png(cached["rgba"])
+        self._finish(job, png, tuple(int(v) for v in cached["inference_size"]), stages, cached=True)
+        with self._changed:
+            self._jobs[job.id] = job
+            self._forget_old_jobs()
+        return True
+
+    def _finish(self, job, result, inference_size, stages, cached=False):
+        job.result = result
+        job.inference_size = inference_size
+        job.stages = stages
+        if self.writer is not None and job.persist:
+            job.processed_path = os.path.join(self.save_folder, processed_name(job.filename))
+            self.writer.write(job.processed_path, result)
+        job.status = "done"
+        job.finished = time.time()
+        if self.metrics is not None:
+            self.metrics.observe("picasso_job_seconds", job.finished - job.created, cached=str(cached).lower())
+            for name, ms in stages.items():
+                self.metrics.observe("picasso_stage_seconds", ms / 1000, stage=name)
+
+    def _forget_old_jobs(self):
+        # the oldest finished jobs go first, jobs still in progress are skipped
+        excess = len(self._jobs) - self.max_jobs
+        if excess > 0:
+            for job_id in [job.id for job in self._jobs.values() if job.done][:excess]:
+                del self._jobs[job_id]
+
+    def _on_done(self, job, future, index=None):
+        # `index` is the position of the job in a batch
+        seconds = None  # time the job took on the worker
+        with self._changed:
+            try:
+                result, info = future.result() if index is None else future.result()[index]
+                seconds = sum(info["stages"].values()) / 1000
+                self._finish(job, result, info["inference_size"], info["stages"], info["cached"])
+            except Exception as e:
+                job.error = str(e)
+                job.status = "error"
+                job.finished = time.time()
+                if self.metrics is not None:
+                    self.metrics.inc("picasso_job_errors_total")
+            finally:
+                self.admission.release(seconds)
+            self._changed.notify_all()
+        if job.on_done is not None:
+            job.on_done(job)
+
+    def _refresh(self, job):
+        if job.status == "queued" and job.future is not None and job.future.running():
+            job.status = "running"
+
+    def get(self, job_id):
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                self._refresh(job)
+            return job
+
+    def wait(self, job_id, timeout):
+        """
+        Blocks until the job is finished or `timeout` seconds have passed.
+        Returns the job, or None if the id is unknown.
+        """
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            job = self._jobs.get(job_id)
+            while job is not None and not job.done:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._changed.wait(remaining)
+            if job is not None:
+                self._refresh(job)
+            return job
+
+    def events(self, job_id, timeout, poll_interval=1.0):
+        """
+        Yields the job every time its status changes, until it is finished or `timeout` seconds
+        have passed.
+        """
+        deadline = time.monotonic() + timeout
+        last_status = None
+        while time.monotonic() < deadline:
+            job = self.wait(job_id, min(poll_interval, max(0.0, deadline - time.monotonic())))
+            if job is None:
+                return
+            if job.status != last_status:
+                last_status = job.status
+                yield job
+            if job.done:
+                return
+
+    def counts(self):
+        """
+        Number of jobs kept by the queue, per status.
+        """
+        with self._changed:
+            counts = {"queued": 0, "running": 0, "done": 0, "error": 0}
+            for job in self._jobs.values():
+                self._refresh(job)
+                counts[job.status] += 1
+            return counts
+
+    def recent(self, limit=20):
+        with self._changed:
+            jobs = list(self._jobs.values())[-limit:]
+            for job in jobs:
+                self._refresh(job)
+            return jobs
+
+    def shutdown(self, wait=False):
+        with self._batch_lock:
+            batches = list(self._batches.values())
+            self._batches.clear()
+        for batch in batches:
+            batch.timer.cancel()
+            self._submit_batch(batch)
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,91 @@
+import threading
+
+import numpy as np
+
+# latency budgets (ms) of the quality tiers, None runs the network at full resolution
+QUALITY_TIERS = {
+    "low": 150,
+    "medium": 500,
+    "high": None,
+}
+MIN_INFERENCE_SIDE = 64  # the network input is never scaled below this size
+
+
+class LatencyModel(object):
+    """
+    Online estimate of the forward pass latency of the network on this host.
+
+    The latency is modelled as `overhead + cost * pixels` and fitted with exponentially weighted
+    least squares on the measured forward passes, so the estimate follows changes in load. Until
+    enough passes have been measured, a conservative prior is used.
+    """
+
+    def __init__(self, overhead_ms=20.0, cost_ms_per_pixel=1e-2, decay=0.95, prior_weight=2.0):
+        self.decay = decay
+        self._lock = threading.Lock()
+        # weighted sums of 1, x, x^2, y and xy, with x in megapixels and y in ms
+        # the prior is a pair of pseudo-observations on the initial line
+        xs = np.array([0.25, 1.0])
+        ys = overhead_ms + cost_ms_per_pixel * 1e6 * xs
+        w = prior_weight / len(xs)
+        self._sums = np.array([prior_weight, w * xs.sum(), w * (xs ** 2).sum(), w * ys.sum(),
+                               w * (xs * ys).sum()])
+
+    def record(self, pixels, latency_ms):
+        x = pixels / 1e6
+        with self._lock:
+            self._sums *= self.decay
+            self._sums += (1.0, x, x * x, latency_ms, x * latency_ms)
+
+    def coefficients(self):
+        """
+        Returns:
+            tuple: (overhead in ms, cost in ms per megapixel)
+        """
+        with self._lock:
+            n, sx, sxx, sy, sxy = self._sums
+        denominator = n * sxx - sx * sx
+        if denominator <= 1e-12:
+            return sy / n, 0.0
+        cost = (n * sxy - sx * sy) / denominator
+        overhead = (sy - cost * sx) / n
+        # latency cannot shrink with the image size
+        return max(overhead, 0.0), max(cost, 1e-6)
+
+    def predict(self, pixels):
+        overhead, cost = self.coefficients()
+        return overhead + cost * pixels / 1e6
+
+    def max_pixels(self, budget_ms):
+        overhead, cost = self.coefficients()
+        return max(budget_ms - overhead, 0.0) / cost * 1e6
+
+
+def inference_size(width, height, budget_ms, latency_model):
+    """
+    Largest size with the aspect ratio of the image whose predicted forward pass latency fits
+    into the budget. Images are never scaled up.
+
+    Returns:
+        tuple: (width, height) for the network input.
+    """
+    if budget_ms is None:
+        return width, height
+    scale = min(1.0, np.sqrt(latency_model.max_pixels(budget_ms) / (width * height)))
+    scale = max(scale, MIN_INFERENCE_SIDE / min(width, height))
+    if scale >= 1.0:
+        return width, height
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+
+def resolve_budget(budget_ms=None, quality=None):
+    """
+    Latency budget of a request, given either directly in ms or as a quality tier.
+    """
+    if budget_ms is not None:
+        return float(budget_ms)
+    if quality is not None:
+        if quality not in QUALITY_TIERS:
+            raise ValueError(f"unknown quality tier \"{quality}\", expected one of {list(QUALITY_TIERS)}")
+        return QUALITY_TIERS[quality]
+    return None
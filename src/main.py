@@ -1,11 +1,5 @@
-from image_processing import *
-
-EXAMPLE_IMAGE = 'me.jpg' # replace with your image
-SAVE_PATH = 'examples'
-
-def main():
-    sobel_filter(EXAMPLE_IMAGE, SAVE_PATH)
-
+from src.batch import main
 
+# batch outline generation, e.g. python -m src.main src/images/raw src/images/processed --workers 4
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,238 @@
+"""
+ArUco marker detection and pose estimation for the headset, so the localisation of the drawing
+surface does not have to run on the device.
+
+Every session (one per headset) remembers where its markers were in the previous frame. The next
+frame is only searched in regions of interest around them, which takes a fraction of a full-frame
+search. The whole frame is searched when there is nothing to track, when a tracked marker was not
+found in its region (loss), and every FULL_SEARCH_INTERVAL frames to pick up new markers.
+The corners of all markers are refined in one cornerSubPix call, and the pose of each marker is
+solved with IPPE for squares.
+
+Poses are in the OpenCV camera frame: x to the right, y down, z forward (meters), the rotation
+maps marker coordinates (x right, y up, z out of the marker) into it.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from src.metrics import stage
+
+ARUCO_DICTIONARY = "DICT_5X5_100"  # same dictionary as MarkerTracker.cs
+MARKER_SIZE = 0.05  # side of the markers (m), as in MarkerTracker.cs
+DEFAULT_HFOV = 70.0  # horizontal field of view (degrees) assumed without camera intrinsics
+ROI_MARGIN = 0.5  # margin of a region of interest, as a fraction of the marker's side
+MIN_ROI_MARGIN = 16  # pixels
+FULL_SEARCH_INTERVAL = 30  # frames between full-frame searches while markers are tracked
+CORNER_WINDOW = 5  # half size of the cornerSubPix search window
+CORNER_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 20, 0.01)
+MAX_SESSIONS = 64
+SESSION_TTL = 120  # seconds after which an idle session is forgotten
+
+
+def aruco_dictionary(name=ARUCO_DICTIONARY):
+    """
+    Predefined ArUco dictionary by name, e.g. "DICT_5X5_100".
+    """
+    if not name.startswith("DICT_") or not hasattr(cv2.aruco, name):
+        raise ValueError(f"unknown ArUco dictionary \"{name}\"")
+    return cv2.aruco.getPredefinedDictionary(getattr(cv2.aruco, name))
+
+
+def camera_matrix(width, height, fx=None, fy=None, cx=None, cy=None, hfov=DEFAULT_HFOV):
+    """
+    Pinhole camera matrix, missing intrinsics are derived from the image size and the horizontal
+    field of view.
+    """
+    if fx is None:
+        fx = width / 2 / np.tan(np.radians(hfov) / 2)
+    return np.array([[fx, 0, width / 2 if cx is None else cx],
+                     [0, fx if fy is None else fy, height / 2 if cy is None else cy],
+                     [0, 0, 1]], dtype=np.float64)
+
+
+def marker_object_points(marker_size):
+    # corners in the order of the detector: top left, top right, bottom right, bottom left
+    half = marker_size / 2
+    return np.array([[-half, half, 0], [half, half, 0], [half, -half, 0], [-half, -half, 0]], dtype=np.float32)
+
+
+def rotation_quaternion(rvec):
+    """
+    Quaternion (x, y, z, w) of a Rodrigues rotation vector.
+    """
+    angle = float(np.linalg.norm(rvec))
+    if angle < 1e-12:
+        return [0.0, 0.0, 0.0, 1.0]
+    axis = np.ravel(rvec) / angle
+    return [*(float(v) for v in axis * np.sin(angle / 2)), float(np.cos(angle / 2))]
+
+
+def refine_corners(gray, corners, window=CORNER_WINDOW):
+    """
+    Refines the corners of all markers (array of shape (markers, 4, 2)) to subpixel accuracy in
+    a single cornerSubPix call. The window shrinks for small markers, so it stays inside them.
+    """
+    if len(corners) == 0:
+        return corners
+    sides = np.linalg.norm(corners - np.roll(corners, 1, axis=1), axis=2).min()
+    window = int(max(1, min(window, sides // 4)))
+    points = np.ascontiguousarray(corners.reshape(-1, 1, 2), dtype=np.float32)
+    cv2.cornerSubPix(gray, points, (window, window), (-1, -1), CORNER_CRITERIA)
+    return points.reshape(-1, 4, 2)
+
+
+def marker_poses(corners, marker_size, camera, distortion=None):
+    """
+    Pose (rvec, tvec) of every marker from its image corners.
+    """
+    objects = marker_object_points(marker_size)
+    poses = []
+    for marker_corners in corners:
+        ok, rvec, tvec = cv2.solvePnP(objects, marker_corners.astype(np.float32), camera, distortion,
+                                      flags=cv2.SOLVEPNP_IPPE_SQUARE)
+        poses.append((rvec.ravel(), tvec.ravel()) if ok else (None, None))
+    return poses
+
+
+class MarkerDetector(object):
+    """
+    Finds the markers of one dictionary in grayscale frames, in the whole frame or in regions of
+    interest. The detector of OpenCV does no corner refinement, see refine_corners.
+    """
+
+    def __init__(self, dictionary=ARUCO_DICTIONARY):
+        parameters = cv2.aruco.DetectorParameters()
+        parameters.cornerRefinementMethod = cv2.aruco.CORNER_REFINE_NONE
+        self._detector = cv2.aruco.ArucoDetector(aruco_dictionary(dictionary), parameters)
+
+    def detect(self, gray, rois=None):
+        """
+        Returns:
+            tuple: ids (array of int) and corners (array of shape (markers, 4, 2), frame pixels).
+            A marker found in several overlapping regions is returned once.
+        """
+        found = OrderedDict()
+        for (x0, y0, x1, y1) in rois or [(0, 0, gray.shape[1], gray.shape[0])]:
+            corners, ids, _ = self._detector.detectMarkers(gray[y0:y1, x0:x1])
+            if ids is None:
+                continue
+            for marker_id, marker_corners in zip(ids.ravel(), corners):
+                found.setdefault(int(marker_id), marker_corners.reshape(4, 2) + (x0, y0))
+        ids = np.array(list(found), dtype=int)
+        corners = np.array(list(found.values()), dtype=np.float32).reshape(-1, 4, 2)
+        return ids, corners
+
+
+def marker_rois(corners, shape, margin=ROI_MARGIN, min_margin=MIN_ROI_MARGIN):
+    """
+    Regions of interest (x0, y0, x1, y1) around markers: their bounding boxes, grown by `margin`
+    times the longest side of the box.
+    """
+    (H, W) = shape[:2]
+    low, high = corners.min(axis=1), corners.max(axis=1)
+    pad = np.maximum((high - low).max(axis=1) * margin, min_margin)[:, None]
+    low = np.clip(np.floor(low - pad), 0, [W, H]).astype(int)
+    high = np.clip(np.ceil(high + pad), 0, [W, H]).astype(int)
+    return [(x0, y0, x1, y1) for (x0, y0), (x1, y1) in zip(low, high)]
+
+
+class MarkerSession(object):
+    """
+    Marker tracking state of one headset: the markers of the previous frame and the number of
+    frames since the last full-frame search.
+    """
+
+    def __init__(self, session_id, dictionary=ARUCO_DICTIONARY):
+        self.id = session_id
+        self.dictionary = dictionary
+        self.detector = MarkerDetector(dictionary)
+        self.frames = 0
+        self.full_searches = 0
+        self.last_active = time.monotonic()
+        self._ids = np.zeros(0, dtype=int)
+        self._corners = np.zeros((0, 4, 2), dtype=np.float32)
+        self._shape = None
+        self._since_full_search = 0
+        self._lock = threading.Lock()  # frames of a session are processed one at a time
+
+    def process(self, gray, marker_size=MARKER_SIZE, camera=None, distortion=None, scale=1.0, stages=None):
+        """
+        Detects the markers in a grayscale frame and estimates their poses. With `scale` != 1 the
+        frame is a downscaled copy of the camera image, corners and intrinsics are in camera pixels.
+
+        Returns:
+            dict: the markers (id, corners, rvec, tvec and quaternion) and the search ("roi" or "full").
+        """
+        with self._lock:
+            self.last_active = time.monotonic()
+            self.frames += 1
+            tracked = (len(self._ids) > 0 and self._shape == gray.shape
+                       and self._since_full_search < FULL_SEARCH_INTERVAL)
+            ids = corners = None
+            if tracked:
+                with stage(stages, "detect"):
+                    ids, corners = self.detector.detect(gray, marker_rois(self._corners, gray.shape))
+                if not np.isin(self._ids, ids).all():
+                    ids = None  # a marker was lost
+            search = "roi" if ids is not None else "full"
+            if ids is None:
+                with stage(stages, "detect"):
+                    ids, corners = self.detector.detect(gray)
+                self.full_searches += 1
+                self._since_full_search = 0
+            else:
+                self._since_full_search += 1
+            with stage(stages, "refine"):
+                corners = refine_corners(gray, corners)
+            self._ids, self._corners, self._shape = ids, corners, gray.shape
+
+        corners = corners * scale
+        if camera is None:
+            camera = camera_matrix(gray.shape[1] * scale, gray.shape[0] * scale)
+        with stage(stages, "pose"):
+            poses = marker_poses(corners, marker_size, camera, distortion)
+        markers = []
+        for marker_id, marker_corners, (rvec, tvec) in zip(ids, corners, poses):
+            marker = {"id": int(marker_id), "corners": marker_corners.astype(float).round(2).tolist()}
+            if rvec is not None:
+                marker.update(rvec=rvec.tolist(), tvec=tvec.tolist(), rotation=rotation_quaternion(rvec))
+            markers.append(marker)
+        return {"markers": markers, "search": search, "frame": self.frames}
+
+
+class MarkerSessions(object):
+    """
+    Tracking sessions by the id chosen by the client, the least recently used ones are dropped
+    beyond `max_sessions`, idle ones after `ttl` seconds.
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS, ttl=SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id, dictionary=ARUCO_DICTIONARY):
+        """
+        The session with this id, a new one if it does not exist or uses another dictionary.
+        Raises ValueError for unknown dictionaries.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for old_id in [key for key, session in self._sessions.items() if now - session.last_active > self.ttl]:
+                del self._sessions[old_id]
+            session = self._sessions.get(session_id)
+            if session is None or session.dictionary != dictionary:
+                session = self._sessions[session_id] = MarkerSession(session_id, dictionary)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            return session
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
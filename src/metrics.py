@@ -0,0 +1,136 @@
+"""
+Low-overhead instrumentation: stage timers and a metrics registry rendered in the Prometheus text
+format.
+
+Stage timings are collected in a plain dict (stage name -> milliseconds), which is passed along
+with the `info` of a run, so they also work inside worker processes and travel back with the
+result.
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # seconds
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7)  # bytes
+
+
+@contextmanager
+def stage(stages, name):
+    """
+    Adds the time spent in the block (ms) to `stages[name]`. Does nothing if `stages` is None.
+    """
+    if stages is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages[name] = stages.get(name, 0.0) + 1000 * (time.perf_counter() - start)
+
+
+def info_stages(info):
+    """
+    Stage timings of a run: the "stages" dict of `info`, created if needed, or None without info.
+    """
+    if info is None:
+        return None
+    return info.setdefault("stages", {})
+
+
+def server_timing(stages):
+    """
+    Formats stage timings (ms) as a Server-Timing header value.
+    """
+    return ", ".join(f"{name};dur={ms:.2f}" for name, ms in stages.items())
+
+
+class Metrics(object):
+    """
+    Counters and histograms with labels, plus collectors that are called on every scrape for
+    values that are kept elsewhere (e.g. queue depth, cache hits).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._described = {}  # name -> (type, help, buckets)
+        self._values = {}  # (name, labels) -> counter value or histogram [bucket counts, sum, count]
+        self._collectors = []
+
+    def describe(self, name, kind, help_text, buckets=LATENCY_BUCKETS):
+        self._described[name] = (kind, help_text, tuple(buckets))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = self._described[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def register(self, collector):
+        """
+        `collector` is called on every scrape and returns (name, labels, value) tuples of metrics
+        described as gauges or counters.
+        """
+        self._collectors.append(collector)
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            # histograms are copied, they keep changing while the text is formatted
+            samples = [(name, dict(labels), [list(value[0])] + value[1:] if isinstance(value, list) else value)
+                       for (name, labels), value in self._values.items()]
+        for collector in self._collectors:
+            samples.extend((name, labels, value) for name, labels, value in collector())
+
+        by_name = {}
+        for name, labels, value in samples:
+            by_name.setdefault(name, []).append((labels, value))
+        lines = []
+        for name in sorted(by_name):
+            kind, help_text, buckets = self._described.get(name, ("untyped", "", ()))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in by_name[name]:
+                if kind != "histogram":
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{_labels({**labels, 'le': _number(bound)})} {cumulative}")
+                lines.append(f"{name}_bucket{_labels({**labels, 'le': '+Inf'})} {count}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(total)}")
+                lines.append(f"{name}_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+               for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+
+def _number(value):
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
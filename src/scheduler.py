@@ -0,0 +1,90 @@
+"""
+CPU budgeting between the server and the OpenCV thread pools.
+
+OpenCV runs the DNN forward pass and most image operations on its own thread pool, sized to all
+cores by default. With several worker processes (and the request threads of the server) each pool
+competes for the same cores, so the processes are given a share of the cores each
+(thread_budget). Under a multi-process server (e.g. gunicorn -w N) every server process has a pool
+of its own, so the cores are shared by the workers of all pools. The number of images waiting for
+the pool is bounded (AdmissionControl): requests beyond the bound are rejected with a retry hint instead of queueing up.
+"""
+import math
+import os
+import threading
+
+import cv2
+
+# smoothing of the average job duration used for the retry hint
+DURATION_SMOOTHING = 0.2
+
+
+def thread_budget(num_workers, threads_per_worker=None, cpu_count=None, server_processes=1):
+    """
+    OpenCV threads of every worker process: the cores divided among the workers of the pools of
+    all `server_processes`, at least one.
+    """
+    if threads_per_worker:
+        return threads_per_worker
+    cpu_count = cpu_count or os.cpu_count() or 1
+    return max(1, cpu_count // max(1, num_workers * server_processes))
+
+
+def configure_threads(num_threads):
+    """
+    Sets the size of the OpenCV thread pool of this process. 1 runs everything on the calling
+    thread, which is what concurrent callers (request threads) want.
+    """
+    if num_threads is not None:
+        cv2.setNumThreads(int(num_threads))
+
+
+class Overloaded(Exception):
+    """
+    Raised when a job is not admitted, `retry_after` is the suggested wait in seconds.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"too many images in progress, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class AdmissionControl(object):
+    """
+    Bounds the number of jobs in progress (queued for or running on the workers). `admit` raises
+    Overloaded once `max_pending` jobs are in progress. The retry hint is the time the workers need
+    to work off the jobs ahead, from the average job duration.
+    """
+
+    def __init__(self, max_pending, num_workers):
+        self.max_pending = max_pending
+        self.num_workers = num_workers
+        self.pending = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.average_seconds = None
+        self._lock = threading.Lock()
+
+    def admit(self):
+        with self._lock:
+            if self.max_pending is not None and self.pending >= self.max_pending:
+                self.rejected += 1
+                raise Overloaded(self._retry_after())
+            self.pending += 1
+            self.admitted += 1
+
+    def release(self, seconds=None):
+        """
+        Called when an admitted job is finished, with its duration if it ran.
+        """
+        with self._lock:
+            self.pending -= 1
+            if seconds is not None:
+                if self.average_seconds is None:
+                    self.average_seconds = seconds
+                else:
+                    self.average_seconds += DURATION_SMOOTHING * (seconds - self.average_seconds)
+
+    def _retry_after(self):
+        if self.average_seconds is None:
+            return 1
+        return max(1, math.ceil(self.average_seconds * self.pending / self.num_workers))
@@ -0,0 +1,435 @@
+"""
+Append-only packed store of outlines and edge maps, instead of one file per result.
+
+A store is a folder with one data file (store.<generation>.pack), holding the payloads back to
+back, and its index (store.<generation>.idx), one JSON line per entry: [key, offset and length of
+the payload, encoding, dtype, shape of the array], or [key] for a deletion. The encodings are:
+ - raw: the bytes of the array. Payloads start at multiples of ALIGNMENT, so reading one is a
+   view into the memory-mapped data file, without copying.
+ - zlib: the array bytes compressed with zlib.
+ - png: a PNG of the array (uint8 images), e.g. an outline as it is sent to the clients, which
+   can be served from the store as is (get_bytes).
+
+Readers map the data file and keep the index as a dict, so a lookup costs one fstat of the index
+(to pick up entries appended by other processes) and a dict lookup, whatever the number of
+entries. Writes go through a lock file (flock), so there is a single writer at a time across
+processes: the payload is appended and flushed before its index line, and readers only use
+complete index lines, so they never see partial entries. A later entry with the same key
+replaces the earlier one, deletions are index lines too.
+
+Replaced and deleted payloads stay in the data file until the store is compacted: the live
+entries are copied to the files of the next generation, the old index gets a line pointing to
+it (readers that still have it open switch over) and the old files are removed.
+
+Migrating the per-file results and compacting, from the repository root:
+
+    python -m src.store migrate
+    python -m src.store migrate --processed src/images/processed --output src/output --remove
+(--remove only deletes the .npy edge maps of the ProbabilityStore, which reads them from the store
+afterwards. The outlines in the processed folder are still served as files by the app.)
+    python -m src.store compact src/images/processed/data
+    python -m src.store stats src/images/processed/data
+"""
+import argparse
+import contextlib
+import fcntl
+import json
+import mmap
+import os
+import re
+import threading
+import zlib
+
+import cv2
+import numpy as np
+
+ALIGNMENT = 64  # bytes, payloads start at multiples of this
+ENCODINGS = ("raw", "zlib", "png")
+LOCK_NAME = "store.lock"
+FILE_PATTERN = re.compile(r"store\.(\d+)\.idx$")
+
+
+def _data_path(folder, generation):
+    return os.path.join(folder, f"store.{generation}.pack")
+
+
+def _index_path(folder, generation):
+    return os.path.join(folder, f"store.{generation}.idx")
+
+
+def _generations(folder):
+    try:
+        names = os.listdir(folder)
+    except FileNotFoundError:
+        return []
+    return sorted(int(match.group(1)) for match in map(FILE_PATTERN.match, names) if match)
+
+
+def encode_array(array, encoding="raw"):
+    """
+    Payload of an array in one of ENCODINGS.
+    """
+    if encoding == "raw":
+        return np.ascontiguousarray(array).data
+    if encoding == "zlib":
+        return zlib.compress(np.ascontiguousarray(array).data, 1)
+    if encoding == "png":
+        ok, png = cv2.imencode(".png", array, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        if not ok:
+            raise ValueError(f"could not encode an array of {array.dtype} {array.shape} as png")
+        return png.data
+    raise ValueError(f"unknown encoding \"{encoding}\", expected one of {list(ENCODINGS)}")
+
+
+class PackedStore(object):
+    """
+    Arrays by key (str) in a packed store folder (see the module docstring). Created empty if
+    the folder has no store. Safe to use from several threads and processes.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self._lock = threading.RLock()
+        self._lock_file = None
+        self._open()
+
+    @staticmethod
+    def exists(folder):
+        """
+        Whether a folder holds a packed store.
+        """
+        return bool(_generations(folder))
+
+    def _open(self):
+        # (re)opens the newest generation, creates the first one if there is none
+        while True:
+            generations = _generations(self.folder)
+            if not generations:
+                with self._writer():
+                    if not _generations(self.folder):
+                        open(_data_path(self.folder, 0), "ab").close()
+                        open(_index_path(self.folder, 0), "ab").close()
+                continue
+            generation = generations[-1]
+            try:
+                index_file = open(_index_path(self.folder, generation), "rb")
+            except FileNotFoundError:
+                continue  # removed by a compaction in the meantime
+            try:
+                data_fd = os.open(_data_path(self.folder, generation), os.O_RDONLY)
+            except FileNotFoundError:
+                index_file.close()
+                continue
+            break
+        self.generation = generation
+        self._index_file = index_file
+        self._index_pos = 0
+        self._data_fd = data_fd
+        self._map = None
+        self._entries = {}  # key -> its index line
+        self._garbage = 0  # bytes of replaced and deleted payloads
+        self._refresh()
+
+    def _refresh(self):
+        # reads the index lines appended since the last call, follows compactions
+        with self._lock:
+            while os.fstat(self._index_file.fileno()).st_size > self._index_pos:
+                self._index_file.seek(self._index_pos)
+                tail = self._index_file.read()
+                complete = tail.rfind(b"\n") + 1  # the last line may still be written
+                if complete == 0:
+                    return
+                self._index_pos += complete
+                moved = None
+                # one JSON document for all lines, much faster than parsing them one by one
+                entries = self._entries
+                for record in json.loads(b"[" + tail[:complete - 1].replace(b"\n", b",") + b"]"):
+                    if type(record) is dict:
+                        moved = record["moved"]
+                        break
+                    previous = entries.get(record[0])
+                    if previous is not None:
+                        self._garbage += previous[2]
+                    if len(record) > 1:
+                        entries[record[0]] = record
+                    elif previous is not None:
+                        del entries[record[0]]
+                if moved is not None:
+                    self._close()
+                    self._open()
+                    return
+
+    def _close(self):
+        self._index_file.close()
+        os.close(self._data_fd)
+        self._map = None  # arrays read before keep the old mapping alive
+
+    def _payload(self, offset, length):
+        end = offset + length
+        if length == 0:
+            return memoryview(b"")
+        if self._map is None or len(self._map) < end:
+            self._map = mmap.mmap(self._data_fd, 0, access=mmap.ACCESS_READ)
+        return memoryview(self._map)[offset:end]
+
+    def _lookup(self, key):
+        self._refresh()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, None
+            return entry, self._payload(entry[1], entry[2])
+
+    def get(self, key):
+        """
+        The array stored under `key`, or None. Raw arrays are read-only views into the data file.
+        """
+        entry, payload = self._lookup(key)
+        if entry is None:
+            return None
+        _, _, _, encoding, dtype, shape = entry
+        if encoding == "raw":
+            return np.frombuffer(payload, dtype=dtype).reshape(shape)
+        if encoding == "zlib":
+            return np.frombuffer(zlib.decompress(payload), dtype=dtype).reshape(shape)
+        return cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+
+    def get_bytes(self, key):
+        """
+        The payload stored under `key` (memoryview into the data file) and its encoding, or (None, None).
+        """
+        entry, payload = self._lookup(key)
+        return (None, None) if entry is None else (payload, entry[3])
+
+    def __contains__(self, key):
+        self._refresh()
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        self._refresh()
+        with self._lock:
+            return len(self._entries)
+
+    def keys(self):
+        self._refresh()
+        with self._lock:
+            return list(self._entries)
+
+    @contextlib.contextmanager
+    def _writer(self):
+        # exclusive across the threads of this process and across processes
+        with self._lock:
+            if self._lock_file is None:
+                self._lock_file = open(os.path.join(self.folder, LOCK_NAME), "ab")
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _append(self, records):
+        # records: (key, payload, encoding, dtype, shape), payload None for deletions
+        with self._writer():
+            self._refresh()
+            index_path = _index_path(self.folder, self.generation)
+            if os.path.getsize(index_path) > self._index_pos:
+                # the line of a writer that died while writing it
+                os.truncate(index_path, self._index_pos)
+            lines = []
+            with open(_data_path(self.folder, self.generation), "ab") as data_file:
+                offset = data_file.seek(0, os.SEEK_END)
+                for key, payload, encoding, dtype, shape in records:
+                    if payload is None:
+                        lines.append([key])
+                        continue
+                    padding = -offset % ALIGNMENT
+                    data_file.write(b"\0" * padding)
+                    offset += padding
+                    length = data_file.write(payload)
+                    lines.append([key, offset, length, encoding, dtype, list(shape)])
+                    offset += length
+                data_file.flush()
+                os.fsync(data_file.fileno())
+            data = "".join(json.dumps(line, separators=(",", ":")) + "\n" for line in lines).encode()
+            fd = os.open(index_path, os.O_WRONLY | os.O_APPEND)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            self._refresh()
+
+    def put(self, key, array, encoding="raw"):
+        """
+        Stores an array under `key`, replacing the previous one. See ENCODINGS.
+        """
+        array = np.asarray(array)
+        self._append([(key, encode_array(array, encoding), encoding, array.dtype.str, array.shape)])
+
+    def put_encoded(self, key, payload, encoding, dtype, shape):
+        """
+        Stores an already encoded payload, e.g. the bytes of a PNG file with encoding "png".
+        """
+        if encoding not in ENCODINGS:
+            raise ValueError(f"unknown encoding \"{encoding}\", expected one of {list(ENCODINGS)}")
+        self._append([(key, payload, encoding, np.dtype(dtype).str, tuple(shape))])
+
+    def put_many(self, items, encoding="raw"):
+        """
+        Stores (key, array) pairs with one flush and one index write.
+        """
+        records = []
+        for key, array in items:
+            array = np.asarray(array)
+            records.append((key, encode_array(array, encoding), encoding, array.dtype.str, array.shape))
+        if records:
+            self._append(records)
+
+    def delete(self, key):
+        if key in self:
+            self._append([(key, None, None, None, None)])
+
+    def stats(self):
+        self._refresh()
+        with self._lock:
+            return {
+                "generation": self.generation,
+                "entries": len(self._entries),
+                "live_bytes": sum(entry[2] for entry in self._entries.values()),
+                "garbage_bytes": self._garbage,
+                "data_bytes": os.fstat(self._data_fd).st_size,
+                "index_bytes": self._index_pos,
+            }
+
+    def compact(self):
+        """
+        Copies the live entries to the files of the next generation and removes the old files.
+
+        Returns:
+            int: bytes freed.
+        """
+        with self._writer():
+            self._refresh()
+            old_generation, generation = self.generation, self.generation + 1
+            old_size = os.fstat(self._data_fd).st_size + self._index_pos
+            data_path, index_path = _data_path(self.folder, generation), _index_path(self.folder, generation)
+            lines = []
+            with open(data_path + ".tmp", "wb") as data_file:
+                offset = 0
+                for key, start, length, encoding, dtype, shape in self._entries.values():
+                    padding = -offset % ALIGNMENT
+                    data_file.write(b"\0" * padding)
+                    offset += padding
+                    data_file.write(self._payload(start, length))
+                    lines.append([key, offset, length, encoding, dtype, shape])
+                    offset += length
+                data_file.flush()
+                os.fsync(data_file.fileno())
+            with open(index_path + ".tmp", "wb") as index_file:
+                index_file.write("".join(json.dumps(line, separators=(",", ":")) + "\n" for line in lines).encode())
+                index_file.flush()
+                os.fsync(index_file.fileno())
+            # the data file first, readers look for the index
+            os.replace(data_path + ".tmp", data_path)
+            os.replace(index_path + ".tmp", index_path)
+            fd = os.open(_index_path(self.folder, old_generation), os.O_WRONLY | os.O_APPEND)
+            try:
+                os.write(fd, json.dumps({"moved": generation}).encode() + b"\n")
+            finally:
+                os.close(fd)
+            self._refresh()
+            for path in (_data_path(self.folder, old_generation), _index_path(self.folder, old_generation)):
+                os.remove(path)
+            return old_size - os.fstat(self._data_fd).st_size - self._index_pos
+
+
+def probability_key(name):
+    # key of the edge map of an image, like the file names of ProbabilityStore and edge_detection
+    return os.path.splitext(name)[0] + "_hed"
+
+
+def outline_key(name):
+    return os.path.splitext(name)[0] + "_transparent"
+
+
+def migrate(store, processed_folder=None, output_folder=None, remove=False):
+    """
+    Moves the per-file results into a packed store:
+     - the outlines of `processed_folder` (*.png, kept as PNG) and its edge maps (data/*_hed.npy)
+     - the outputs of edge_detection in `output_folder` (*_transparent.png kept as PNG, *_hed.png
+       edge maps)
+    Edge maps are stored raw, so they are read without decoding. When a key comes from several
+    files, the most recently modified one wins.
+    With `remove`, the migrated .npy edge maps of `processed_folder`/data are deleted if the store
+    is in that folder, where ProbabilityStore finds them. Other files are kept: the app serves the
+    outlines of the processed folder as files.
+
+    Returns:
+        int: number of migrated files.
+    """
+    sources = []  # (mtime, path, key, kind)
+    folders = []
+    if processed_folder is not None:
+        folders += [(processed_folder, "outline"), (os.path.join(processed_folder, "data"), "map")]
+    if output_folder is not None:
+        folders.append((output_folder, None))
+    for folder, kind in folders:
+        if not os.path.isdir(folder):
+            continue
+        for entry in os.scandir(folder):
+            name = entry.name
+            if not entry.is_file():
+                continue
+            if name.endswith("_hed.npy") or name.endswith("_hed.png"):
+                sources.append((entry.stat().st_mtime_ns, entry.path, name[:-len(".npy")], "map"))
+            elif name.endswith("_transparent.png") or (kind == "outline" and name.lower().endswith(".png")):
+                sources.append((entry.stat().st_mtime_ns, entry.path, outline_key(name.replace("_transparent", "")),
+                                "outline"))
+    sources.sort()
+
+    for _, path, key, kind in sources:
+        if kind == "map":
+            hed = np.load(path) if path.endswith(".npy") else cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+            if hed is None:
+                raise ValueError(f"could not read {path}")
+            store.put(key, np.ascontiguousarray(hed, dtype=np.uint8))
+        else:
+            with open(path, "rb") as f:
+                png = f.read()
+            outline = cv2.imdecode(np.frombuffer(png, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+            if outline is None:
+                raise ValueError(f"could not read {path}")
+            store.put_encoded(key, png, "png", outline.dtype, outline.shape)
+    if remove and processed_folder is not None:
+        data_folder = os.path.join(processed_folder, "data")
+        if os.path.isdir(data_folder) and os.path.samefile(data_folder, store.folder):
+            for _, path, _, _ in sources:
+                if path.endswith("_hed.npy") and os.path.dirname(path) == data_folder:
+                    os.remove(path)
+    return len(sources)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = commands.add_parser("migrate", help="move per-file outlines and edge maps into a store")
+    migrate_parser.add_argument("--store", default="src/images/processed/data", help="folder of the store")
+    migrate_parser.add_argument("--processed", default="src/images/processed", help="folder of the outlines")
+    migrate_parser.add_argument("--output", default="src/output", help="folder of the edge_detection outputs")
+    migrate_parser.add_argument("--remove", action="store_true", help="delete the migrated .npy edge maps of the ProbabilityStore")
+    for command, help_text in (("compact", "drop replaced and deleted payloads"), ("stats", "print the size")):
+        commands.add_parser(command, help=help_text).add_argument("store", help="folder of the store")
+    args = parser.parse_args(argv)
+
+    store = PackedStore(args.store)
+    if args.command == "migrate":
+        count = migrate(store, args.processed, args.output, args.remove)
+        print(f"{count} files migrated into {args.store}")
+    elif args.command == "compact":
+        print(f"{store.compact()} bytes freed")
+    print(json.dumps(store.stats()))
+
+
+if __name__ == "__main__":
+    main()
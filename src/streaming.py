@@ -0,0 +1,275 @@
+"""
+Temporal coherence for continuous camera frame streams.
+
+A stream session keeps the outline of the last processed frame and a small grayscale signature
+of the frame it belongs to. Every new frame is compared to that signature first:
+ - near-duplicates (no changed cell and a mean difference below DUPLICATE_THRESHOLD) reuse the
+   outline as is
+ - local changes (at most LOCAL_FRACTION of the signature cells changed) only process the changed
+   region, with some context around it, and paste its outline into the previous one
+ - everything else (camera motion, new scene) processes the whole frame
+
+At most one frame per session is processed at a time. Frames that arrive meanwhile wait in a single
+slot, a newer frame replaces (drops) the waiting one, so a session never falls behind the camera.
+The server load follows the changes in the scene rather than the frame rate.
+"""
+import threading
+import time
+import uuid
+
+import cv2
+import numpy as np
+
+from src.image_processing import BORDER_THICKNESS
+from src.scheduler import Overloaded
+
+SIGNATURE_SIZE = (64, 48)  # width, height of the frame signature (grayscale, area downsampled)
+CELL_SIZE = 8  # signature pixels per side of a change detection cell
+DUPLICATE_THRESHOLD = 2.0  # mean absolute difference (gray levels) below which a frame is a duplicate
+CELL_THRESHOLD = 12.0  # mean absolute difference above which a cell has changed
+LOCAL_FRACTION = 0.25  # changes in at most this fraction of the cells are processed as a region
+REGION_MARGIN = 4 * BORDER_THICKNESS  # context (pixels) processed around a changed region
+SESSION_TTL = 120  # seconds after which an idle session is closed
+
+# results of a frame, counted per session
+FRAME_RESULTS = ("duplicate", "local", "full", "dropped", "error")
+
+
+def frame_signature(image):
+    """
+    Small grayscale copy of a frame (float32, SIGNATURE_SIZE), cheap to compare.
+    """
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, SIGNATURE_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+def changed_region(reference, signature):
+    """
+    Compares the signature of a frame with the reference.
+
+    Returns:
+        tuple: ("duplicate", None), ("local", (x0, y0, x1, y1) in signature pixels) or ("full", None)
+    """
+    difference = cv2.absdiff(reference, signature)
+    height, width = difference.shape
+    cells = cv2.resize(difference, (width // CELL_SIZE, height // CELL_SIZE), interpolation=cv2.INTER_AREA)
+    changed = cells > CELL_THRESHOLD
+    if not changed.any():
+        if float(difference.mean()) < DUPLICATE_THRESHOLD:
+            return "duplicate", None
+        # a small difference spread over the whole frame, e.g. exposure
+        return "full", None
+    if changed.mean() > LOCAL_FRACTION:
+        return "full", None
+    rows, cols = np.nonzero(changed)
+    return "local", (int(cols.min()) * CELL_SIZE, int(rows.min()) * CELL_SIZE,
+                     (int(cols.max()) + 1) * CELL_SIZE, (int(rows.max()) + 1) * CELL_SIZE)
+
+
+class StreamSession(object):
+    """
+    State of one frame stream: the current outline, its sequence number and the frames in flight.
+    Frames are processed by the job queue without being cached or saved.
+    """
+
+    def __init__(self, jobs, options=None, on_frame=None):
+        self.id = uuid.uuid4().hex
+        self.jobs = jobs
+        self.options = options or {}
+        self.frames = 0
+        self.sequence = 0  # number of the current outline, increases with every update
+        self.outline = None
+        self.counts = dict.fromkeys(FRAME_RESULTS, 0)
+        self.closed = False
+        self.last_active = time.monotonic()
+        self._on_frame = on_frame
+        self._reference = None  # signature of the frame the outline (or the frame in flight) shows
+        self._in_flight = False
+        self._waiting = None  # (frame number, image, signature) of the newest unprocessed frame
+        self._changed = threading.Condition()
+
+    def _count(self, result):
+        self.counts[result] += 1
+        if self._on_frame is not None:
+            self._on_frame(result)
+
+    def submit(self, image):
+        """
+        Hands a new camera frame to the session.
+
+        Returns:
+            dict: Frame number and what happens with it: "duplicate" (the outline stays), "queued"
+            (processed now, "local" or "full") or "waiting" (processed after the frame in flight).
+        """
+        with self._changed:
+            self.last_active = time.monotonic()
+            self.frames += 1
+            frame = self.frames
+            signature = frame_signature(image)
+            if self._in_flight:
+                if self._is_duplicate(image, signature):
+                    self._count("duplicate")
+                    return {"frame": frame, "status": "duplicate"}
+                if self._waiting is not None:
+                    self._count("dropped")
+                self._waiting = (frame, image, signature)
+                return {"frame": frame, "status": "waiting"}
+            return self._dispatch(frame, image, signature)
+
+    def _is_duplicate(self, image, signature):
+        return (self._reference is not None and self._reference.shape == signature.shape
+                and self.outline is not None and self.outline.shape[:2] == image.shape[:2]
+                and changed_region(self._reference, signature)[0] == "duplicate")
+
+    def _dispatch(self, frame, image, signature):
+        # called with the lock held and no frame in flight
+        height, width = image.shape[:2]
+        if self._reference is not None and self.outline is not None and self.outline.shape[:2] == (height, width):
+            mode, box = changed_region(self._reference, signature)
+        else:
+            mode, box = "full", None
+        if mode == "duplicate":
+            self._count("duplicate")
+            return {"frame": frame, "status": "duplicate"}
+
+        region = crop = None
+        if mode == "local":
+            # the changed cells in frame pixels, and the crop with context around them
+            sx, sy = width / SIGNATURE_SIZE[0], height / SIGNATURE_SIZE[1]
+            region = (int(box[0] * sx), int(box[1] * sy), min(width, int(np.ceil(box[2] * sx))),
+                      min(height, int(np.ceil(box[3] * sy))))
+            crop = (max(0, region[0] - REGION_MARGIN), max(0, region[1] - REGION_MARGIN),
+                    min(width, region[2] + REGION_MARGIN), min(height, region[3] + REGION_MARGIN))
+            image = np.ascontiguousarray(image[crop[1]:crop[3], crop[0]:crop[2]])
+
+        # updated before submitting, a fast job can finish (and call _on_done on this thread) before
+        # submit returns
+        previous = self._reference
+        if mode == "local":
+            # only the processed cells follow the new frame, the others keep comparing against the
+            # frame of their outline, so slow changes cannot add up unnoticed
+            self._reference = previous.copy()
+            self._reference[box[1]:box[3], box[0]:box[2]] = signature[box[1]:box[3], box[0]:box[2]]
+        else:
+            self._reference = signature
+        self._in_flight = True
+        try:
+            self.jobs.submit(f"stream_{self.id}_{frame}.png", image, persist=False,
+                             on_done=lambda job: self._on_done(job, mode, region, crop), **self.options)
+        except Overloaded:
+            self._in_flight = False
+            self._reference = previous
+            self._count("dropped")
+            return {"frame": frame, "status": "dropped"}
+        return {"frame": frame, "status": "queued", "mode": mode, "region": region}
+
+    def _on_done(self, job, mode, region, crop):
+        result = None
+        if job.status == "done":
+            result = cv2.imdecode(np.frombuffer(job.result, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        if result is not None and mode == "local":
+            # readers encode the outline outside the lock, so the region goes into a copy. Only the
+            # worker callbacks (one job in flight per session) replace the outline
+            x0, y0, x1, y1 = region
+            outline = self.outline.copy()
+            outline[y0:y1, x0:x1] = result[y0 - crop[1]:y1 - crop[1], x0 - crop[0]:x1 - crop[0]]
+            result = outline
+        with self._changed:
+            self._in_flight = False
+            if result is None:
+                self._count("error")
+                self._reference = None  # the next frame is processed in full
+            else:
+                self.outline = result
+                self._count(mode)
+                self.sequence += 1
+            self._changed.notify_all()
+            if self._waiting is not None and not self.closed:
+                frame, image, signature = self._waiting
+                self._waiting = None
+                self._dispatch(frame, image, signature)
+
+    def wait(self, after, timeout):
+        """
+        Blocks until there is an outline newer than sequence number `after`, the session is closed
+        or `timeout` seconds have passed. Returns (sequence number, outline or None).
+        """
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            self.last_active = time.monotonic()
+            while self.sequence <= after and not self.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._changed.wait(remaining)
+            return self.sequence, self.outline
+
+    def close(self):
+        with self._changed:
+            self.closed = True
+            self._waiting = None
+            self._changed.notify_all()
+
+    def to_dict(self):
+        return {
+            "session_id": self.id,
+            "frames": self.frames,
+            "sequence": self.sequence,
+            "counts": dict(self.counts),
+            "closed": self.closed,
+        }
+
+
+class StreamSessions(object):
+    """
+    The open stream sessions, sessions idle for longer than `ttl` seconds are closed.
+    Counts the results of all frames in `totals`.
+    """
+
+    def __init__(self, jobs, ttl=SESSION_TTL):
+        self.jobs = jobs
+        self.ttl = ttl
+        self.totals = dict.fromkeys(FRAME_RESULTS, 0)
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _count(self, result):
+        with self._lock:
+            self.totals[result] += 1
+
+    def _expire(self):
+        # removes the idle sessions, they are closed by the caller after releasing the lock (a
+        # session counts its frames while holding its own lock)
+        now = time.monotonic()
+        expired = [session for session in self._sessions.values() if now - session.last_active > self.ttl]
+        for session in expired:
+            del self._sessions[session.id]
+        return expired
+
+    def create(self, options=None):
+        session = StreamSession(self.jobs, options, on_frame=self._count)
+        with self._lock:
+            expired = self._expire()
+            self._sessions[session.id] = session
+        for old in expired:
+            old.close()
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            expired = self._expire()
+            session = self._sessions.get(session_id)
+        for old in expired:
+            old.close()
+        return session
+
+    def close(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None:
+            session.close()
+        return session
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
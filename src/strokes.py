@@ -0,0 +1,267 @@
+"""
+Drawing order of the strokes of an outline, for the drawing tutor.
+
+Strokes are the centre lines of the outline: the line mask is thinned to one pixel and the
+contours of the thin lines are traced. A contour runs along a line and back, so only the points
+where a contour passes a pixel for the first time are kept, and the runs of such points are the
+strokes: every piece of line is drawn once, branches become strokes of their own.
+
+The order (plan_drawing_order) is built in three levels:
+ - size: strokes of at least LONG_STROKE pixels (the main shapes) come before the details
+ - region: within a size class, the image is divided into REGION_SIZE squares (a grid index of
+   the strokes), visited row by row in serpentine order
+ - tour: within a region, the next stroke is the one with the endpoint closest to the pen, drawn
+   from that endpoint (greedy nearest neighbour over the endpoints of the region)
+Then runs of up to TWO_OPT_WINDOW consecutive strokes of the whole sequence are reversed where
+that shortens the pen-up travel (2-opt bounded to the window and to TWO_OPT_ROUNDS vectorised
+rounds). The greedy search only looks at the strokes of one region, so its cost grows with the
+number of strokes times the strokes per region, not with the square of all strokes.
+
+Like ContourSet, the points of all strokes are kept in one (N, 2) int32 array with the start
+offset of every stroke.
+"""
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from src.vector import TOLERANCE
+
+MIN_STROKE_LENGTH = 4.0  # pixels, shorter strokes (specks) are dropped
+LONG_STROKE = 40.0  # pixels, strokes at least this long are drawn before the shorter ones
+REGION_SIZE = 128  # pixels, side of the regions of the drawing order
+TWO_OPT_WINDOW = 16  # longest run of strokes reversed by 2-opt
+TWO_OPT_ROUNDS = 4
+PAGE_SIZE = 200  # strokes per page of the strokes endpoint
+MAX_PLANS = 32
+
+
+class Strokes(object):
+    """
+    Open polylines of an outline.
+
+    Attributes:
+        points (np.ndarray): (N, 2) int32 points of all strokes.
+        offsets (np.ndarray): Start of every stroke in `points`, plus the total number of points.
+        shape (tuple): (height, width) of the outline.
+    """
+
+    def __init__(self, points, offsets, shape):
+        self.points = points
+        self.offsets = offsets
+        self.shape = shape
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def stroke(self, i):
+        return self.points[self.offsets[i]:self.offsets[i + 1]]
+
+    def starts(self):
+        return self.points[self.offsets[:-1]]
+
+    def ends(self):
+        return self.points[self.offsets[1:] - 1]
+
+    def lengths(self):
+        """
+        Arc length of every stroke.
+        """
+        if len(self) == 0:
+            return np.zeros(0)
+        steps = np.hypot(*np.diff(self.points, axis=0, append=self.points[-1:]).astype(np.float64).T)
+        steps[self.offsets[1:] - 1] = 0.0  # no step from the last point of a stroke to the next stroke
+        return np.add.reduceat(steps, self.offsets[:-1]) if len(self.points) else np.zeros(len(self))
+
+    def ordered(self, order, reverse):
+        """
+        The strokes in the given order, the ones flagged in `reverse` drawn from their end.
+        """
+        order = np.asarray(order, dtype=np.int64)
+        counts = np.diff(self.offsets)[order]
+        offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        local = np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts)
+        local = np.where(np.repeat(reverse, counts), np.repeat(counts, counts) - 1 - local, local)
+        return Strokes(self.points[np.repeat(self.offsets[:-1][order], counts) + local], offsets, self.shape)
+
+    def pen_up_length(self, start=(0, 0)):
+        """
+        Distance the pen travels between the strokes in their current order, from `start`.
+        """
+        if len(self) == 0:
+            return 0.0
+        ends = np.vstack([np.asarray(start, dtype=np.float64)[None], self.ends()[:-1]])
+        return float(np.hypot(*(self.starts() - ends).T).sum())
+
+
+def extract_strokes(mask, tolerance=TOLERANCE, min_length=MIN_STROKE_LENGTH):
+    """
+    Strokes of a line mask (bool or uint8, non-zero pixels are lines), simplified with
+    approxPolyDP. Strokes shorter than `min_length` pixels are dropped.
+    """
+    skeleton = cv2.ximgproc.thinning((mask > 0).astype(np.uint8) * 255)
+    contours, _ = cv2.findContours(skeleton, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+    shape = mask.shape[:2]
+    if not contours:
+        return Strokes(np.zeros((0, 2), np.int32), np.zeros(1, dtype=np.int64), shape)
+    counts = np.fromiter((len(c) for c in contours), dtype=np.int64, count=len(contours))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    points = np.concatenate(contours).reshape(-1, 2)
+
+    # start every contour at an end of its line if it has one, so the first run is a whole stroke
+    neighbours = cv2.filter2D((skeleton > 0).astype(np.uint8), -1, np.ones((3, 3), np.uint8),
+                              borderType=cv2.BORDER_CONSTANT)
+    is_end = neighbours[points[:, 1], points[:, 0]] == 2  # the pixel itself and one neighbour
+    index = np.arange(len(points))
+    first_end = np.minimum.reduceat(np.where(is_end, index, len(points)), starts)
+    shift = np.where(first_end < starts + counts, first_end - starts, 0)
+    local = index - np.repeat(starts, counts)
+    points = points[np.repeat(starts, counts) + (local + np.repeat(shift, counts)) % np.repeat(counts, counts)]
+
+    # first visit of every pixel, runs of first visits within a contour are the strokes
+    _, first_index = np.unique(points[:, 1].astype(np.int64) * shape[1] + points[:, 0], return_index=True)
+    first = np.zeros(len(points), dtype=bool)
+    first[first_index] = True
+    contour = np.repeat(np.arange(len(contours)), counts)
+    run_start = first & ~np.concatenate(([False], first[:-1] & (contour[1:] == contour[:-1])))
+    run_end = first & ~np.concatenate((first[1:] & (contour[1:] == contour[:-1]), [False]))
+    run_starts, run_ends = np.flatnonzero(run_start), np.flatnonzero(run_end) + 1
+
+    strokes = []
+    for start, end in zip(run_starts.tolist(), run_ends.tolist()):
+        stroke = points[start:end].reshape(-1, 1, 2)
+        if cv2.arcLength(stroke, False) < min_length:
+            continue
+        if tolerance > 0:
+            stroke = cv2.approxPolyDP(stroke, tolerance, False)
+        strokes.append(stroke.reshape(-1, 2))
+    if not strokes:
+        return Strokes(np.zeros((0, 2), np.int32), np.zeros(1, dtype=np.int64), shape)
+    offsets = np.zeros(len(strokes) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in strokes], out=offsets[1:])
+    return Strokes(np.concatenate(strokes).astype(np.int32), offsets, shape)
+
+
+def _greedy_tour(starts, ends, pen):
+    # nearest neighbour over the endpoints of a group, returns the order, the reversed flags and
+    # the pen position after the last stroke
+    count = len(starts)
+    endpoints = np.vstack([starts, ends])
+    taken = np.zeros(2 * count)  # inf for the endpoints of drawn strokes
+    order = np.empty(count, dtype=np.int64)
+    reverse = np.empty(count, dtype=bool)
+    for step in range(count):
+        distances = np.square(endpoints - pen).sum(axis=1) + taken
+        nearest = int(distances.argmin())
+        stroke = nearest % count
+        order[step] = stroke
+        reverse[step] = nearest >= count
+        taken[stroke] = taken[stroke + count] = np.inf
+        pen = starts[stroke] if reverse[step] else ends[stroke]
+    return order, reverse, pen
+
+
+def _two_opt(first, last, pen, window=TWO_OPT_WINDOW, rounds=TWO_OPT_ROUNDS):
+    # first/last: (count, 2) points where the strokes start and end in drawing order. Reversing a
+    # run i..j (its order and the direction of every stroke) changes only the pen-up moves into i
+    # and out of j. Every round evaluates all runs of up to `window` strokes at once and applies
+    # the best improving ones that share no pen-up move. Returns the order and the flipped flags
+    # relative to the input.
+    count = len(first)
+    order = np.arange(count)
+    flipped = np.zeros(count, dtype=bool)
+    first, last = first.astype(np.float64), last.astype(np.float64)
+    for _ in range(rounds):
+        before = np.vstack([pen[None], last[:-1]])
+        j = np.arange(count)[:, None] + np.arange(window)[None]
+        valid = j < count
+        j = np.minimum(j, count - 1)
+        tail = j == count - 1  # reversing up to the last stroke, there is no move out of it
+        following = first[np.minimum(j + 1, count - 1)]
+        old = (np.linalg.norm(before - first, axis=1)[:, None]
+               + np.where(tail, 0.0, np.linalg.norm(last[j] - following, axis=2)))
+        new = (np.linalg.norm(before[:, None] - last[j], axis=2)
+               + np.where(tail, 0.0, np.linalg.norm(first[:, None] - following, axis=2)))
+        gain = np.where(valid, old - new, 0.0)
+        best = gain.argmax(axis=1)
+        best_gain = gain[np.arange(count), best]
+        candidates = np.flatnonzero(best_gain > 1e-6)
+        if len(candidates) == 0:
+            break
+        used = np.zeros(count + 1, dtype=bool)  # pen-up move e goes into stroke e
+        for i in candidates[np.argsort(-best_gain[candidates], kind="stable")].tolist():
+            end = i + int(best[i]) + 1
+            if used[i] or used[end] or used[i:end + 1].any():
+                continue
+            used[i:end + 1] = True
+            order[i:end] = order[i:end][::-1]
+            flipped[i:end] = ~flipped[i:end][::-1]
+            first[i:end], last[i:end] = last[i:end][::-1].copy(), first[i:end][::-1].copy()
+    return order, flipped
+
+
+def plan_drawing_order(strokes, long_stroke=LONG_STROKE, region_size=REGION_SIZE, two_opt_window=TWO_OPT_WINDOW,
+                       two_opt_rounds=TWO_OPT_ROUNDS, start=(0, 0)):
+    """
+    Drawing order of strokes (see the module docstring), starting with the pen at `start`.
+
+    Returns:
+        tuple: the stroke indices in drawing order and whether each of them is drawn from its end.
+    """
+    if len(strokes) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+    starts, ends = strokes.starts().astype(np.float64), strokes.ends().astype(np.float64)
+    (H, W) = strokes.shape
+    columns = max(1, -(-W // region_size))
+    # region of every stroke (by the middle of its endpoints), serpentine over the rows
+    middle = (starts + ends) / 2
+    row = np.clip(middle[:, 1] // region_size, 0, max(0, -(-H // region_size) - 1)).astype(np.int64)
+    column = np.clip(middle[:, 0] // region_size, 0, columns - 1).astype(np.int64)
+    column = np.where(row % 2 == 1, columns - 1 - column, column)
+    size_class = (strokes.lengths() < long_stroke).astype(np.int64)  # long strokes first
+    group = (size_class * (row.max() + 1) + row) * columns + column
+
+    by_group = np.argsort(group, kind="stable")
+    boundaries = np.flatnonzero(np.diff(group[by_group])) + 1
+    pen = np.asarray(start, dtype=np.float64)
+    orders, reverses = [], []
+    for members in np.split(by_group, boundaries):
+        order, reverse, pen = _greedy_tour(starts[members], ends[members], pen)
+        orders.append(members[order])
+        reverses.append(reverse)
+    order, reverse = np.concatenate(orders), np.concatenate(reverses)
+    if two_opt_window > 0 and two_opt_rounds > 0 and len(order) > 1:
+        first = np.where(reverse[:, None], ends[order], starts[order])
+        last = np.where(reverse[:, None], starts[order], ends[order])
+        moved, flipped = _two_opt(first, last, np.asarray(start, dtype=np.float64), two_opt_window,
+                                  two_opt_rounds)
+        order, reverse = order[moved], reverse[moved] ^ flipped
+    return order, reverse
+
+
+class DrawingPlans(object):
+    """
+    LRU of ordered strokes, so the pages of a plan are served without planning again.
+    """
+
+    def __init__(self, max_plans=MAX_PLANS):
+        self.max_plans = max_plans
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, plan):
+        """
+        The plan stored under `key`, computed with `plan()` if there is none.
+        """
+        with self._lock:
+            if key in self._plans:
+                self._plans.move_to_end(key)
+                return self._plans[key]
+        result = plan()
+        with self._lock:
+            self._plans[key] = result
+            while len(self._plans) > self.max_plans:
+                self._plans.popitem(last=False)
+        return result
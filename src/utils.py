@@ -13,4 +13,23 @@ def format_bytes(size):
     while size >= 1024 and index < len(units) - 1:
         size /= 1024.0
         index += 1
-    return f"{size:.2f} {units[index]}"
\ No newline at end of file
+    return f"{size:.2f} {units[index]}"
+
+def parse_hex_color(value):
+    """
+    Converts a hex color string to an OpenCV (BGR) color tuple.
+
+    Args:
+        value (str): Color in the form "RRGGBB" or "#RRGGBB".
+
+    Returns:
+        tuple: (blue, green, red) values in the range 0-255.
+
+    Raises:
+        ValueError: If the string is not a valid hex color.
+    """
+    value = value.lstrip("#")
+    if len(value) != 6:
+        raise ValueError(f"invalid color \"{value}\", expected RRGGBB")
+    red, green, blue = (int(value[i:i + 2], 16) for i in (0, 2, 4))
+    return blue, green, red
@@ -0,0 +1,103 @@
+"""
+Vector representation of outlines: the line mask traced into simplified polylines.
+
+Binary format (little-endian):
+ - header: 4-byte magic "PAV1", width, height and number of polylines as uint32
+ - number of points of every polyline as uint32
+ - the points of all polylines as int16 (x, y) pairs. The first point of a polyline is absolute,
+   the following ones are deltas to the previous point. Polylines are closed.
+
+The polylines are the boundaries of the line regions (outer boundaries and holes), filling them
+with the even-odd rule (cv2.fillPoly) restores the lines.
+"""
+import struct
+
+import cv2
+import numpy as np
+
+POLYLINES_MAGIC = b"PAV1"
+_HEADER = struct.Struct("<4sIII")
+TOLERANCE = 1.0  # maximum distance (pixels) between a polyline and the traced contour
+
+
+def extract_polylines(mask, tolerance=TOLERANCE, min_points=1):
+    """
+    Traces the boundaries of the line regions of a mask into polylines simplified with approxPolyDP.
+
+    Args:
+        mask (np.ndarray): Line mask (bool or uint8, non-zero pixels are lines).
+        tolerance (float): Simplification tolerance in pixels, 0 keeps every contour point.
+        min_points (int): Polylines with fewer points are dropped.
+
+    Returns:
+        list: One int32 array of shape (N, 2) with the (x, y) points per polyline.
+    """
+    contours, _ = cv2.findContours((mask > 0).astype(np.uint8), cv2.RETR_CCOMP,
+                                   cv2.CHAIN_APPROX_SIMPLE)
+    polylines = []
+    for contour in contours:
+        if tolerance > 0:
+            contour = cv2.approxPolyDP(contour, tolerance, True)
+        if len(contour) >= min_points:
+            polylines.append(contour.reshape(-1, 2))
+    return polylines
+
+
+def encode_polylines(polylines, width, height):
+    """
+    Serializes polylines (as returned by extract_polylines) of an image of the given size.
+
+    Returns:
+        bytes: The encoded polylines.
+    """
+    if max(width, height) > np.iinfo(np.int16).max:
+        raise ValueError("images larger than 32767 pixels cannot be encoded as polylines")
+    counts = np.array([len(p) for p in polylines], dtype="<u4")
+    points = np.concatenate(polylines).astype(np.int32) if polylines else np.zeros((0, 2), np.int32)
+
+    # deltas to the previous point, except at the start of every polyline
+    deltas = np.diff(points, axis=0, prepend=np.zeros((1, 2), np.int32))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64)
+    deltas[starts[counts > 0]] = points[starts[counts > 0]]
+    return (_HEADER.pack(POLYLINES_MAGIC, width, height, len(polylines)) + counts.tobytes()
+            + deltas.astype("<i2").tobytes())
+
+
+def decode_polylines(data):
+    """
+    Returns:
+        tuple: (list of (N, 2) int32 point arrays, width, height)
+    """
+    magic, width, height, count = _HEADER.unpack_from(data)
+    if magic != POLYLINES_MAGIC:
+        raise ValueError("not an encoded polyline outline")
+    if count == 0:
+        return [], width, height
+    counts = np.frombuffer(data, dtype="<u4", count=count, offset=_HEADER.size).astype(np.int64)
+    deltas = np.frombuffer(data, dtype="<i2", offset=_HEADER.size + 4 * count).reshape(-1, 2)
+    deltas = deltas.astype(np.int32)
+
+    # a running sum over all deltas, restarted at the first point of every polyline by subtracting
+    # the sum reached before it
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[counts > 0]
+    points = np.cumsum(deltas, axis=0, dtype=np.int32)
+    before = np.zeros_like(points)
+    before[starts] = points[starts] - deltas[starts]
+    polyline_start = np.zeros(len(points), dtype=np.int64)
+    polyline_start[starts] = starts
+    points -= before[np.maximum.accumulate(polyline_start)]
+    return np.split(points, np.cumsum(counts)[:-1]), width, height
+
+
+def render_polylines(polylines, width, height):
+    """
+    Rasterizes decoded polylines into a line mask (uint8, lines are 255), e.g. to compare with the
+    raster outline.
+    """
+    mask = np.zeros((height, width), dtype=np.uint8)
+    contours = [p.reshape(-1, 1, 2).astype(np.int32) for p in polylines]
+    if contours:
+        cv2.fillPoly(mask, contours, 255)
+        # the boundary pixels belong to the lines, also where a region is thinner than a pixel
+        cv2.polylines(mask, contours, True, 255, 1)
+    return mask
@@ -0,0 +1,170 @@
+"""
+Outlines warped onto the marker plane, as the headset shows them.
+
+The pose is given as the positions of the four outline corners in the output image (e.g. the
+marker plane projected into the camera frame), or as the homography from outline to output
+pixels. Raster formats warp the outline with warpPerspective, the polylines format transforms
+the points of the vector outline instead.
+
+The set of poses users take in front of an image is small and repetitive, so warped outlines are
+kept in an LRU (WarpCache), keyed on the source outline and the pose with the corners rounded to
+POSE_QUANTUM pixels. A pose whose corners are all within POSE_TOLERANCE pixels of a cached one
+reuses that warp.
+"""
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from src.encoding import encode_outline, outline_mask
+from src.image_processing import OUTLINE_PNG_PARAMS
+from src.vector import TOLERANCE, encode_polylines, extract_polylines
+
+POSE_QUANTUM = 2.0  # pixels, the corners of a pose are rounded to this grid for the cache key
+POSE_TOLERANCE = 3.0  # pixels, largest corner displacement at which a cached warp is reused
+MAX_SOURCE_SIZES = 4096  # sizes of source outlines remembered, so hits do not read the outline
+
+
+def outline_corners(width, height):
+    # top left, top right, bottom right, bottom left, like the corners of a detected marker
+    return np.array([[0, 0], [width, 0], [width, height], [0, height]], dtype=np.float32)
+
+
+def pose_corners(width, height, corners=None, homography=None):
+    """
+    The output positions (4 x 2, float32) of the corners of a `width` x `height` outline, from
+    the corners themselves or from a homography (3 x 3). Raises ValueError for invalid poses.
+    """
+    if homography is not None:
+        homography = np.asarray(homography, dtype=np.float64).reshape(3, 3)
+        corners = cv2.perspectiveTransform(outline_corners(width, height)[None], homography)[0]
+    corners = np.asarray(corners, dtype=np.float32).reshape(4, 2)
+    if not np.isfinite(corners).all():
+        raise ValueError("the pose maps the outline to infinity")
+    if cv2.contourArea(corners) < 1:
+        raise ValueError("the corners of the pose must span an area")
+    return corners
+
+
+def warp_outline(rgba_image, corners, size):
+    """
+    Warps an outline so its corners land on `corners`, in an output of `size` (width, height).
+    Pixels outside the outline are transparent.
+    """
+    (H, W) = rgba_image.shape[:2]
+    homography = cv2.getPerspectiveTransform(outline_corners(W, H), corners)
+    return cv2.warpPerspective(rgba_image, homography, tuple(size), flags=cv2.INTER_LINEAR,
+                               borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0, 0))
+
+
+def warp_polylines(polylines, homography):
+    """
+    Transforms the points of polylines (see src.vector) with a homography.
+    """
+    limit = np.iinfo(np.int16)
+    warped = []
+    for polyline in polylines:
+        points = cv2.perspectiveTransform(polyline.reshape(1, -1, 2).astype(np.float32), homography)[0]
+        warped.append(np.clip(np.rint(points), limit.min, limit.max).astype(np.int32))
+    return warped
+
+
+def encode_warped(rgba_image, corners, size, fmt, tolerance=TOLERANCE):
+    """
+    The outline warped to the pose, encoded in one of FORMATS (see src.encoding).
+    """
+    if fmt == "png":
+        # fast settings, like the stepwise outlines, a warp is computed per pose
+        ok, png = cv2.imencode(".png", warp_outline(rgba_image, corners, size), OUTLINE_PNG_PARAMS)
+        if not ok:
+            raise ValueError("could not encode the warped outline as .png")
+        return png.tobytes()
+    if fmt != "polylines":
+        return encode_outline(warp_outline(rgba_image, corners, size), fmt)
+    (H, W) = rgba_image.shape[:2]
+    homography = cv2.getPerspectiveTransform(outline_corners(W, H), corners)
+    polylines = extract_polylines(outline_mask(rgba_image), tolerance)
+    return encode_polylines(warp_polylines(polylines, homography), *size)
+
+
+class WarpCache(object):
+    """
+    LRU of warped outlines, keyed on the source (any hashable, e.g. the content hash of the outline),
+    the output size, the format and the quantized pose. Bounded by the total size of the results.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 ** 2, quantum=POSE_QUANTUM, tolerance=POSE_TOLERANCE):
+        self.max_bytes = max_bytes
+        self.quantum = quantum
+        self.tolerance = tolerance
+        self.counts = {"hit": 0, "near": 0, "miss": 0}
+        self._entries = OrderedDict()  # key -> (corners, data)
+        self._poses = {}  # (source, size, format) -> keys of its cached poses
+        self._sizes = OrderedDict()  # source -> (width, height)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def source_size(self, source, read):
+        """
+        (width, height) of a source outline, `read()` returns the outline if it is not known yet.
+        """
+        with self._lock:
+            if source in self._sizes:
+                self._sizes.move_to_end(source)
+                return self._sizes[source]
+        size = tuple(read().shape[1::-1])
+        with self._lock:
+            self._sizes[source] = size
+            while len(self._sizes) > MAX_SOURCE_SIZES:
+                self._sizes.popitem(last=False)
+        return size
+
+    def get(self, source, corners, size, fmt, warp):
+        """
+        Returns the warped outline for the pose, calling `warp()` on a miss.
+
+        Returns:
+            tuple: (data, "hit" | "near" | "miss", largest corner distance (pixels) to the pose
+            of the returned warp)
+        """
+        group = (source, tuple(size), fmt)
+        key = group + (tuple(np.round(corners.ravel() / self.quantum).astype(int).tolist()),)
+        with self._lock:
+            result = None
+            if key in self._entries:
+                result = "hit", key
+            elif self._poses.get(group):
+                keys = list(self._poses[group])
+                cached = np.stack([self._entries[k][0] for k in keys])
+                distances = np.abs(cached - corners).max(axis=(1, 2))
+                nearest = int(distances.argmin())
+                if distances[nearest] <= self.tolerance:
+                    result = "near", keys[nearest]
+            if result is not None:
+                status, found = result
+                self._entries.move_to_end(found)
+                self.counts[status] += 1
+                cached_corners, data = self._entries[found]
+                return data, status, float(np.abs(cached_corners - corners).max())
+            self.counts["miss"] += 1
+
+        data = warp()
+
+        with self._lock:
+            if key not in self._entries and len(data) <= self.max_bytes:
+                self._entries[key] = (corners.copy(), data)
+                self._poses.setdefault(group, set()).add(key)
+                self._bytes += len(data)
+                while self._bytes > self.max_bytes:
+                    evicted, (_, evicted_data) = self._entries.popitem(last=False)
+                    self._bytes -= len(evicted_data)
+                    poses = self._poses[evicted[:3]]
+                    poses.discard(evicted)
+                    if not poses:
+                        del self._poses[evicted[:3]]
+        return data, "miss", 0.0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,53 @@
+import os
+import queue
+import threading
+import uuid
+
+
+class AsyncWriter(object):
+    """
+    Writes files on a background thread, so persisting images stays off the request path.
+
+    Files are written to a temporary name first and then renamed, readers never see partial files.
+    """
+
+    def __init__(self, max_pending=256):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.written = 0
+        self.failed = 0
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="async-writer", daemon=True)
+                self._thread.start()
+
+    def write(self, path, data):
+        """
+        Queues `data` (bytes) to be written to `path`. Blocks if too many writes are pending.
+        """
+        self._ensure_started()
+        self._queue.put((path, data))
+
+    def _run(self):
+        while True:
+            path, data = self._queue.get()
+            try:
+                tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                self.written += 1
+            except OSError as e:
+                self.failed += 1
+                print(f"Error while writing {path}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """
+        Blocks until all queued files are written.
+        """
+        self._queue.join()